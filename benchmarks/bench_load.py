@@ -0,0 +1,69 @@
+"""
+Compare staging load throughput (rows/sec) of the available to_sql paths.
+
+    uv run python -m benchmarks.bench_load --rows 200000
+    uv run python -m benchmarks.bench_load --db-uri postgresql://localhost:5432/postgres
+
+COPY FROM STDIN is only measured against a Postgres URI; the default in-memory
+SQLite database compares the batched executemany fallback with pandas'
+method='multi'.
+"""
+import argparse
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from src.clean_and_load import copy_insert
+from src.config import INSERT_BATCH_SIZE
+
+
+def make_frame(rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "Production Code": "CD001",
+        "Unit ID": [f"U{i}" for i in range(rows)],
+        "Column A Stage A": rng.random(rows),
+        "Column B Stage A": rng.random(rows),
+        "Column C Stage A": rng.random(rows),
+        "Column D Stage A": rng.random(rows),
+        "processing_ts": datetime.now(),
+    })
+
+
+def run(engine, df: pd.DataFrame, name: str, **to_sql_kwargs) -> float:
+    table = f"bench_{name}"
+    with engine.begin() as conn:
+        conn.execute(text(f'DROP TABLE IF EXISTS "{table}"'))
+    start = time.perf_counter()
+    df.to_sql(table, engine, if_exists='append', index=False, **to_sql_kwargs)
+    elapsed = time.perf_counter() - start
+    with engine.begin() as conn:
+        conn.execute(text(f'DROP TABLE IF EXISTS "{table}"'))
+    return len(df) / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-uri", default="sqlite://")
+    parser.add_argument("--rows", type=int, default=100_000)
+    args = parser.parse_args()
+
+    engine = create_engine(args.db_uri)
+    df = make_frame(args.rows)
+    paths = {
+        "executemany": {"chunksize": INSERT_BATCH_SIZE},
+        "multi_values": {"method": "multi", "chunksize": INSERT_BATCH_SIZE},
+    }
+    if engine.dialect.name == "postgresql":
+        paths["copy"] = {"method": copy_insert}
+    print(f"{args.rows} rows -> {engine.dialect.name}")
+    for name, kwargs in paths.items():
+        print(f"{name:>14}: {run(engine, df, name, **kwargs):>12,.0f} rows/sec")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+End-to-end pipeline benchmark on synthetic data, runnable offline.
+
+    uv run python -m benchmarks.bench_pipeline --files 30 --rows 20000
+    uv run python -m benchmarks.bench_pipeline --dirty-ratio 0.05 --duplicate-ratio 0.1 --workers 4
+
+Synthetic AB/CD/EF CSVs are served from an in-process S3 stand-in and loaded into a
+SQLite file (or --db-uri). Each stage of process_file is timed on its own, followed
+by an end-to-end process_file run and load_to_prod for every staging table, and the
+report gives rows/sec, bytes/sec and peak RSS per stage.
+"""
+import argparse
+import io
+import os
+import resource
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+import pandas as pd
+from sqlalchemy import create_engine, inspect, text
+
+from benchmarks.stand_ins import FakeS3Client, populate_bucket, register_sqlite_functions
+from src import transform
+from src.clean_and_load import (
+    RunContext, cleaning_data, load_to_postgres, process_file, route_by_production_code,
+)
+from src.config import EXPECTED_SCHEMAS
+from src.extract import (
+    coerce_numeric_columns, csv_read_options, drop_invalid_production_codes, validate_csv_schema_by_production_code,
+)
+
+BUCKET = 'bench'
+PREFIX = 'raw/'
+
+
+def _reset_peak_rss() -> None:
+    # Linux: writing 5 to clear_refs resets VmHWM, so each stage reports its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageStats:
+    def __init__(self) -> None:
+        self.stats: Dict[str, Dict[str, float]] = {}
+
+    @contextmanager
+    def stage(self, name: str, rows: int = 0, nbytes: int = 0) -> Iterator[None]:
+        _reset_peak_rss()
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        entry = self.stats.setdefault(name, {'seconds': 0.0, 'rows': 0, 'bytes': 0, 'peak_rss_mb': 0.0})
+        entry['seconds'] += elapsed
+        entry['rows'] += rows
+        entry['bytes'] += nbytes
+        entry['peak_rss_mb'] = max(entry['peak_rss_mb'], _peak_rss_mb())
+
+    def report(self) -> str:
+        lines = [f"{'stage':<14}{'seconds':>10}{'rows/sec':>14}{'MB/sec':>10}{'peak RSS MB':>13}"]
+        for name, s in self.stats.items():
+            seconds = s['seconds'] or float('nan')
+            lines.append(
+                f"{name:<14}{s['seconds']:>10.3f}{s['rows'] / seconds:>14,.0f}"
+                f"{s['bytes'] / seconds / 1e6:>10.1f}{s['peak_rss_mb']:>13.1f}"
+            )
+        return '\n'.join(lines)
+
+
+def bench_stages(s3: FakeS3Client, engine: Any, stats: StageStats) -> None:
+    for key in list(s3.objects):
+        with stats.stage('download', nbytes=len(s3.objects[key])):
+            body = s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+        with stats.stage('parse', nbytes=len(body)):
+            df = coerce_numeric_columns(pd.read_csv(io.BytesIO(body), **csv_read_options()), key)
+        stats.stats['parse']['rows'] += len(df)
+        with stats.stage('validate', rows=len(df)):
+            valid, res = validate_csv_schema_by_production_code(df, EXPECTED_SCHEMAS)
+        if isinstance(res, pd.DataFrame):
+            df = res
+        with stats.stage('drop_invalid', rows=len(df)):
+            df = drop_invalid_production_codes(df)
+        with stats.stage('clean', rows=len(df)):
+            df = cleaning_data(df)
+        with stats.stage('load', rows=len(df)):
+            for table_name, group in route_by_production_code(df):
+                load_to_postgres(group, f"bench_{table_name}", engine=engine)
+
+
+def bench_merges(engine: Any, stats: StageStats) -> None:
+    staging = [t for t in inspect(engine).get_table_names() if t.startswith('stg_')]
+    for source_table in staging:
+        target_table = f"prod_{source_table[len('stg_'):]}"
+        with engine.connect() as conn:
+            rows = conn.execute(text(f'select count(*) from {conn.dialect.identifier_preparer.quote(source_table)}')).scalar()
+        with stats.stage('load_to_prod', rows=rows):
+            transform.load_to_prod(source_table, target_table, engine=engine)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=30)
+    parser.add_argument('--rows', type=int, default=10_000, help='rows per file')
+    parser.add_argument('--dirty-ratio', type=float, default=0.02)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.05)
+    parser.add_argument('--codes-per-prefix', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunksize', type=int, default=None)
+    parser.add_argument('--low-memory', action='store_true', help='clean with clean_low_memory')
+    parser.add_argument('--quarantine', action='store_true', help='clean with clean_with_rules, quarantining rejects')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='processes parsing and cleaning files behind the download threads')
+    parser.add_argument('--db-uri', default=None, help='defaults to a temporary SQLite file')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.TemporaryDirectory()
+    db_uri = args.db_uri or f"sqlite:///{os.path.join(tmpdir.name, 'bench.db')}"
+    engine = create_engine(db_uri)
+    register_sqlite_functions(engine)
+
+    s3 = FakeS3Client()
+    total_bytes = populate_bucket(
+        s3, BUCKET, PREFIX, args.files, args.rows,
+        dirty_ratio=args.dirty_ratio, duplicate_ratio=args.duplicate_ratio,
+        codes_per_prefix=args.codes_per_prefix,
+    )
+    total_rows = args.files * args.rows
+    print(f"{args.files} files, {total_rows:,} rows, {total_bytes / 1e6:.1f} MB -> {engine.dialect.name}\n")
+
+    stats = StageStats()
+    bench_stages(s3, engine, stats)
+    with stats.stage('process_file', rows=total_rows, nbytes=total_bytes):
+        ctx = RunContext(engine=engine, max_workers=args.workers, parse_workers=args.parse_workers,
+                         chunksize=args.chunksize, low_memory=args.low_memory, quarantine=args.quarantine)
+        results = process_file(s3, BUCKET, PREFIX, ctx)
+    failed = [r for r in results if r['status'] == 'failed']
+    bench_merges(engine, stats)
+    print(stats.report())
+    if failed:
+        print(f"\n{len(failed)} files failed, e.g. {failed[0]['key']}: {failed[0]['error']}")
+    engine.dispose()
+    tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Offline stand-ins for the pipeline's external services, plus synthetic data.
+
+FakeS3Client serves in-memory objects through the subset of the boto3 S3 client API
+the pipeline uses (paginated list_objects_v2, get_object with optional Range), and
+make_csv builds AB/CD/EF files that match TYPED_SCHEMAS.
+"""
+import hashlib
+import io
+import sqlite3
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import event
+
+from src.config import TYPED_SCHEMAS
+
+COMMENTS = ['Comment', 'test', 'This is not Real']
+OPERATORS = ['alice', 'bob', 'carol', 'dave']
+
+
+class FakeS3Client:
+    """
+    In-process S3 bucket keyed by object key.
+    """
+
+    def __init__(self, page_size: int = 1000):
+        self.objects: Dict[str, bytes] = {}
+        self.page_size = page_size
+        self.modified: Dict[str, datetime] = {}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes) -> None:
+        self.objects[Key] = Body
+        self.modified[Key] = datetime.now(timezone.utc)
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = '', ContinuationToken: Optional[str] = None,
+                        StartAfter: Optional[str] = None, MaxKeys: Optional[int] = None) -> Dict[str, Any]:
+        keys = sorted(k for k in self.objects if k.startswith(Prefix))
+        if StartAfter:
+            keys = [k for k in keys if k > StartAfter]
+        start = int(ContinuationToken or 0)
+        end = start + (MaxKeys or self.page_size)
+        response: Dict[str, Any] = {
+            'Contents': [self._entry(k) for k in keys[start:end]],
+            'IsTruncated': end < len(keys),
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(end)
+        return response
+
+    def get_object(self, Bucket: str, Key: str, Range: Optional[str] = None) -> Dict[str, Any]:
+        body = self.objects[Key]
+        if Range:
+            first, last = Range[len('bytes='):].split('-')
+            body = body[int(first):int(last) + 1]
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+
+    def _entry(self, key: str) -> Dict[str, Any]:
+        body = self.objects[key]
+        return {
+            'Key': key,
+            'ETag': f'"{hashlib.md5(body).hexdigest()}"',
+            'Size': len(body),
+            'LastModified': self.modified[key],
+        }
+
+
+def make_frame(production_code: str, rows: int, dirty_ratio: float = 0.0,
+               duplicate_ratio: float = 0.0, seed: int = 0) -> pd.DataFrame:
+    """
+    Synthetic rows for the schema of production_code's prefix. dirty_ratio of the rows
+    get an invalid Production Code or a missing value; duplicate_ratio of them repeat
+    an earlier row.
+    """
+    rng = np.random.default_rng(seed)
+    data = {}
+    for name, dtype, _ in TYPED_SCHEMAS[production_code[:2]]:
+        if name == 'Production Code':
+            data[name] = np.full(rows, production_code, dtype=object)
+        elif name == 'Comment':
+            data[name] = rng.choice(COMMENTS, rows)
+        elif name == 'Operator':
+            data[name] = rng.choice(OPERATORS, rows)
+        elif name == 'Child Position':
+            data[name] = np.char.add('C', rng.integers(0, 100, rows).astype(str))
+        elif dtype == 'float64':
+            data[name] = rng.random(rows) * 100
+        else:
+            data[name] = np.char.add(name[0], rng.integers(0, 10 * rows + 1, rows).astype(str))
+    df = pd.DataFrame(data)
+    dirty = rng.random(rows) < dirty_ratio
+    invalid_code = dirty & (rng.random(rows) < 0.5)
+    df.loc[invalid_code, 'Production Code'] = 'BAD'
+    df.loc[dirty & ~invalid_code, df.columns[-1]] = np.nan
+    duplicates = np.flatnonzero(rng.random(rows) < duplicate_ratio)
+    duplicates = duplicates[duplicates > 0]
+    if len(duplicates):
+        df.iloc[duplicates] = df.iloc[rng.integers(0, duplicates)].to_numpy()
+    return df
+
+
+def make_csv(production_code: str, rows: int, **kwargs: Any) -> bytes:
+    return make_frame(production_code, rows, **kwargs).to_csv(index=False).encode()
+
+
+def populate_bucket(s3_client: FakeS3Client, bucket: str, prefix: str, files: int, rows: int,
+                    dirty_ratio: float = 0.0, duplicate_ratio: float = 0.0,
+                    codes_per_prefix: int = 1) -> int:
+    """
+    Spread files CSVs round-robin over the AB/CD/EF prefixes and return the total bytes.
+    """
+    total = 0
+    prefixes = list(TYPED_SCHEMAS)
+    for i in range(files):
+        code = f"{prefixes[i % len(prefixes)]}{(i // len(prefixes)) % codes_per_prefix + 1:03d}"
+        body = make_csv(code, rows, dirty_ratio=dirty_ratio, duplicate_ratio=duplicate_ratio, seed=i)
+        s3_client.put_object(Bucket=bucket, Key=f"{prefix}{code}_{i:05d}.csv", Body=body)
+        total += len(body)
+    return total
+
+
+def register_sqlite_functions(engine: Any) -> None:
+    """
+    Give a SQLite stand-in database the md5() and concat() functions the merge queries use.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _register(dbapi_conn: sqlite3.Connection, _: Any) -> None:
+        dbapi_conn.create_function('md5', 1, lambda v: hashlib.md5(str(v).encode()).hexdigest(), deterministic=True)
+        dbapi_conn.create_function('concat', -1, lambda *v: ''.join('' if x is None else str(x) for x in v), deterministic=True)
@@ -1,7 +1,37 @@
-import boto3
+"""
+ETL pipeline command line.
+
+    uv run --env-file=.env main.py run --bucket mybucket --prefix raw/ --workers 8
+    uv run --env-file=.env main.py plan --sub-prefixes AB CD EF
+    uv run --env-file=.env main.py run --work-queue-uri "$DB_URI" --sub-prefixes AB   # on each node
+    uv run --env-file=.env main.py watch --merge --batch-window 2
+
+'run' (the default) ingests new objects; 'watch' keeps ingesting them in micro-batches
+with a warm engine until stopped; 'plan' lists and header-checks what a run would
+ingest without importing pandas or connecting to the database. Heavy modules are
+imported only when needed, so a run that finds nothing new exits before pandas or
+the engine are loaded.
+"""
+import argparse
+import itertools
 import os
 import logging
-from src.clean_and_load import process_file
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from src.config import (
+    S3_BUCKET, S3_RAW_PREFIX, EXPECTED_SCHEMAS, HEADER_PEEK_BYTES, DB_POOL_SIZE, MAX_WORKERS, CHUNK_SIZE,
+    COALESCE_LOADS, MERGE_AFTER_LOAD, MERGE_WORKERS, LOW_MEMORY, QUARANTINE_REJECTS, PARSE_WORKERS,
+    MANIFEST_URI, WORK_QUEUE_URI,
+    METRICS_JSON_PATH, METRICS_PROM_PATH, PROFILE_DIR, PROFILE_TOP_N,
+    DEDUPE_INDEX_PATH, DEDUPE_BLOOM_CAPACITY, DEDUPE_BLOOM_ERROR_RATE, DEDUPE_KEYS_ONLY, CACHE_DIR,
+    WATCH_INTERVAL, WATCH_BATCH_FILES, WATCH_BATCH_BYTES, WATCH_BATCH_WINDOW,
+)
+from src.listing import check_header, list_s3_objects, list_s3_objects_by_prefixes, read_head_bytes
+
+logger = logging.getLogger(__name__)
 
 def setup_logging():
     logging.basicConfig(
@@ -9,21 +39,249 @@ def setup_logging():
         format='%(asctime)s %(levelname)s %(name)s %(message)s',
     )
 
-def main():
-    setup_logging()
-    logger = logging.getLogger(__name__)
+def s3_client() -> Any:
+    import boto3
+    return boto3.client(
+        's3',
+        endpoint_url=os.environ.get("endpoint_url"),
+        aws_access_key_id=os.environ.get("aws_access_key_id"),
+        aws_secret_access_key=os.environ.get("aws_secret_access_key")
+    )
+
+def list_objects(s3: Any, args: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    if args.sub_prefixes:
+        return list_s3_objects_by_prefixes(s3, args.bucket, args.prefix, args.sub_prefixes)
+    return list_s3_objects(s3, args.bucket, args.prefix)
+
+def open_manifest(uri: Optional[str]) -> Any:
+    if not uri:
+        return None
+    from src.manifest import IngestionManifest
+    return IngestionManifest.from_uri(uri)
+
+def open_work_queue(uri: Optional[str]) -> Any:
+    if not uri:
+        return None
+    from src.work_queue import WorkQueue
+    return WorkQueue.from_uri(uri)
+
+def run(args: argparse.Namespace) -> int:
+    s3 = s3_client()
+    manifest = open_manifest(args.manifest_uri)
+    work_queue = open_work_queue(args.work_queue_uri)
+    objects = list_objects(s3, args) if work_queue is None or args.enqueue else iter(())
+    if manifest is not None:
+        objects = (obj for obj in objects if manifest.should_process(obj))
+    if work_queue is not None:
+        logger.info(f"Queued {work_queue.enqueue(objects)} listed objects")
+        objects = work_queue.drain()
+    first = next(objects, None)
+    if first is None:
+        logger.info("Nothing new to ingest.")
+        return 0
+    return ingest(s3, args, manifest, itertools.chain([first], objects), work_queue)
+
+@contextmanager
+def pipeline(s3: Any, args: argparse.Namespace, manifest: Any, work_queue: Any = None) -> Iterator[Any]:
+    """
+    Set up what every batch of a run or watch session shares (the pooled engine,
+    dedupe index, batch cache, metrics and profiler) and yield ingest_batch(objects),
+    which processes one batch of listing entries and returns (file results, names
+    of failed prod merges). Metrics are written after every batch.
+    """
+    from src.cache import BatchCache
+    from src.clean_and_load import RunContext, process_file
+    from src.db import create_pipeline_engine
+    from src.dedupe import DedupeIndex
+    from src import metrics
+    from src.metrics import FileProfiler, RunMetrics
+    from src.scheduler import MergeScheduler
+    from src.staged import shutdown_parse_pools
+
+    profiler = FileProfiler(args.profile_top) if args.profile_dir else None
+    # cProfile allows one active profiler per process
+    workers = 1 if profiler else args.workers
+    merge_workers = args.merge_workers if args.merge else 0
+    engine = create_pipeline_engine(pool_size=max(DB_POOL_SIZE, workers + merge_workers))
+    run_metrics = RunMetrics()
+
+    def ingest_batch(objects: Iterable[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[str]]:
+        scheduler = MergeScheduler(engine, max_workers=merge_workers) if args.merge else None
+        try:
+            ctx = RunContext(
+                engine=engine, max_workers=workers, parse_workers=args.parse_workers, chunksize=args.chunksize,
+                coalesce=args.coalesce, low_memory=args.low_memory, quarantine=args.quarantine,
+                manifest=manifest, run_metrics=run_metrics, profiler=profiler, dedupe_index=dedupe_index,
+                batch_cache=batch_cache, scheduler=scheduler, work_queue=work_queue,
+            )
+            results = process_file(s3_client=s3, bucket_name=args.bucket, prefix=args.prefix, ctx=ctx, objects=objects)
+            failed_merges = []
+            if scheduler is not None:
+                with metrics.activate(run_metrics):
+                    merges = scheduler.wait()
+                failed_merges = [table for table, merge in merges.items() if merge['status'] == 'failed']
+                if failed_merges:
+                    logger.error(f"Prod merges failed for {', '.join(failed_merges)}")
+            return results, failed_merges
+        finally:
+            if args.metrics_json:
+                run_metrics.write_json(args.metrics_json)
+            if args.metrics_prom:
+                run_metrics.write_prometheus(args.metrics_prom)
+
     try:
-        s3 = boto3.client(
-            's3',
-            endpoint_url=os.environ.get("endpoint_url"),
-            aws_access_key_id=os.environ.get("aws_access_key_id"),
-            aws_secret_access_key=os.environ.get("aws_secret_access_key")
-        )
+        dedupe_index = DedupeIndex(
+            DEDUPE_INDEX_PATH, bloom_capacity=DEDUPE_BLOOM_CAPACITY,
+            error_rate=DEDUPE_BLOOM_ERROR_RATE, keys_only=DEDUPE_KEYS_ONLY,
+        ) if DEDUPE_INDEX_PATH else None
+        batch_cache = BatchCache(CACHE_DIR) if CACHE_DIR else None
+        yield ingest_batch
+    finally:
+        if work_queue is not None:
+            work_queue.close()
+        shutdown_parse_pools()
+        engine.dispose()
+        if profiler:
+            profiler.dump(args.profile_dir)
+
+def ingest(
+    s3: Any, args: argparse.Namespace, manifest: Any, objects: Iterator[Dict[str, Any]], work_queue: Any = None
+) -> int:
+    with pipeline(s3, args, manifest, work_queue) as ingest_batch:
         logger.info("Starting ETL pipeline...")
-        process_file(s3_client=s3, bucket_name='mybucket', prefix='raw/')
+        _, failed_merges = ingest_batch(objects)
         logger.info("ETL pipeline completed successfully.")
+    return 1 if failed_merges else 0
+
+def watch(args: argparse.Namespace) -> int:
+    from src.watch import Watcher
+
+    s3 = s3_client()
+    manifest = open_manifest(args.manifest_uri)
+    prefixes = [f"{args.prefix}{sub}" for sub in args.sub_prefixes] if args.sub_prefixes else [args.prefix]
+    with pipeline(s3, args, manifest) as ingest_batch:
+        watcher = Watcher(
+            s3, args.bucket, prefixes, lambda objects: ingest_batch(objects)[0],
+            interval=args.interval, batch_files=args.batch_files, batch_bytes=args.batch_bytes,
+            batch_window=args.batch_window,
+        )
+        signal.signal(signal.SIGTERM, lambda *_: watcher.stop())
+        logger.info(f"Watching s3://{args.bucket}/{{{','.join(prefixes)}}} for new objects...")
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            watcher.stop()
+    return 0
+
+def plan(args: argparse.Namespace) -> int:
+    s3 = s3_client()
+    manifest = open_manifest(args.manifest_uri)
+    listed = list(list_objects(s3, args))
+    pending = [obj for obj in listed if manifest is None or manifest.should_process(obj)]
+
+    def check(obj: Dict[str, Any]) -> Any:
+        if not args.prevalidate:
+            return True, ''
+        try:
+            return check_header(read_head_bytes(s3, args.bucket, obj['Key'], HEADER_PEEK_BYTES), EXPECTED_SCHEMAS)
+        except Exception as e:
+            return False, f"Header check failed: {e}"
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        checks = list(executor.map(check, pending))
+    ingest_bytes = 0
+    rejected = 0
+    for obj, (valid, message) in zip(pending, checks):
+        if valid:
+            ingest_bytes += obj.get('Size') or 0
+            print(f"ingest\t{obj.get('Size')}\t{obj['Key']}")
+        else:
+            rejected += 1
+            print(f"reject\t{obj.get('Size')}\t{obj['Key']}\t{message.splitlines()[0]}")
+    print(
+        f"{len(pending) - rejected} to ingest ({ingest_bytes / 1e6:.1f} MB), {rejected} rejected, "
+        f"{len(listed) - len(pending)} unchanged",
+        file=sys.stderr,
+    )
+    return 0
+
+def parse_workers(value: str) -> Optional[int]:
+    # 'auto' is PARSE_WORKERS=None: one process per core
+    return None if value == 'auto' else int(value)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--bucket', default=S3_BUCKET)
+    common.add_argument('--prefix', default=S3_RAW_PREFIX)
+    common.add_argument('--sub-prefixes', nargs='+', default=None, help="list '<prefix><sub>' in parallel, e.g. AB CD EF")
+    common.add_argument('--workers', type=int, default=MAX_WORKERS, help='concurrent files (plan: header checks)')
+    common.add_argument('--manifest-uri', default=MANIFEST_URI,
+                        help='skip objects this ingestion manifest marks done (e.g. a local SQLite file)')
+
+    loading = argparse.ArgumentParser(add_help=False)
+    loading.add_argument('--chunksize', type=int, default=CHUNK_SIZE, help='stream files in row chunks')
+    loading.add_argument('--coalesce', action=argparse.BooleanOptionalAction, default=COALESCE_LOADS,
+                         help='batch small files per staging table')
+    loading.add_argument('--merge', action=argparse.BooleanOptionalAction, default=MERGE_AFTER_LOAD,
+                         help='merge each stg_<code> into prod as soon as its files are loaded')
+    loading.add_argument('--merge-workers', type=int, default=MERGE_WORKERS, help='prod merges in parallel')
+    loading.add_argument('--low-memory', action=argparse.BooleanOptionalAction, default=LOW_MEMORY,
+                         help='clean with one combined row mask and downcast columns in place')
+    loading.add_argument('--quarantine', action=argparse.BooleanOptionalAction, default=QUARANTINE_REJECTS,
+                         help='load rows failing the data-quality rules into quarantine_<prefix> instead of dropping them')
+    loading.add_argument('--parse-workers', type=parse_workers, default=PARSE_WORKERS,
+                         help='processes parsing and cleaning whole files behind the download threads '
+                              '(0: in the threads, auto: one per core)')
+    loading.add_argument('--metrics-json', default=METRICS_JSON_PATH, help='write run metrics as JSON here')
+    loading.add_argument('--metrics-prom', default=METRICS_PROM_PATH,
+                         help='write run metrics in the Prometheus text format here')
+    loading.add_argument('--profile-dir', default=PROFILE_DIR,
+                         help='profile every file into this directory (forces --workers 1)')
+    loading.add_argument('--profile-top', type=int, default=PROFILE_TOP_N, help='slowest files to keep profiles of')
+
+    run_parser = commands.add_parser('run', parents=[common, loading], help='ingest new objects (default)')
+    run_parser.add_argument('--work-queue-uri', default=WORK_QUEUE_URI,
+                            help='share ingestion with other nodes through leases in this database (e.g. DB_URI)')
+    run_parser.add_argument('--enqueue', action=argparse.BooleanOptionalAction, default=True,
+                            help='with --work-queue-uri: list and queue new objects before claiming')
+    run_parser.set_defaults(func=run)
+
+    watch_parser = commands.add_parser('watch', parents=[common, loading],
+                                       help='keep ingesting new objects in micro-batches until stopped')
+    watch_parser.add_argument('--interval', type=float, default=WATCH_INTERVAL, help='seconds between listings')
+    watch_parser.add_argument('--batch-files', type=int, default=WATCH_BATCH_FILES, help='files per micro-batch')
+    watch_parser.add_argument('--batch-bytes', type=int, default=WATCH_BATCH_BYTES, help='bytes per micro-batch')
+    watch_parser.add_argument('--batch-window', type=float, default=WATCH_BATCH_WINDOW,
+                              help='seconds a micro-batch waits for more files')
+    watch_parser.set_defaults(func=watch)
+
+    plan_parser = commands.add_parser('plan', parents=[common], help='dry run: list and header-check only')
+    plan_parser.add_argument('--prevalidate', action=argparse.BooleanOptionalAction, default=True,
+                             help='ranged-GET header check of every object')
+    plan_parser.set_defaults(func=plan)
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in ('run', 'watch', 'plan', '-h', '--help'):
+        argv = ['run', *argv]  # Bare 'main.py' (e.g. from cron) keeps meaning a full run
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'work_queue_uri', None) and args.merge:
+        # A node's scheduler only sees its own files, so its watermark could pass rows
+        # stamped earlier that other nodes have yet to commit
+        parser.error('--merge cannot be combined with --work-queue-uri; merge once every node has finished')
+    if getattr(args, 'work_queue_uri', None) and args.coalesce:
+        # A coalesced batch mixes rows of several leases and commits outside their completion
+        parser.error('--coalesce cannot be combined with --work-queue-uri')
+    setup_logging()
+    try:
+        return args.func(args)
     except Exception as e:
-        logger.error(f"ETL pipeline failed: {e}")
+        logger.error(f"ETL pipeline {args.command} failed: {e}")
+        return 1
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import argparse
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterator, Optional, Tuple
+import pandas as pd
+from .config import CACHE_DIR, CACHE_MAX_BYTES
+from .extract import HAS_PYARROW
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_KEY = b'etl.key'
+_ETAG = b'etl.etag'
+
+
+class BatchCache:
+    """
+    On-disk Parquet cache of cleaned frames keyed by S3 key + ETag and the cleaning
+    variant (e.g. low-memory or quarantining against a rule set), so reruns and
+    backfills of unchanged objects skip the download, parse, validation and cleaning.
+    Frames are stored without processing_ts, which is stamped fresh on every read.
+    The least recently used files are evicted once the cache exceeds max_bytes.
+    Requires pyarrow (the 'arrow' extra).
+    """
+
+    def __init__(self, directory: str, max_bytes: int = CACHE_MAX_BYTES):
+        if not HAS_PYARROW:
+            raise ImportError("BatchCache requires pyarrow; install the 'arrow' extra")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        files = [e for e in os.scandir(directory) if e.name.endswith('.parquet')]
+        # Least recently used first; reads bump the file's mtime
+        self._sizes: 'OrderedDict[str, int]' = OrderedDict(
+            (e.name, e.stat().st_size) for e in sorted(files, key=lambda e: e.stat().st_mtime)
+        )
+        self._total = sum(self._sizes.values())
+
+    @staticmethod
+    def _name(key: str, etag: str, variant: str = '') -> str:
+        name = f"{key}\0{etag}\0{variant}" if variant else f"{key}\0{etag}"
+        return hashlib.sha256(name.encode()).hexdigest()[:32] + '.parquet'
+
+    def get(self, key: str, etag: str, variant: str = '') -> Optional[pd.DataFrame]:
+        """
+        The cached frame for this version of key cleaned the variant way (memory-mapped),
+        or None.
+        """
+        import pyarrow.parquet as pq
+
+        name = self._name(key, etag, variant)
+        with self._lock:
+            if name not in self._sizes:
+                return None
+            self._sizes.move_to_end(name)
+        path = os.path.join(self.directory, name)
+        try:
+            with metrics.stage('cache_read') as read:
+                df = pq.read_table(path, memory_map=True).to_pandas()
+                read['rows'], read['bytes'] = len(df), self._sizes.get(name, 0)
+            os.utime(path)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache entry for {key}: {e}")
+            self._discard(name)
+            return None
+        return df
+
+    def put(self, key: str, etag: str, df: pd.DataFrame, variant: str = '') -> None:
+        """
+        Cache a cleaned frame; failures are logged and never fail the file.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        name = self._name(key, etag, variant)
+        path = os.path.join(self.directory, name)
+        try:
+            with metrics.stage('cache_write') as written:
+                table = pa.Table.from_pandas(df.drop(columns='processing_ts', errors='ignore'), preserve_index=False)
+                table = table.replace_schema_metadata({**(table.schema.metadata or {}), _KEY: key, _ETAG: etag})
+                tmp_path = f"{path}.tmp"
+                pq.write_table(table, tmp_path)
+                os.replace(tmp_path, path)
+                written['rows'], written['bytes'] = len(df), os.path.getsize(path)
+        except Exception as e:
+            logger.warning(f"Could not cache {key}: {e}")
+            return
+        with self._lock:
+            self._total += written['bytes'] - self._sizes.pop(name, 0)
+            self._sizes[name] = written['bytes']
+            evicted = []
+            while self._total > self.max_bytes and len(self._sizes) > 1:
+                oldest, size = self._sizes.popitem(last=False)
+                self._total -= size
+                evicted.append(oldest)
+        for oldest in evicted:
+            self._remove(oldest)
+
+    def entries(self) -> Iterator[Tuple[str, pd.DataFrame]]:
+        """
+        Yield (S3 key, frame) for every cached object, least recently used first. Only
+        the most recently used frame of each key is yielded (older versions or other
+        cleaning variants would load its rows twice).
+        """
+        import pyarrow.parquet as pq
+
+        with self._lock:
+            names = list(self._sizes)
+        latest: Dict[str, str] = {}
+        for name in names:
+            try:
+                metadata = pq.read_schema(os.path.join(self.directory, name)).metadata or {}
+            except Exception:
+                metadata = {}
+            latest[metadata.get(_KEY, name.encode()).decode()] = name
+        keep = set(latest.values())
+        for name in names:
+            if name not in keep:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                table = pq.read_table(path, memory_map=True)
+            except Exception as e:
+                logger.warning(f"Skipping unreadable cache entry {name}: {e}")
+                continue
+            yield table.schema.metadata.get(_KEY, b'').decode(), table.to_pandas()
+
+    def _discard(self, name: str) -> None:
+        with self._lock:
+            self._total -= self._sizes.pop(name, 0)
+        self._remove(name)
+
+    def _remove(self, name: str) -> None:
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Maintain the local Parquet batch cache.')
+    parser.add_argument('command', choices=['rebuild'], help='rebuild: load every cached batch into staging')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, required=CACHE_DIR is None)
+    parser.add_argument('--db-uri', default=None, help='defaults to DB_URI')
+    parser.add_argument('--replace', action='store_true', help='drop each staging table before reloading it')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    from .clean_and_load import rebuild_staging_from_cache
+    from .db import create_pipeline_engine
+
+    engine = create_pipeline_engine(args.db_uri) if args.db_uri else create_pipeline_engine()
+    try:
+        tables = rebuild_staging_from_cache(BatchCache(args.cache_dir), engine=engine, replace=args.replace)
+    finally:
+        engine.dispose()
+    for table_name, rows in sorted(tables.items()):
+        logger.info(f"Rebuilt {table_name}: {rows} rows")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,61 +1,777 @@
+import csv
+import dataclasses
+import io
+import itertools
+import threading
+import numpy as np
 import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from dataclasses import dataclass, field
 from datetime import datetime
-from sqlalchemy import create_engine
-from .config import EXPECTED_SCHEMAS, DB_URI
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Float, MetaData, Table, Text, create_engine, inspect, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateTable
+from .config import (
+    EXPECTED_SCHEMAS, TYPED_SCHEMAS, DB_URI, DB_POOL_SIZE, MAX_WORKERS, PARSE_WORKERS, CHUNK_SIZE, DEDUPE_ACROSS_CHUNKS,
+    INSERT_BATCH_SIZE, COALESCE_LOADS, COALESCE_MAX_ROWS, PREVALIDATE_MIN_BYTES, HEADER_PEEK_BYTES,
+    LOW_MEMORY, CATEGORY_MAX_RATIO, ADAPTIVE_CONCURRENCY, QUARANTINE_REJECTS,
+)
+from .cache import BatchCache
+from .db import create_pipeline_engine
+from .dedupe import DedupeIndex
+from .manifest import IngestionManifest
+from .retry import AdaptiveLimiter, RetryPolicy, call_with_retry
+from .rules import REASONS_COLUMN, quarantine_table, rules_digest, schema_prefix, split_rejects
+from .scheduler import MergeScheduler
+from .work_queue import WorkQueue
+from . import metrics
 import logging
 from .extract import *
-from typing import Any
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 logger = logging.getLogger(__name__)
 
-def cleaning_data(df: pd.DataFrame) -> pd.DataFrame:
+_created_tables: Set[Tuple[str, str]] = set()  # (database URL, table) created by create_table_if_missing
+
+def cleaning_data(df: pd.DataFrame, processing_ts: Optional[datetime] = None) -> pd.DataFrame:
     """
     Remove duplicates, drop rows with any nulls, and add processing timestamp.
+    Pass processing_ts to stamp several chunks of one file with the same value.
     """
     df = df.drop_duplicates()
     df = df.dropna()
-    df['processing_ts'] = datetime.now()
+    df['processing_ts'] = processing_ts or datetime.now()
+    return df
+
+def downcast_frame(df: pd.DataFrame, category_max_ratio: float = CATEGORY_MAX_RATIO) -> pd.DataFrame:
+    """
+    Shrink df in place, column by column: float64 columns become float32 when every
+    value survives the round trip unchanged, and string columns with at most
+    category_max_ratio distinct values per row become categoricals. Staging loads
+    widen the floats back, so staging columns stay double precision.
+    """
+    for name in df.columns:
+        column = df[name]
+        if column.dtype == np.float64:
+            values = column.to_numpy()
+            narrow = values.astype(np.float32)
+            if np.array_equal(narrow, values, equal_nan=True):
+                df[name] = narrow
+        elif (column.dtype == object or isinstance(column.dtype, pd.StringDtype)) and len(column):
+            if column.nunique() <= category_max_ratio * len(column):
+                df[name] = column.astype('category')
     return df
 
-def load_to_postgres(df: pd.DataFrame, table_name: str) -> None:
+def clean_low_memory(df: pd.DataFrame, processing_ts: Optional[datetime] = None) -> pd.DataFrame:
+    """
+    Low-memory equivalent of drop_invalid_production_codes followed by cleaning_data:
+    the frame is downcast in place, then one boolean mask of valid Production Codes,
+    complete rows and first occurrences selects the kept rows with a single take.
+    Returns df itself, stamped in place, when every row is kept.
+    """
+    if "Production Code" not in df.columns:
+        raise ValueError("Missing required column: 'Production Code'")
+    downcast_frame(df)
+    mask = valid_production_code_mask(df["Production Code"])
+    mask &= df.notna().all(axis=1).to_numpy()
+    mask &= ~df.duplicated().to_numpy()
+    if not mask.all():
+        df = df.take(np.flatnonzero(mask))
+    df['processing_ts'] = processing_ts or datetime.now()
+    return df
+
+def clean_with_rules(
+    df: pd.DataFrame, key: str, processing_ts: Optional[datetime] = None, low_memory: bool = LOW_MEMORY
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Quarantining alternative to drop_invalid_production_codes and cleaning_data: df
+    is checked against the rules of its schema (src.rules.RULES) in one pass and
+    split into the kept rows and the rejected rows with their reason codes and
+    source key. Both are stamped with processing_ts. With low_memory df is first
+    downcast in place.
+    """
+    if low_memory:
+        downcast_frame(df)
+    df_clean, rejected = split_rejects(df)
+    processing_ts = processing_ts or datetime.now()
+    df_clean['processing_ts'] = processing_ts
+    rejected['source_key'] = key
+    rejected['processing_ts'] = processing_ts
+    return df_clean, rejected
+
+def copy_insert(table: Any, conn: Any, keys: List[str], data_iter: Iterable) -> int:
+    """
+    pandas to_sql method that streams rows through psycopg2 COPY FROM STDIN using
+    an in-memory CSV buffer instead of issuing INSERT statements.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(data_iter)
+    buffer.seek(0)
+    columns = ', '.join(f'"{k}"' for k in keys)
+    table_name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+    dbapi_conn = conn.connection
+    with dbapi_conn.cursor() as cur:
+        cur.copy_expert(f'COPY {table_name} ({columns}) FROM STDIN WITH CSV', buffer)
+        return cur.rowcount
+
+
+def load_to_postgres(df: pd.DataFrame, table_name: str, engine: Any = None) -> None:
     """
-    Load DataFrame to Postgres table.
+    Load DataFrame to Postgres table through engine, a pooled Engine or an open
+    Connection; defaults to a new engine. Uses COPY FROM STDIN on Postgres and
+    INSERT_BATCH_SIZE-row executemany batches elsewhere (see benchmarks/bench_load.py).
     """
+    # float32 columns (see downcast_frame) would create REAL columns that round every later value
+    narrow = {name: np.float64 for name, dtype in df.dtypes.items() if dtype == np.float32}
+    if narrow:
+        df = df.astype(narrow)
     try:
-        engine = create_engine(DB_URI)
-        df.to_sql(table_name, engine, if_exists='append', index=False)
+        if engine is None:
+            engine = create_engine(DB_URI)
+        create_table_if_missing(df, table_name, engine)
+        _append(df, table_name, engine)
     except Exception as e:
         logger.error(f"Error loading data to Postgres: {e}")
         raise
 
-def process_file(s3_client: Any, bucket_name: str, prefix: str) -> None:
+
+def _sql_type(dtype: Any) -> Any:
+    # The types pandas' to_sql would pick
+    if pd.api.types.is_bool_dtype(dtype):
+        return Boolean()
+    if pd.api.types.is_integer_dtype(dtype):
+        return BigInteger()
+    if pd.api.types.is_float_dtype(dtype):
+        return Float(precision=53)
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return DateTime()
+    return Text()
+
+
+def staging_table(df: pd.DataFrame, table_name: str) -> Table:
+    """
+    The table df is loaded into: stg_<code> columns take their TYPED_SCHEMAS type, so
+    the table does not depend on the values of the first file loaded; other columns
+    (and tables) take the type of their dtype.
+    """
+    prefix = table_name[len('stg_'):len('stg_') + 2] if table_name.startswith('stg_') else None
+    typed = {name: dtype for name, dtype, _ in TYPED_SCHEMAS.get(prefix, [])}
+    return Table(table_name, MetaData(), *(
+        Column(name, _sql_type(typed.get(name, dtype))) for name, dtype in df.dtypes.items()
+    ))
+
+
+def create_table_if_missing(df: pd.DataFrame, table_name: str, engine: Any) -> None:
+    """
+    CREATE TABLE IF NOT EXISTS the staging_table of df, committed on its own so that
+    concurrent loads (in other transactions or on other nodes) find it, whether or
+    not the caller's transaction commits. On SQLite, whose writers share one lock, a
+    Connection's own transaction runs it instead.
+    """
+    ddl = CreateTable(staging_table(df, table_name), if_not_exists=True)
+    if isinstance(engine, Connection) and engine.dialect.name == 'sqlite':
+        engine.execute(ddl)
+        return
+    engine = getattr(engine, 'engine', engine)
+    key = (str(engine.url), table_name)
+    if key in _created_tables:
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(ddl)
+    except DBAPIError:
+        # Postgres fails a CREATE racing another one that commits first
+        if not inspect(engine).has_table(table_name):
+            raise
+    _created_tables.add(key)
+
+
+def _append(df: pd.DataFrame, table_name: str, engine: Any) -> None:
+    if engine.dialect.name == 'postgresql':
+        df.to_sql(table_name, engine, if_exists='append', index=False, method=copy_insert)
+    else:
+        df.to_sql(table_name, engine, if_exists='append', index=False, chunksize=INSERT_BATCH_SIZE)
+
+
+class StagingBuffer:
     """
-    Process all CSV files from S3 and load valid data to Postgres.
+    Coalesces cleaned frames of many small files per stg_<code> table and loads each
+    table's batch in one transaction, retried whole, once it reaches max_rows or on
+    flush. A file's result stays 'buffered', and its dedupe fingerprints reserved,
+    until every batch it was routed to has committed.
     """
-    for item in list_s3_files(s3_client=s3_client, bucket_name=bucket_name, prefix=prefix):
+
+    def __init__(
+        self,
+        engine: Any,
+        max_rows: int = COALESCE_MAX_ROWS,
+        on_loaded: Optional[Callable[[Dict[str, Any]], None]] = None,
+        dedupe_index: Optional[DedupeIndex] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        limiter: Optional[AdaptiveLimiter] = None,
+    ):
+        self.engine = engine
+        self.max_rows = max_rows
+        self.on_loaded = on_loaded
+        self.dedupe_index = dedupe_index
+        self.retry_policy = retry_policy
+        self.limiter = limiter
+        self._lock = threading.Lock()
+        self._pending: Dict[str, List[Any]] = defaultdict(list)
+        self._rows: Dict[str, int] = defaultdict(int)
+        self._outstanding: Dict[int, int] = defaultdict(int)
+
+    def add(
+        self, groups: List[Tuple[str, pd.DataFrame]], result: Dict[str, Any],
+        fingerprints: Optional[List[Optional[np.ndarray]]] = None,
+    ) -> None:
+        """
+        Buffer the (table_name, frame) groups of one file, with the fingerprints
+        dedupe_index.drop_seen() returned for each frame.
+        """
+        result['status'] = 'buffered'
+        full = []
+        with self._lock:
+            self._outstanding[id(result)] += len(groups)
+            for (table_name, df), reserved in zip(groups, fingerprints or [None] * len(groups)):
+                self._pending[table_name].append((df, result, reserved))
+                self._rows[table_name] += len(df)
+                if self._rows[table_name] >= self.max_rows:
+                    full.append((table_name, self._take(table_name)))
+        for table_name, batch in full:
+            self._load(table_name, batch)
+
+    def flush(self) -> None:
+        with self._lock:
+            batches = {table: self._take(table) for table in list(self._pending)}
+        for table_name, batch in batches.items():
+            self._load(table_name, batch)
+
+    def _take(self, table_name: str) -> List[Any]:
+        self._rows.pop(table_name, None)
+        return self._pending.pop(table_name, [])
+
+    def _load(self, table_name: str, batch: List[Any]) -> None:
+        def load_batch() -> None:
+            with self.engine.begin() as conn:
+                load_to_postgres(df, table_name, engine=conn)
+
         try:
-            df = read_csv_file(s3_client, bucket_name, item)
-            valid, res = validate_csv_schema_by_production_code(df, EXPECTED_SCHEMAS)
-            if valid:
-                if isinstance(res, pd.DataFrame):
-                    df = res  # Use standardized header if returned
-                try:
-                    df_clean = drop_invalid_production_codes(df=df)
-                except Exception as e:
-                    logger.error(f"Error while dropping invalid production code: {e}")
-                    continue
-                if df_clean is None or df_clean.empty:
-                    logger.info(f"No valid records found in the dataframe: {item}")
+            with metrics.stage('load', table=table_name) as loaded:
+                df = pd.concat([df for df, _, _ in batch], ignore_index=True)
+                call_with_retry(load_batch, 'load', self.retry_policy, self.limiter)
+                loaded['rows'] = len(df)
+        except Exception as e:
+            logger.error(f"Error while loading data in postgres: {e}")
+            for _, result, reserved in batch:
+                result.update(status='failed', error=str(e))
+                if reserved is not None:
+                    self.dedupe_index.release(reserved)
+        else:
+            logger.info(f"Data ingested successfully {table_name} ({len(batch)} files)")
+            for _, _, reserved in batch:
+                if reserved is not None:
+                    self.dedupe_index.add(reserved)
+        for _, result, _ in batch:
+            with self._lock:
+                self._outstanding[id(result)] -= 1
+                done = self._outstanding[id(result)] == 0
+                if done:
+                    del self._outstanding[id(result)]
+            if done:
+                if result['status'] == 'buffered':
+                    result['status'] = 'loaded'
+                if self.on_loaded is not None:
+                    self.on_loaded(result)
+
+
+@dataclass
+class RunContext:
+    """
+    Options and shared state for one ingestion run. process_file works on a copy and
+    fills in the engine (when unset), staging buffer and concurrency limiters.
+    """
+    engine: Any = None
+    max_workers: int = MAX_WORKERS  # Files processed concurrently
+    parse_workers: Optional[int] = PARSE_WORKERS  # Parse processes (see src.staged); None: one per core, 0: none
+    chunksize: Optional[int] = CHUNK_SIZE  # Stream each file in chunks of this many rows
+    coalesce: bool = COALESCE_LOADS  # Load small files for the same staging table together
+    adaptive_concurrency: bool = ADAPTIVE_CONCURRENCY  # AIMD limits on in-flight S3 reads and staging loads
+    low_memory: bool = LOW_MEMORY
+    quarantine: bool = QUARANTINE_REJECTS  # Keep rows failing src.rules.RULES in quarantine_<prefix>
+    prevalidate_min_bytes: Optional[int] = PREVALIDATE_MIN_BYTES
+    retry_policy: Optional[RetryPolicy] = None
+    manifest: Optional[IngestionManifest] = None
+    run_metrics: Optional[metrics.RunMetrics] = None
+    profiler: Optional[metrics.FileProfiler] = None  # Use with max_workers=1
+    dedupe_index: Optional[DedupeIndex] = None
+    batch_cache: Optional[BatchCache] = None
+    scheduler: Optional[MergeScheduler] = None  # Call scheduler.wait() after process_file
+    work_queue: Optional[WorkQueue] = None
+    staging_buffer: Optional[StagingBuffer] = None
+    s3_limiter: Optional[AdaptiveLimiter] = None
+    db_limiter: Optional[AdaptiveLimiter] = None
+    leases_completed: Set[str] = field(default_factory=set)  # Keys whose lease the load transaction completed
+
+
+def _file_result(key: str, status: str, tables: Optional[Dict[str, int]] = None, rows: int = 0,
+                 error: Optional[str] = None) -> Dict[str, Any]:
+    return {'key': key, 'status': status, 'tables': tables or {}, 'rows': rows, 'error': error, 'quarantined': 0}
+
+
+def route_by_production_code(df: pd.DataFrame) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """
+    Split a cleaned frame into one ('stg_<code>', rows) pair per Production Code in a
+    single groupby pass; a file with one code yields the frame itself without copying.
+    """
+    codes = df["Production Code"]
+    if isinstance(codes.dtype, pd.CategoricalDtype):
+        present = codes.cat.remove_unused_categories().cat.categories
+        single = len(present) == 1
+    else:
+        single = codes.nunique(dropna=False) == 1
+    if single:
+        yield f"stg_{codes.iloc[0]}", df
+        return
+    for code, group in df.groupby("Production Code", observed=True, sort=False):
+        yield f"stg_{code}", group
+
+
+def _load_routed(
+    df: pd.DataFrame, result: Dict[str, Any], ctx: 'RunContext', unindexed: Optional[List[Any]] = None
+) -> None:
+    """
+    Route df by Production Code and load (or buffer) each group, recording the rows
+    written per staging table on result. With ctx.dedupe_index, rows already loaded
+    by earlier files or runs (or in flight in other files) are dropped first, and the
+    rest are indexed once loaded; pass unindexed to collect their fingerprints
+    instead when ctx.engine is an open transaction that has yet to commit.
+    """
+    groups, reserved = [], []
+    for table_name, group in route_by_production_code(df):
+        fingerprints = None
+        if ctx.dedupe_index is not None:
+            with metrics.stage('dedupe', table=table_name) as deduped:
+                deduped['rows'] = len(group)
+                group, fingerprints = ctx.dedupe_index.drop_seen(group, table_name)
+            if group.empty:
+                continue
+        if ctx.staging_buffer is None:
+            try:
+                with metrics.stage('load', table=table_name) as loaded:
+                    call_with_retry(lambda: load_to_postgres(group, table_name, engine=ctx.engine),
+                                    'load', ctx.retry_policy, ctx.db_limiter)
+                    loaded['rows'] = len(group)
+            except Exception:
+                if fingerprints is not None:
+                    ctx.dedupe_index.release(fingerprints)
+                raise
+            if fingerprints is not None and unindexed is not None:
+                unindexed.append(fingerprints)
+            elif fingerprints is not None:
+                ctx.dedupe_index.add(fingerprints)
+        groups.append((table_name, group))
+        reserved.append(fingerprints)
+        result['tables'][table_name] = result['tables'].get(table_name, 0) + len(group)
+        result['rows'] += len(group)
+    if ctx.staging_buffer is not None and groups:
+        ctx.staging_buffer.add(groups, result, reserved)
+
+
+def _quarantine(rejected: pd.DataFrame, result: Dict[str, Any], ctx: 'RunContext') -> None:
+    """
+    Bulk-load rows rejected by clean_with_rules into quarantine_<prefix>, counting
+    them on result.
+    """
+    if rejected.empty:
+        return
+    columns = [name for name in rejected.columns if name not in (REASONS_COLUMN, 'source_key', 'processing_ts')]
+    table_name = quarantine_table(schema_prefix(columns))
+    with metrics.stage('quarantine', table=table_name) as quarantined:
+        call_with_retry(lambda: load_to_postgres(rejected, table_name, engine=ctx.engine),
+                        'load', ctx.retry_policy, ctx.db_limiter)
+        quarantined['rows'] = len(rejected)
+    result['quarantined'] += len(rejected)
+
+
+def _drop_seen_rows(df: pd.DataFrame, columns: List[str], seen: set) -> pd.DataFrame:
+    """
+    Drop rows whose hash over columns is already in seen, then record the rest.
+    """
+    hashes = pd.util.hash_pandas_object(df[columns], index=False)
+    keep = ~hashes.isin(seen).to_numpy()
+    seen.update(hashes[keep].tolist())
+    return df[keep]
+
+
+def process_file_chunked(
+    s3_client: Any,
+    bucket_name: str,
+    item: str,
+    chunksize: int,
+    ctx: Optional[RunContext] = None,
+    dedupe_across_chunks: bool = DEDUPE_ACROSS_CHUNKS,
+) -> Dict[str, Any]:
+    """
+    Streaming variant of process_single_file for files larger than memory: the schema
+    is checked on the first chunk, then each chunk is cleaned and loaded as it is read,
+    under one processing_ts and never coalesced. Duplicates are dropped within each
+    chunk, or across the whole file with dedupe_across_chunks (one hash per row kept).
+    """
+    processing_ts = datetime.now()
+    seen: set = set()
+    headers = None
+    result = _file_result(item, 'loaded')
+    ctx = dataclasses.replace(ctx or RunContext(), staging_buffer=None)
+
+    def open_chunks() -> Iterator[pd.DataFrame]:
+        chunks = read_csv_chunks(s3_client, bucket_name, item, chunksize)
+        first = next(chunks, None)
+        return chunks if first is None else itertools.chain([first], chunks)
+
+    try:
+        chunks = call_with_retry(open_chunks, 's3', ctx.retry_policy, ctx.s3_limiter)
+        for chunk in chunks:
+            if headers is None:
+                with metrics.stage('validate') as validated:
+                    valid, res = validate_csv_schema_by_production_code(chunk, EXPECTED_SCHEMAS)
+                    validated['rows'] = len(chunk)
+                if not valid:
+                    logger.warning(f"Schema validation failed for {item}: {res}")
+                    return _file_result(item, 'schema_invalid', error=str(res))
+                headers = list(chunk.columns)
+            else:
+                chunk.columns = headers
+            chunk = coerce_numeric_columns(chunk, item)  # Aliased headers were skipped at read time
+            if ctx.quarantine:
+                with metrics.stage('rules') as checked:
+                    checked['rows'] = len(chunk)
+                    df_clean, rejected = clean_with_rules(chunk, item, processing_ts, ctx.low_memory)
+                _quarantine(rejected, result, ctx)
+            elif ctx.low_memory:
+                with metrics.stage('clean') as cleaned:
+                    cleaned['rows'] = len(chunk)
+                    df_clean = clean_low_memory(chunk, processing_ts=processing_ts)
+            else:
+                with metrics.stage('drop_invalid') as checked:
+                    df_clean = drop_invalid_production_codes(df=chunk)
+                    checked['rows'] = len(chunk)
+                if df_clean.empty:
                     continue
+                with metrics.stage('clean') as cleaned:
+                    cleaned['rows'] = len(df_clean)
+                    df_clean = cleaning_data(df_clean, processing_ts=processing_ts)
+            if dedupe_across_chunks and not df_clean.empty:
+                df_clean = _drop_seen_rows(df_clean, headers, seen)
+            if df_clean.empty:
+                continue
+            _load_routed(df_clean, result, ctx)
+    except Exception as e:
+        logger.error(f"Failed to process file {item}: {e}")
+        result.update(status='failed', error=str(e))
+        return result
+    if not result['tables']:
+        logger.info(f"No valid records found in the dataframe: {item}")
+        result.update(status='empty')
+        return result
+    logger.info(f"Data ingested successfully {', '.join(result['tables'])}")
+    return result
+
+
+def validate_and_clean(
+    df: pd.DataFrame, item: str, low_memory: bool = LOW_MEMORY, quarantine: bool = QUARANTINE_REJECTS
+) -> Tuple[Optional[Dict[str, Any]], Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+    """
+    The validate -> drop_invalid -> clean stages of process_single_file on a parsed
+    file (cleaned by clean_low_memory or clean_with_rules as low_memory/quarantine
+    say). Returns (final, df_clean, rejected): final is the file's result when it
+    ends here (schema_invalid, failed or empty), otherwise None; rejected holds the
+    rows to quarantine, or is None without quarantine.
+    """
+    with metrics.stage('validate') as validated:
+        valid, res = validate_csv_schema_by_production_code(df, EXPECTED_SCHEMAS)
+        validated['rows'] = len(df)
+    if not valid:
+        logger.warning(f"Schema validation failed for {item}: {res}")
+        return _file_result(item, 'schema_invalid', error=str(res)), None, None
+    if isinstance(res, pd.DataFrame):
+        df = coerce_numeric_columns(res, item)  # Use standardized header if returned; coerce what it renamed
+    if quarantine:
+        with metrics.stage('rules') as checked:
+            checked['rows'] = len(df)
+            df_clean, rejected = clean_with_rules(df, item, low_memory=low_memory)
+        return None, df_clean, rejected  # Rejects are quarantined even when no row is kept
+    if low_memory:
+        with metrics.stage('clean') as cleaned:
+            cleaned['rows'] = len(df)
+            df_clean = clean_low_memory(df)
+    else:
+        try:
+            with metrics.stage('drop_invalid') as checked:
+                df_clean = drop_invalid_production_codes(df=df)
+                checked['rows'] = len(df)
+        except Exception as e:
+            logger.error(f"Error while dropping invalid production code: {e}")
+            return _file_result(item, 'failed', error=str(e)), None, None
+        if df_clean is not None and not df_clean.empty:
+            with metrics.stage('clean') as cleaned:
+                cleaned['rows'] = len(df_clean)
                 df_clean = cleaning_data(df_clean)
-                table_name = df_clean["Production Code"].iloc[0]
-                table_name = f"stg_{table_name}"
-                try:
-                    load_to_postgres(df_clean, table_name)
-                    logger.info(f"Data ingested successfully {table_name}")
-                except Exception as e:
-                    logger.error(f"Error while loading data in postgres: {e}")
-            else:
-                logger.warning(f"Schema validation failed for {item}: {res}")
+    if df_clean is None or df_clean.empty:
+        logger.info(f"No valid records found in the dataframe: {item}")
+        return _file_result(item, 'empty'), None, None
+    return None, df_clean, None
+
+
+def _cache_variant(ctx: RunContext) -> str:
+    # Frames cleaned another way (or checked against other rules) are cached apart
+    variant = 'low_memory' if ctx.low_memory else ''
+    return f"{variant};rules={rules_digest()}" if ctx.quarantine else variant
+
+
+def _needs_prevalidation(size: Optional[int], ctx: RunContext) -> bool:
+    if ctx.prevalidate_min_bytes is None or size is None:
+        return False
+    return size >= ctx.prevalidate_min_bytes
+
+
+def process_single_file(
+    s3_client: Any,
+    bucket_name: str,
+    item: str,
+    ctx: Optional[RunContext] = None,
+    size: Optional[int] = None,
+    etag: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Run the read -> validate -> clean -> load chain for one S3 key under ctx. Objects
+    of at least ctx.prevalidate_min_bytes get a ranged header check first, and a
+    cached cleaned frame for etag replaces the whole chain.
+    Never raises: failures are logged and reported in the returned result.
+    """
+    ctx = ctx or RunContext()
+    use_cache = ctx.batch_cache is not None and etag is not None and not ctx.chunksize
+    if use_cache:
+        cached = ctx.batch_cache.get(item, etag, _cache_variant(ctx))
+        if cached is not None:
+            cached['processing_ts'] = datetime.now()
+            return _load_clean(item, cached, ctx)
+    if _needs_prevalidation(size, ctx):
+        try:
+            valid, res = call_with_retry(
+                lambda: prevalidate_csv_schema(s3_client, bucket_name, item, EXPECTED_SCHEMAS, HEADER_PEEK_BYTES),
+                's3', ctx.retry_policy, ctx.s3_limiter)
         except Exception as e:
-            logger.error(f"Failed to process file {item}: {e}")
\ No newline at end of file
+            logger.error(f"Failed to process file {item}: {e}")
+            return _file_result(item, 'failed', error=str(e))
+        if not valid:
+            logger.warning(f"Schema validation failed for {item}: {res}")
+            return _file_result(item, 'schema_invalid', error=str(res))
+    if ctx.chunksize:
+        return process_file_chunked(s3_client, bucket_name, item, ctx.chunksize, ctx=ctx)
+    try:
+        df = call_with_retry(lambda: read_csv_file(s3_client, bucket_name, item),
+                             's3', ctx.retry_policy, ctx.s3_limiter)
+        final, df_clean, rejected = validate_and_clean(df, item, ctx.low_memory, ctx.quarantine)
+        del df
+        if final is not None:
+            return final
+        result = _load_clean(item, df_clean, ctx, rejected)
+        # Only once the rejects are stored: a cached frame holds the kept rows alone
+        if use_cache and result['status'] != 'failed' and not df_clean.empty:
+            ctx.batch_cache.put(item, etag, df_clean, _cache_variant(ctx))
+        return result
+    except Exception as e:
+        logger.error(f"Failed to process file {item}: {e}")
+        return _file_result(item, 'failed', error=str(e))
+
+
+def _load_clean(
+    item: str, df_clean: pd.DataFrame, ctx: RunContext, rejected: Optional[pd.DataFrame] = None
+) -> Dict[str, Any]:
+    result = _file_result(item, 'loaded')
+    try:
+        if ctx.work_queue is not None and ctx.staging_buffer is None and ctx.work_queue.shares_database(ctx.engine):
+            _load_leased(df_clean, result, ctx, rejected)
+        else:
+            if rejected is not None:
+                _quarantine(rejected, result, ctx)
+            if not df_clean.empty:
+                _load_routed(df_clean, result, ctx)
+    except Exception as e:
+        logger.error(f"Error while loading data in postgres: {e}")
+        result.update(status='failed', error=str(e))
+        return result
+    if df_clean.empty:
+        logger.info(f"No valid records found in the dataframe: {item}")
+        result.update(status='empty')
+    elif ctx.staging_buffer is None:
+        logger.info(f"Data ingested successfully {', '.join(result['tables'])}")
+    return result
+
+
+def _load_leased(
+    df_clean: pd.DataFrame, result: Dict[str, Any], ctx: RunContext, rejected: Optional[pd.DataFrame] = None
+) -> None:
+    """
+    Load every group of one file (and its quarantined rows) and mark its work-queue
+    key done in a single transaction, so a file whose lease was lost to another
+    worker is rolled back rather than loaded twice. Retried whole on transient errors.
+    """
+    def load_file() -> List[Any]:
+        result.update(tables={}, rows=0, quarantined=0)
+        unindexed: List[Any] = []
+        try:
+            with ctx.engine.begin() as conn:
+                in_transaction = dataclasses.replace(ctx, engine=conn, retry_policy=RetryPolicy(attempts=1),
+                                                     db_limiter=None)
+                if rejected is not None:
+                    _quarantine(rejected, result, in_transaction)
+                if not df_clean.empty:
+                    _load_routed(df_clean, result, in_transaction, unindexed)
+                ctx.work_queue.complete(dict(result, status='empty') if df_clean.empty else result, conn=conn)
+        except Exception:
+            for fingerprints in unindexed:  # Rolled back: a retry filters the rows afresh
+                ctx.dedupe_index.release(fingerprints)
+            raise
+        return unindexed
+
+    try:
+        unindexed = call_with_retry(load_file, 'load', ctx.retry_policy, ctx.db_limiter)
+    except Exception:
+        result.update(tables={}, rows=0, quarantined=0)  # Rolled back
+        raise
+    ctx.leases_completed.add(result['key'])
+    for fingerprints in unindexed:
+        ctx.dedupe_index.add(fingerprints)
+
+
+def rebuild_staging_from_cache(
+    batch_cache: BatchCache, engine: Any = None, replace: bool = False
+) -> Dict[str, int]:
+    """
+    Reload every cached batch into its stg_<code> tables without touching S3, stamping
+    one fresh processing_ts so the next incremental merge picks the rows up. With
+    replace, each staging table is dropped before its first batch is reloaded.
+    Returns the rows loaded per staging table.
+    """
+    engine = engine or create_pipeline_engine()
+    processing_ts = datetime.now()
+    tables: Dict[str, int] = {}
+    for key, df in batch_cache.entries():
+        df['processing_ts'] = processing_ts
+        for table_name, group in route_by_production_code(df):
+            if replace and table_name not in tables:
+                with engine.begin() as conn:
+                    conn.execute(text(f'drop table if exists {conn.dialect.identifier_preparer.quote(table_name)}'))
+                _created_tables.discard((str(engine.url), table_name))
+            load_to_postgres(group, table_name, engine=engine)
+            tables[table_name] = tables.get(table_name, 0) + len(group)
+        logger.info(f"Reloaded {key} from cache")
+    return tables
+
+
+def process_file(
+    s3_client: Any,
+    bucket_name: str,
+    prefix: str,
+    ctx: Optional[RunContext] = None,
+    sub_prefixes: Optional[List[str]] = None,
+    objects: Optional[Iterable[Dict[str, Any]]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Process all CSV files from S3 and load valid data to Postgres, with the options in
+    ctx. Pass objects (listing entries) to process them instead of listing prefix, or
+    sub_prefixes (e.g. S3_PREFIXES) to fan the listing out; with ctx.work_queue keys
+    are claimed from the queue instead.
+    Returns one result dict per file (key, status, tables, rows, error, quarantined).
+    """
+    ctx = dataclasses.replace(ctx or RunContext(), staging_buffer=None, leases_completed=set())
+    owns_engine = ctx.engine is None
+    if owns_engine:
+        ctx.engine = create_pipeline_engine(pool_size=max(DB_POOL_SIZE, ctx.max_workers))
+    if ctx.adaptive_concurrency and ctx.max_workers > 1:
+        ctx.s3_limiter = AdaptiveLimiter(ctx.max_workers)
+        ctx.db_limiter = AdaptiveLimiter(ctx.max_workers)
+    if ctx.coalesce and ctx.work_queue is not None:
+        logger.warning("Coalescing is off for leased work: each file commits with its lease")
+    elif ctx.coalesce:
+        ctx.staging_buffer = StagingBuffer(ctx.engine, on_loaded=lambda result: _finish(result, ctx),
+                                           dedupe_index=ctx.dedupe_index, retry_policy=ctx.retry_policy,
+                                           limiter=ctx.db_limiter)
+    if objects is None and ctx.work_queue is not None:
+        objects = ctx.work_queue.drain()
+    elif objects is None and sub_prefixes:
+        objects = list_s3_objects_by_prefixes(s3_client, bucket_name, prefix, sub_prefixes)
+    elif objects is None:
+        objects = list_s3_objects(s3_client=s3_client, bucket_name=bucket_name, prefix=prefix)
+    if ctx.manifest is not None:
+        objects = (obj for obj in objects if ctx.manifest.should_process(obj))
+    if ctx.scheduler is not None:
+        objects = ctx.scheduler.track(objects)
+    try:
+        with metrics.activate(ctx.run_metrics):
+            if ctx.parse_workers != 0 and not ctx.chunksize and ctx.profiler is None:
+                from .staged import run_staged  # src.staged imports this module
+                results = run_staged(s3_client, bucket_name, objects, ctx, ctx.max_workers, ctx.parse_workers)
+            else:
+                results = _run_files(s3_client, bucket_name, objects, ctx)
+            if ctx.staging_buffer is not None:
+                ctx.staging_buffer.flush()
+        if ctx.dedupe_index is not None:
+            ctx.dedupe_index.save()
+        if ctx.run_metrics is not None:
+            for result in results:
+                ctx.run_metrics.add_result(result)
+        return results
+    finally:
+        if owns_engine:
+            ctx.engine.dispose()
+
+
+def _process_and_record(
+    s3_client: Any, bucket_name: str, obj: Dict[str, Any], ctx: RunContext
+) -> Dict[str, Any]:
+    with metrics.current_file(obj['Key']):
+        if ctx.profiler is not None:
+            with ctx.profiler.profile(obj['Key']):
+                result = process_single_file(s3_client, bucket_name, obj['Key'], ctx,
+                                             size=obj.get('Size'), etag=obj.get('ETag'))
+        else:
+            result = process_single_file(s3_client, bucket_name, obj['Key'], ctx,
+                                         size=obj.get('Size'), etag=obj.get('ETag'))
+    if result['status'] != 'buffered':
+        _finish(result, ctx)
+    return result
+
+
+def _finish(result: Dict[str, Any], ctx: RunContext) -> None:
+    # A result is final: record it, release its lease and let the scheduler queue the merges it unblocks
+    if ctx.manifest is not None:
+        ctx.manifest.record(result)
+    if ctx.work_queue is not None and result['key'] not in ctx.leases_completed:
+        ctx.work_queue.complete(result)
+    if ctx.scheduler is not None:
+        ctx.scheduler.file_done(result)
+
+
+def _run_files(
+    s3_client: Any, bucket_name: str, objects: Iterable[Dict[str, Any]], ctx: RunContext
+) -> List[Dict[str, Any]]:
+    max_workers = ctx.max_workers
+    if max_workers <= 1:
+        return [_process_and_record(s3_client, bucket_name, obj, ctx) for obj in objects]
+
+    results = []
+    max_in_flight = max_workers * 2  # Keep the listing streaming instead of queueing every key
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = set()
+        for obj in objects:
+            in_flight.add(executor.submit(_process_and_record, s3_client, bucket_name, obj, ctx))
+            if len(in_flight) >= max_in_flight:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                results.extend(f.result() for f in finished)
+        results.extend(f.result() for f in as_completed(in_flight))
+    return results
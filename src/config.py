@@ -1,8 +1,87 @@
 S3_BUCKET = 'mybucket'
 S3_PREFIXES = ['AB', 'CD', 'EF']  # Example prefixes for each CSV type
+S3_RAW_PREFIX = 'raw/'  # Key prefix the pipeline lists (main.py --prefix)
 DB_URI = 'postgresql://localhost:5432/postgres'
-EXPECTED_SCHEMAS = {
-    "CD": ["Production Code", "Unit ID", "Column A Stage A", "Column B Stage A", "Column C Stage A", "Column D Stage A" ],
-    "AB": ["Production Code", "Parent ID", "Child Position", "Operator", "Column A Stage A", "Column B Stage A" ],
-    "EF": ["Production Code", "Parent ID", "Child Position", "Comment", "Column A Stage A", "Column B Stage A", "Column C Stage A"]
-}
\ No newline at end of file
+DB_POOL_SIZE = 5  # Pooled connections per run; process_file raises it to max_workers
+DB_MAX_OVERFLOW = 10
+DB_POOL_RECYCLE = 1800  # Seconds before a pooled connection is replaced
+MAX_WORKERS = 1  # Concurrent files in process_file; raise until S3 or Postgres saturates
+PARSE_WORKERS = 0  # Processes parsing, validating and cleaning whole files behind max_workers download threads; 0 keeps it in the threads, None uses every core
+STAGED_MAX_BYTES = 512 * 1024 * 1024  # With PARSE_WORKERS: raw object bytes in flight between download and load (parsed frames take several times this)
+CHUNK_SIZE = None  # Rows per streamed chunk; None reads each file whole
+DEDUPE_ACROSS_CHUNKS = False  # Drop duplicate rows spanning chunk boundaries (costs ~8 bytes/row)
+PREVALIDATE_MIN_BYTES = 64 * 1024 * 1024  # Objects this large get a ranged header check first; None disables
+HEADER_PEEK_BYTES = 64 * 1024  # Bytes fetched by the header pre-flight check
+INSERT_BATCH_SIZE = 500  # Rows per multi-row INSERT when COPY is unavailable (non-Postgres URIs)
+COALESCE_LOADS = False  # Batch small files per stg_<code> table into one transaction
+COALESCE_MAX_ROWS = 50000  # Rows buffered per table before a coalesced load is flushed
+MANIFEST_URI = None  # e.g. 'sqlite:///ingestion_manifest.db' or DB_URI; None reprocesses every file
+CSV_ENGINE = 'c'  # 'pyarrow' uses the multithreaded Arrow parser (requires pyarrow)
+CSV_DTYPE_BACKEND = None  # 'pyarrow' keeps parsed columns in Arrow-backed dtypes
+METRICS_JSON_PATH = None  # Per-stage/per-file/per-table run report as JSON
+METRICS_PROM_PATH = None  # Same totals in Prometheus textfile-collector format
+PROFILE_DIR = None  # cProfile + tracemalloc dumps of the slowest files; forces one worker
+PROFILE_TOP_N = 5  # Slowest files kept for PROFILE_DIR
+DEDUPE_INDEX_PATH = None  # e.g. 'dedupe_index.npz'; drops rows already loaded by earlier files/runs
+DEDUPE_BLOOM_CAPACITY = None  # Keys to size a fixed-memory Bloom filter for; None keeps an exact set (8 bytes/key)
+DEDUPE_BLOOM_ERROR_RATE = 0.001  # Share of new rows a full Bloom filter wrongly drops as seen
+DEDUPE_KEYS_ONLY = False  # Fingerprint the merge key alone (first row per key wins) instead of key + values
+CACHE_DIR = None  # e.g. '.cache/batches'; Parquet copies of cleaned files keyed by key + ETag (requires pyarrow)
+CACHE_MAX_BYTES = 10 * 1024 ** 3  # Least recently used cached files are evicted beyond this
+MERGE_BATCH_SIZE = 50000  # Target ids upserted per prod transaction by load_to_prod
+MERGE_AFTER_LOAD = False  # main.py run: merge each stg_<code> into prod as soon as its files are loaded
+MERGE_WORKERS = 4  # Prod merges run in parallel (one per target table at a time)
+PROD_TABLE_TEMPLATE = 'prod_{code}'  # Prod table merged from stg_<code>; keep one per staging table (watermarks are per target)
+RETRY_ATTEMPTS = 5  # Tries per S3 read or staging load on throttling and transient errors (1 disables retries)
+RETRY_BASE_DELAY = 0.2  # Seconds; backoff before retry n is uniform in [0, min(RETRY_MAX_DELAY, base * 2**n)]
+RETRY_MAX_DELAY = 20.0
+ADAPTIVE_CONCURRENCY = True  # AIMD caps on in-flight S3 reads and staging loads: halved on throttling, regrown on success
+WORK_QUEUE_URI = None  # e.g. DB_URI; nodes running main.py share ingestion through leases in this database
+WORK_LEASE_SECONDS = 300  # A claimed key returns to the queue unless its worker renews the lease in time
+WORK_CLAIM_BATCH = 8  # Keys leased per claim
+WORK_MAX_ATTEMPTS = 3  # Claims per key before it is marked failed
+WATCH_INTERVAL = 2.0  # main.py watch: seconds between incremental (StartAfter) listings
+WATCH_BATCH_FILES = 100  # A micro-batch is processed once it holds this many files...
+WATCH_BATCH_BYTES = 256 * 1024 * 1024  # ...or this many bytes...
+WATCH_BATCH_WINDOW = 5.0  # ...or this many seconds after its first file was seen
+WATCH_RESCAN_EVERY = 30  # Polls between full listings, which catch keys sorting before the last one seen
+WATCH_RESCAN_OVERLAP = 3600.0  # Seconds before the previous full listing still treated as new (slow uploads, clock skew)
+LOW_MEMORY = False  # Clean with one combined row mask and downcast columns in place (fewer full-frame copies)
+CATEGORY_MAX_RATIO = 0.5  # Low-memory mode dictionary-encodes string columns with at most this many distinct values per row
+QUARANTINE_REJECTS = False  # Check rows against src.rules.RULES and load rejects into quarantine_<prefix> with reason codes
+STAGE_VALUE_RANGE = (None, None)  # (low, high) bounds of 'Column X Stage A' values for the rules, e.g. (0.0, 100.0); None leaves a side open
+# (column name, dtype, categorical) per Production Code prefix
+TYPED_SCHEMAS = {
+    "CD": [
+        ("Production Code", "string", True),
+        ("Unit ID", "string", False),
+        ("Column A Stage A", "float64", False),
+        ("Column B Stage A", "float64", False),
+        ("Column C Stage A", "float64", False),
+        ("Column D Stage A", "float64", False),
+    ],
+    "AB": [
+        ("Production Code", "string", True),
+        ("Parent ID", "string", False),
+        ("Child Position", "string", False),
+        ("Operator", "string", True),
+        ("Column A Stage A", "float64", False),
+        ("Column B Stage A", "float64", False),
+    ],
+    "EF": [
+        ("Production Code", "string", True),
+        ("Parent ID", "string", False),
+        ("Child Position", "string", False),
+        ("Comment", "string", True),
+        ("Column A Stage A", "float64", False),
+        ("Column B Stage A", "float64", False),
+        ("Column C Stage A", "float64", False),
+    ],
+}
+# Columns the prod merge queries hash into the target id, per prefix
+MERGE_KEY_COLUMNS = {
+    "CD": ["Production Code", "Unit ID"],
+    "AB": ["Production Code", "Parent ID", "Child Position", "Operator"],
+    "EF": ["Production Code", "Parent ID", "Child Position"],
+}
+EXPECTED_SCHEMAS = {prefix: [name for name, _, _ in columns] for prefix, columns in TYPED_SCHEMAS.items()}
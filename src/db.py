@@ -0,0 +1,38 @@
+from typing import Any, Dict, List
+from sqlalchemy import Table, create_engine
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection, Engine, make_url
+from .config import DB_URI, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE
+
+
+def create_pipeline_engine(
+    db_uri: str = DB_URI,
+    pool_size: int = DB_POOL_SIZE,
+    max_overflow: int = DB_MAX_OVERFLOW,
+) -> Engine:
+    """
+    Create the pooled engine shared by every staging load and prod merge of one run.
+    Pool sizing is skipped for SQLite, whose default pools do not take it.
+    """
+    if make_url(db_uri).get_backend_name() == 'sqlite':
+        return create_engine(db_uri)
+    return create_engine(
+        db_uri,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=True,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+
+
+def upsert(conn: Connection, table: Table, values: Dict[str, Any], key_columns: List[str]) -> None:
+    """
+    INSERT ... ON CONFLICT DO UPDATE of one row on Postgres or SQLite.
+    """
+    dialect = postgresql if conn.dialect.name == 'postgresql' else sqlite
+    stmt = dialect.insert(table).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={k: v for k, v in values.items() if k not in key_columns},
+    )
+    conn.execute(stmt)
@@ -0,0 +1,189 @@
+import logging
+import math
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from .config import MERGE_KEY_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# Fingerprints are mixed with this odd constant to derive the Bloom filter's second hash
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+class _FingerprintSet:
+    """
+    Exact set of 64-bit fingerprints held as a few sorted uint64 runs (8 bytes per
+    key). New fingerprints become a small run that is merged into its neighbour once
+    they are of similar size, so lookups stay a handful of binary searches.
+    """
+
+    def __init__(self, values: Optional[np.ndarray] = None):
+        self._runs: List[np.ndarray] = []
+        if values is not None and len(values):
+            self._runs.append(np.unique(values.astype(np.uint64)))
+
+    def __len__(self) -> int:
+        return sum(len(run) for run in self._runs)
+
+    def contains(self, fingerprints: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(fingerprints), dtype=bool)
+        for run in self._runs:
+            idx = np.minimum(np.searchsorted(run, fingerprints), len(run) - 1)
+            found |= run[idx] == fingerprints
+        return found
+
+    def add(self, fingerprints: np.ndarray) -> None:
+        if not len(fingerprints):
+            return
+        self._runs.append(np.unique(fingerprints))
+        while len(self._runs) > 1 and len(self._runs[-2]) <= 2 * len(self._runs[-1]):
+            newest = self._runs.pop()
+            self._runs[-1] = np.union1d(self._runs[-1], newest)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        merged = np.unique(np.concatenate(self._runs)) if self._runs else np.empty(0, dtype=np.uint64)
+        self._runs = [merged] if len(merged) else []
+        return {'fingerprints': merged}
+
+
+class _BloomFilter:
+    """
+    Fixed-size Bloom filter over 64-bit fingerprints: about 1.2 bytes per key at a
+    1% false-positive rate, 1.8 bytes at 0.1%, whatever the number of keys inserted.
+    """
+
+    def __init__(self, capacity: int, error_rate: float, bits: Optional[np.ndarray] = None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bits if bits is not None else np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, fingerprints: np.ndarray) -> List[np.ndarray]:
+        # Kirsch-Mitzenmacher double hashing: position_i = h1 + i * h2 (mod size)
+        h2 = (fingerprints * _GOLDEN) | np.uint64(1)
+        size = np.uint64(self.size)
+        return [(fingerprints + np.uint64(i) * h2) % size for i in range(self.hashes)]
+
+    def contains(self, fingerprints: np.ndarray) -> np.ndarray:
+        found = np.ones(len(fingerprints), dtype=bool)
+        for pos in self._positions(fingerprints):
+            found &= (self.bits[pos >> np.uint64(3)] >> (pos & np.uint64(7)).astype(np.uint8)) & 1 == 1
+        return found
+
+    def add(self, fingerprints: np.ndarray) -> None:
+        for pos in self._positions(fingerprints):
+            np.bitwise_or.at(self.bits, pos >> np.uint64(3), np.left_shift(1, pos & np.uint64(7)).astype(np.uint8))
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {'bits': self.bits, 'capacity': np.array(self.capacity), 'error_rate': np.array(self.error_rate)}
+
+
+class DedupeIndex:
+    """
+    Persistent index of the row fingerprints already loaded into staging, shared by
+    every file of a run and carried across runs, so replayed or overlapping exports
+    are dropped before they reach the database.
+    A fingerprint is a 64-bit hash of a row's merge key columns (MERGE_KEY_COLUMNS,
+    the columns the prod merge hashes into its id) followed by its other schema
+    columns: a replayed row is dropped, while a corrected row for an existing key
+    still reaches the merge. keys_only=True hashes the merge key alone, so only the
+    first row ever seen per key is loaded; use it only for write-once sources.
+    The index is exact (8 bytes per key) unless bloom_capacity is set, in which case
+    a Bloom filter of fixed size is used and about error_rate of new rows are wrongly
+    dropped as seen. Loads can fail after filtering, so callers add() fingerprints only
+    once their rows are committed. Until then drop_seen() holds them in flight, so
+    the same rows in another file loading concurrently (or buffered in the same
+    batch) are dropped too; release() them if the load fails.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        bloom_capacity: Optional[int] = None,
+        error_rate: float = 0.001,
+        keys_only: bool = False,
+    ):
+        self.path = path
+        self.keys_only = keys_only
+        self._lock = threading.Lock()
+        self._in_flight: Dict[int, Tuple[np.ndarray, _FingerprintSet]] = {}
+        saved = self._read(path)
+        if bloom_capacity is not None:
+            bits = None
+            if saved is not None and 'bits' in saved:
+                bloom_capacity, error_rate = int(saved['capacity']), float(saved['error_rate'])
+                bits = saved['bits']
+            self._store = _BloomFilter(bloom_capacity, error_rate, bits)
+        else:
+            self._store = _FingerprintSet(saved.get('fingerprints') if saved is not None else None)
+
+    @staticmethod
+    def _read(path: Optional[str]) -> Optional[Dict[str, np.ndarray]]:
+        if not path or not os.path.exists(path):
+            return None
+        with np.load(path) as saved:
+            return {name: saved[name] for name in saved.files}
+
+    def fingerprints(self, df: pd.DataFrame, table_name: str) -> np.ndarray:
+        """
+        One uint64 fingerprint per row of df, a frame routed to table_name (stg_<code>).
+        Hashes depend on dtype, so float32 columns (as left by low-memory cleaning) are
+        hashed as float64 like the same values cleaned normally.
+        """
+        keys = [c for c in MERGE_KEY_COLUMNS.get(table_name[len('stg_'):len('stg_') + 2], []) if c in df.columns]
+        columns = keys if self.keys_only and keys else keys + [
+            c for c in df.columns if c not in keys and c != 'processing_ts'
+        ]
+        frame = df[columns]
+        narrow = {name: np.float64 for name, dtype in frame.dtypes.items() if dtype == np.float32}
+        if narrow:
+            frame = frame.astype(narrow)
+        return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+    def drop_seen(self, df: pd.DataFrame, table_name: str) -> Tuple[pd.DataFrame, np.ndarray]:
+        """
+        Drop rows of df whose fingerprint is already indexed or in flight, or repeats an
+        earlier row of df. Returns the kept rows and their fingerprints, which stay in
+        flight until passed to add() after loading or to release().
+        """
+        fingerprints = self.fingerprints(df, table_name)
+        first = ~pd.Series(fingerprints).duplicated().to_numpy()
+        with self._lock:
+            keep = first & ~self._store.contains(fingerprints)
+            for _, in_flight in self._in_flight.values():
+                keep &= ~in_flight.contains(fingerprints)
+            if not keep.all():
+                df, fingerprints = df[keep], fingerprints[keep]
+            if len(fingerprints):
+                self._in_flight[id(fingerprints)] = (fingerprints, _FingerprintSet(fingerprints))
+        return df, fingerprints
+
+    def add(self, fingerprints: np.ndarray) -> None:
+        with self._lock:
+            self._in_flight.pop(id(fingerprints), None)
+            self._store.add(fingerprints)
+
+    def release(self, fingerprints: np.ndarray) -> None:
+        """
+        Forget fingerprints returned by drop_seen() whose rows were not loaded.
+        """
+        with self._lock:
+            self._in_flight.pop(id(fingerprints), None)
+
+    def save(self) -> None:
+        """
+        Atomically write the index to path (a .npz file), if one was given.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            arrays = self._store.arrays()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self.path)
+        logger.info(f"Dedupe index saved to {self.path}")
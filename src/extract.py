@@ -1,38 +1,97 @@
-import re
+import io
+import time
+import importlib.util
+import numpy as np
 import pandas as pd
 import logging
-from typing import List, Dict, Tuple, Any
+from typing import List, Dict, Tuple, Any, Iterator, Optional
+from .config import TYPED_SCHEMAS, CSV_ENGINE, CSV_DTYPE_BACKEND
+from . import metrics
+from .listing import (
+    HAS_ZSTANDARD, COMPRESSIONS, CSV_SUFFIXES, list_s3_objects, list_s3_files, list_s3_objects_by_prefixes,
+    list_s3_files_by_prefixes, is_valid_csv_filename, compression_of, decompressed, read_head_bytes, check_header,
+)
 
 logger = logging.getLogger(__name__)
 
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+ARROW_DTYPES = {'string': 'string[pyarrow]', 'float64': 'double[pyarrow]'}
+NUMERIC_COLUMNS = frozenset(
+    name for columns in TYPED_SCHEMAS.values() for name, dtype, _ in columns if dtype == 'float64'
+)
 
-def list_s3_files(s3_client: Any, bucket_name: str, prefix: str) -> List[str]:
+
+def csv_dtypes(typed_schemas: Dict[str, List[tuple]], dtype_backend: Optional[str] = None) -> Dict[str, str]:
     """
-    List all CSV files in an S3 bucket under a given prefix.
+    Builds the parser dtype for every column name in the typed schemas. Names are shared
+    across prefixes with the same type, so the mapping applies before the Production
+    Code (and hence the schema) of a file is known. Categorical columns parse as
+    'category'; with dtype_backend='pyarrow' the rest use Arrow-backed dtypes.
     """
-    try:
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-        return [obj['Key'] for obj in response.get('Contents', []) if obj['Key'].endswith('.csv')]
-    except Exception as e:
-        logger.error(f"Error listing S3 files: {e}")
-        raise
+    dtypes = {}
+    for columns in typed_schemas.values():
+        for name, dtype, categorical in columns:
+            if categorical:
+                dtypes[name] = 'category'
+            elif dtype_backend == 'pyarrow':
+                dtypes[name] = ARROW_DTYPES.get(dtype, dtype)
+            else:
+                dtypes[name] = dtype
+    return dtypes
+
+
+def _dtype_backend() -> Optional[str]:
+    return CSV_DTYPE_BACKEND if HAS_PYARROW else None
 
 
-def is_valid_csv_filename(file_name: str, directory_name: str, prefix: str) -> bool:
+def csv_read_options(chunked: bool = False) -> Dict[str, Any]:
     """
-    Checks if the file_name matches the pattern: directory_name/<prefix><three-digit-number>.csv
+    pd.read_csv keyword arguments for typed parsing with the configured parser engine.
+    Falls back to the C parser without pyarrow, and for chunked reads which the
+    pyarrow engine does not support. Numeric columns are left to inference, for
+    coerce_numeric_columns after the read, so one stray value cannot fail the parse.
     """
-    pattern = rf"^{re.escape(directory_name)}/{re.escape(prefix)}\d{{3}}\.csv$"
-    return bool(re.match(pattern, file_name))
+    dtype_backend = _dtype_backend()
+    dtypes = csv_dtypes(TYPED_SCHEMAS, dtype_backend)
+    options: Dict[str, Any] = {'dtype': {name: dtype for name, dtype in dtypes.items() if name not in NUMERIC_COLUMNS}}
+    if dtype_backend:
+        options['dtype_backend'] = dtype_backend
+    if CSV_ENGINE == 'pyarrow' and HAS_PYARROW and not chunked:
+        options['engine'] = 'pyarrow'
+    return options
+
+
+def coerce_numeric_columns(df: pd.DataFrame, key: str) -> pd.DataFrame:
+    """
+    Cast the numeric schema columns of a parsed frame to float64 (double[pyarrow] with
+    the pyarrow backend) in place; values that are not numbers become nulls, left to
+    cleaning or the data-quality rules.
+    """
+    target = ARROW_DTYPES['float64'] if _dtype_backend() == 'pyarrow' else 'float64'
+    for name in df.columns:
+        if name not in NUMERIC_COLUMNS or str(df[name].dtype) == target:
+            continue
+        column = df[name]
+        if not pd.api.types.is_numeric_dtype(column.dtype):
+            # Via object: Arrow strings would coerce to NaN values rather than nulls
+            numbers = pd.to_numeric(column.astype(object), errors='coerce')
+            coerced = int((numbers.isna() & column.notna()).sum())
+            if coerced:
+                logger.warning(f"{coerced} non-numeric values in '{name}' of {key} read as null")
+            column = numbers
+        df[name] = column.astype(target)
+    return df
 
 
 def read_csv_file(s3_client: Any, bucket_name: str, key: str) -> pd.DataFrame:
     """
-    Reads a CSV file from S3 and returns a pandas DataFrame.
+    Reads a CSV file from S3 and returns a pandas DataFrame typed by TYPED_SCHEMAS.
     """
     try:
-        obj = s3_client.get_object(Bucket=bucket_name, Key=key)
-        df = pd.read_csv(obj['Body'])
+        start = time.perf_counter()
+        body = _get_body(s3_client, bucket_name, key)
+        df = coerce_numeric_columns(pd.read_csv(decompressed(body, key), **csv_read_options()), key)
+        _record_read(body, start, rows=len(df))
         if not isinstance(df, pd.DataFrame):
             raise ValueError(f"File at {bucket_name}/{key} did not return a DataFrame.")
         return df
@@ -41,6 +100,99 @@ def read_csv_file(s3_client: Any, bucket_name: str, key: str) -> pd.DataFrame:
         raise
 
 
+def download_bytes(s3_client: Any, bucket_name: str, key: str) -> bytes:
+    """
+    The raw (still compressed) bytes of an S3 object, for parsing elsewhere with
+    parse_csv_bytes.
+    """
+    body = _get_body(s3_client, bucket_name, key)
+    data = body.read()
+    metrics.record('download', body.seconds, nbytes=body.bytes)
+    return data
+
+
+def parse_csv_bytes(data: Any, key: str) -> pd.DataFrame:
+    """
+    Parses a downloaded CSV object (bytes or any buffer, compressed as key says) the
+    way read_csv_file parses a streamed body.
+    """
+    start = time.perf_counter()
+    df = coerce_numeric_columns(pd.read_csv(decompressed(io.BytesIO(data), key), **csv_read_options()), key)
+    metrics.record('parse', time.perf_counter() - start, rows=len(df), nbytes=len(data))
+    return df
+
+
+def read_csv_chunks(s3_client: Any, bucket_name: str, key: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    """
+    Streams a CSV file from S3 as DataFrames of at most chunksize rows.
+    """
+    try:
+        body = _get_body(s3_client, bucket_name, key)
+        reader = pd.read_csv(decompressed(body, key), chunksize=chunksize, **csv_read_options(chunked=True))
+    except Exception as e:
+        logger.error(f"Error reading CSV from S3: {e}")
+        raise
+    with reader:
+        for chunk in _metered_chunks(reader, body):
+            yield coerce_numeric_columns(chunk, key)
+
+
+def _metered_chunks(reader: Any, body: 'metrics.MeteredStream') -> Iterator[pd.DataFrame]:
+    while True:
+        start = time.perf_counter()
+        seconds, nbytes = body.seconds, body.bytes
+        chunk = next(reader, None)
+        read_seconds, read_bytes = body.seconds - seconds, body.bytes - nbytes
+        metrics.record('download', read_seconds, nbytes=read_bytes)
+        metrics.record('parse', time.perf_counter() - start - read_seconds,
+                       rows=0 if chunk is None else len(chunk), nbytes=read_bytes)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _get_body(s3_client: Any, bucket_name: str, key: str) -> 'metrics.MeteredStream':
+    obj = s3_client.get_object(Bucket=bucket_name, Key=key)
+    return metrics.MeteredStream(obj['Body'])
+
+
+def _record_read(body: 'metrics.MeteredStream', start: float, rows: int) -> None:
+    # The parser pulls the body while it parses: split time spent in reads out as 'download'
+    metrics.record('download', body.seconds, nbytes=body.bytes)
+    metrics.record('parse', time.perf_counter() - start - body.seconds, rows=rows, nbytes=body.bytes)
+
+
+def read_csv_header(s3_client: Any, bucket_name: str, key: str, max_bytes: int) -> pd.DataFrame:
+    """
+    Reads only the first max_bytes of a CSV file from S3 with a ranged GET and parses
+    the header plus every complete row inside that range (see read_head_bytes); the
+    DataFrame is empty when the range holds no complete line.
+    """
+    head = read_head_bytes(s3_client, bucket_name, key, max_bytes)
+    if not head:
+        return pd.DataFrame()
+    return pd.read_csv(io.BytesIO(head))
+
+
+def prevalidate_csv_schema(
+    s3_client: Any, bucket_name: str, key: str, expected_schemas: Dict[str, List[str]], max_bytes: int
+) -> Tuple[bool, Any]:
+    """
+    Pre-flight schema check on the first max_bytes of a file, so a mis-schema'd file is
+    rejected before the full download. Returns the same (valid, message) as
+    validate_csv_schema_by_production_code; a header with no Production Code value in
+    range, or no complete header at all, is inconclusive and passes, leaving the
+    decision to the full validation.
+    """
+    head = read_csv_header(s3_client, bucket_name, key, max_bytes)
+    if head.columns.empty:
+        return True, "No complete header within the first bytes"
+    valid, res = validate_csv_schema_by_production_code(head, expected_schemas)
+    if not valid and res == "'Production Code' column is empty":
+        return True, res
+    return valid, res
+
+
 def validate_csv_schema_by_production_code(
     df: pd.DataFrame, expected_schemas: Dict[str, List[str]]
 ) -> Tuple[bool, Any]:
@@ -75,13 +227,32 @@ def validate_csv_schema_by_production_code(
         return False, f"Error processing file: {e}"
 
 
+def valid_production_code_mask(codes: pd.Series) -> np.ndarray:
+    """
+    Vectorized check of the AA999 Production Code format using fixed-width character
+    comparisons instead of a per-row regex. Categorical columns are checked once per
+    category rather than once per row.
+    """
+    if isinstance(codes.dtype, pd.CategoricalDtype):
+        valid_categories = np.append(valid_production_code_mask(pd.Series(codes.cat.categories)), False)
+        return valid_categories[codes.cat.codes.to_numpy()]  # code -1 (null) maps to the trailing False
+    values = codes.to_numpy(dtype=object)
+    # Six UCS-4 code points per value: a valid code fills the first five and leaves the sixth empty
+    chars = np.where(pd.isna(values), '', values).astype('U6').view(np.uint32).reshape(-1, 6)
+    letters = (chars[:, :2] >= ord('A')) & (chars[:, :2] <= ord('Z'))
+    digits = (chars[:, 2:5] >= ord('0')) & (chars[:, 2:5] <= ord('9'))
+    return letters.all(axis=1) & digits.all(axis=1) & (chars[:, 5] == 0)
+
+
 def drop_invalid_production_codes(df: pd.DataFrame) -> pd.DataFrame:
     """
     Removes records where 'Production Code' does not match the expected pattern: AA999.
+    Returns df itself when every record is valid.
     """
     if "Production Code" not in df.columns:
         logger.error("Missing required column: 'Production Code'")
         raise ValueError("Missing required column: 'Production Code'")
-    valid_pattern = r"^[A-Z]{2}\d{3}$"
-    filtered_df = df[df["Production Code"].astype(str).str.match(valid_pattern, na=False)].copy()
-    return filtered_df
\ No newline at end of file
+    mask = valid_production_code_mask(df["Production Code"])
+    if mask.all():
+        return df
+    return df.take(np.flatnonzero(mask))
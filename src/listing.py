@@ -0,0 +1,228 @@
+"""
+S3 listing, compression handling and header checks. Kept free of pandas so that
+planning and no-op runs start fast; src.extract re-exports everything here.
+"""
+import bz2
+import csv
+import gzip
+import importlib.util
+import io
+import logging
+import queue
+import re
+import threading
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+HAS_ZSTANDARD = importlib.util.find_spec('zstandard') is not None
+# Compressed CSV suffixes and their codec; objects are decompressed as they stream in
+COMPRESSIONS = {'.csv.gz': 'gzip', '.csv.zst': 'zstd', '.csv.bz2': 'bz2'}
+CSV_SUFFIXES = ('.csv', *COMPRESSIONS)
+
+
+def list_s3_objects(
+    s3_client: Any, bucket_name: str, prefix: str, start_after: Optional[str] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Lazily yield the listing entries (Key, ETag, Size, LastModified) of CSV objects,
+    plain or compressed (CSV_SUFFIXES), under a given prefix. Follows continuation
+    tokens so listings beyond 1,000 keys are complete, and yields each page's entries
+    as soon as it arrives. With start_after only keys sorting after it are listed.
+    """
+    params = {'Bucket': bucket_name, 'Prefix': prefix}
+    if start_after:
+        params['StartAfter'] = start_after
+    while True:
+        try:
+            response = s3_client.list_objects_v2(**params)
+        except Exception as e:
+            logger.error(f"Error listing S3 files: {e}")
+            raise
+        for obj in response.get('Contents', []):
+            if obj['Key'].endswith(CSV_SUFFIXES):
+                yield obj
+        if not response.get('IsTruncated'):
+            return
+        params['ContinuationToken'] = response['NextContinuationToken']
+
+
+def list_s3_files(s3_client: Any, bucket_name: str, prefix: str) -> Iterator[str]:
+    """
+    Lazily yield CSV keys in an S3 bucket under a given prefix.
+    """
+    for obj in list_s3_objects(s3_client, bucket_name, prefix):
+        yield obj['Key']
+
+
+def list_s3_objects_by_prefixes(
+    s3_client: Any,
+    bucket_name: str,
+    prefix: str,
+    sub_prefixes: List[str],
+    max_queue_size: int = 1000,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Fan out list_s3_objects across '<prefix><sub_prefix>' listings in parallel threads
+    and yield entries in arrival order. The bounded queue keeps memory flat: listing
+    threads block once max_queue_size entries are waiting to be consumed.
+    """
+    done = object()
+    keys: queue.Queue = queue.Queue(maxsize=max_queue_size)
+    stop = threading.Event()
+
+    def _put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                keys.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _list(sub_prefix: str) -> None:
+        try:
+            for obj in list_s3_objects(s3_client, bucket_name, f"{prefix}{sub_prefix}"):
+                if not _put(obj):
+                    return
+        except Exception as e:
+            _put(e)
+        finally:
+            _put(done)
+
+    threads = [
+        threading.Thread(target=_list, args=(sub_prefix,), daemon=True)
+        for sub_prefix in sub_prefixes
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        remaining = len(threads)
+        while remaining:
+            item = keys.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+
+
+def list_s3_files_by_prefixes(
+    s3_client: Any, bucket_name: str, prefix: str, sub_prefixes: List[str]
+) -> Iterator[str]:
+    """
+    Fan out list_s3_files across '<prefix><sub_prefix>' listings and yield keys.
+    """
+    for obj in list_s3_objects_by_prefixes(s3_client, bucket_name, prefix, sub_prefixes):
+        yield obj['Key']
+
+
+def is_valid_csv_filename(file_name: str, directory_name: str, prefix: str) -> bool:
+    """
+    Checks if the file_name matches the pattern: directory_name/<prefix><three-digit-number>.csv,
+    optionally followed by a compression suffix (.gz, .zst or .bz2).
+    """
+    pattern = rf"^{re.escape(directory_name)}/{re.escape(prefix)}\d{{3}}\.csv(\.gz|\.zst|\.bz2)?$"
+    return bool(re.match(pattern, file_name))
+
+
+def compression_of(key: str) -> Optional[str]:
+    """
+    The codec ('gzip', 'zstd' or 'bz2') implied by key's suffix, or None for plain CSV.
+    """
+    for suffix, codec in COMPRESSIONS.items():
+        if key.endswith(suffix):
+            return codec
+    return None
+
+
+def _zstandard() -> Any:
+    if not HAS_ZSTANDARD:
+        raise ImportError("Reading .csv.zst objects requires zstandard; install the 'zstd' extra")
+    import zstandard
+    return zstandard
+
+
+def decompressed(body: Any, key: str) -> Any:
+    """
+    Wrap a file-like S3 body in a streaming decompressor chosen by key's suffix, so
+    the parser inflates the object block by block as it is downloaded.
+    """
+    codec = compression_of(key)
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=body, mode='rb')
+    if codec == 'bz2':
+        return bz2.BZ2File(body, mode='rb')
+    if codec == 'zstd':
+        return _zstandard().ZstdDecompressor().stream_reader(body, read_across_frames=True)
+    return body
+
+
+def _decompress_prefix(data: bytes, key: str) -> bytes:
+    # Inflate as much of a truncated compressed prefix as possible
+    codec = compression_of(key)
+    if codec == 'gzip':
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16).decompress(data)
+    if codec == 'bz2':
+        return bz2.BZ2Decompressor().decompress(data)
+    if codec == 'zstd':
+        return _zstandard().ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def read_head_bytes(s3_client: Any, bucket_name: str, key: str, max_bytes: int) -> bytes:
+    """
+    The first max_bytes of an object fetched with a ranged GET, inflated as far as it
+    goes for compressed objects, cut after the last complete line when the object
+    extends past the range. Empty when the range holds no complete line (e.g. a bz2
+    block larger than max_bytes).
+    """
+    try:
+        with metrics.stage('prevalidate') as fetched:
+            obj = s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes=0-{max_bytes - 1}")
+            head = obj['Body'].read()
+            fetched['bytes'] = len(head)
+    except Exception as e:
+        logger.error(f"Error reading CSV header from S3: {e}")
+        raise
+    truncated = len(head) >= max_bytes
+    head = _decompress_prefix(head, key)
+    if truncated:
+        head = head[:head.rfind(b"\n") + 1]  # Drop the row cut off by the range
+    return head if head.strip() else b''
+
+
+def check_header(head: bytes, expected_schemas: Dict[str, List[str]]) -> Tuple[bool, str]:
+    """
+    pandas-free counterpart of validate_csv_schema_by_production_code for the raw
+    leading bytes of a file, with the same messages. Inconclusive heads (no complete
+    header, no Production Code value yet) pass.
+    """
+    rows = [row for row in csv.reader(io.StringIO(head.decode('utf-8', errors='replace'))) if row]
+    if not rows:
+        return True, "No complete header within the first bytes"
+    actual_headers = rows[0]
+    if "Production Code" not in actual_headers:
+        return False, "Missing required column: 'Production Code'"
+    column = actual_headers.index("Production Code")
+    codes = [row[column] for row in rows[1:] if len(row) > column and row[column]]
+    if not codes:
+        return True, "'Production Code' column is empty"
+    prefix = codes[0][:2]
+    if prefix not in expected_schemas:
+        return False, f"No schema defined for Production Code prefix '{prefix}'"
+    expected_headers = expected_schemas[prefix]
+    if actual_headers == expected_headers:
+        return True, f"Headers match expected schema for prefix '{prefix}'."
+    if len(actual_headers) == len(expected_headers):
+        return True, f"Headers renamed to expected schema for prefix '{prefix}'."
+    return False, (
+        f"Header mismatch for prefix '{prefix}'.\n"
+        f"Expected: {expected_headers}\n"
+        f"Found:    {actual_headers}"
+    )
@@ -0,0 +1,90 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict
+from sqlalchemy import (
+    BigInteger, Column, DateTime, MetaData, String, Table, Text, create_engine, select,
+)
+from .db import upsert
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+ingestion_manifest = Table(
+    'ingestion_manifest',
+    metadata,
+    Column('key', String(1024), primary_key=True),
+    Column('etag', String(128)),
+    Column('size', BigInteger),
+    Column('last_modified', DateTime(timezone=True)),
+    Column('rows', BigInteger),
+    Column('status', String(32)),
+    Column('error', Text),
+    Column('updated_at', DateTime),
+)
+
+# Outcomes that are final for an unchanged object; anything else is retried on rerun.
+DONE_STATUSES = {'loaded', 'empty', 'schema_invalid'}
+
+
+class IngestionManifest:
+    """
+    Persisted record of every ingested S3 object (key, ETag, size, row count, outcome),
+    stored in the 'ingestion_manifest' table of a Postgres database or local SQLite file.
+    The whole manifest is read once at startup so skip checks cost no round trips.
+    """
+
+    def __init__(self, engine: Any):
+        self.engine = engine
+        metadata.create_all(engine, tables=[ingestion_manifest])
+        with engine.connect() as conn:
+            rows = conn.execute(select(
+                ingestion_manifest.c.key, ingestion_manifest.c.etag,
+                ingestion_manifest.c.size, ingestion_manifest.c.status,
+            ))
+            self._entries = {key: (etag, size, status) for key, etag, size, status in rows}
+        self._listed: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_uri(cls, uri: str) -> 'IngestionManifest':
+        return cls(create_engine(uri))
+
+    def should_process(self, obj: Dict[str, Any]) -> bool:
+        """
+        True unless obj was already ingested with the same ETag and size and a final
+        outcome. Remembers obj so record() can store its listing metadata.
+        """
+        entry = self._entries.get(obj['Key'])
+        if entry is not None:
+            etag, size, status = entry
+            if etag == obj.get('ETag') and size == obj.get('Size') and status in DONE_STATUSES:
+                return False
+        with self._lock:
+            self._listed[obj['Key']] = obj
+        return True
+
+    def record(self, result: Dict[str, Any]) -> None:
+        """
+        Upsert the outcome of one processed file.
+        """
+        with self._lock:
+            obj = self._listed.pop(result['key'], {'Key': result['key']})
+        values = {
+            'key': result['key'],
+            'etag': obj.get('ETag'),
+            'size': obj.get('Size'),
+            'last_modified': obj.get('LastModified'),
+            'rows': result['rows'],
+            'status': result['status'],
+            'error': result['error'],
+            'updated_at': datetime.now(),
+        }
+        try:
+            with self.engine.begin() as conn:
+                upsert(conn, ingestion_manifest, values, ['key'])
+        except Exception as e:
+            logger.error(f"Error recording {result['key']} in ingestion manifest: {e}")
+            return
+        self._entries[result['key']] = (values['etag'], values['size'], values['status'])
@@ -0,0 +1,180 @@
+"""
+Declarative staging -> prod merge specs and the SQL generated from them.
+
+Each Production Code prefix declares the key columns hashed into the target id, the
+cast target columns and, for EF, the pivot of one staging column's values into
+target columns. From a spec this module generates the target DDL (with a unique
+index on id) and an INSERT ... SELECT ... ON CONFLICT (id) DO UPDATE that runs on
+Postgres and on SQLite (given md5() and concat()). Table and index names go
+through quote (a dialect's identifier_preparer.quote), since pandas creates the
+mixed-case staging tables quoted.
+"""
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+from .config import MERGE_KEY_COLUMNS
+
+
+@dataclass(frozen=True)
+class TargetColumn:
+    name: str
+    sql_type: str
+    expression: str  # SQL over staging columns
+    update: bool = False  # Overwritten when the id already exists
+
+
+@dataclass(frozen=True)
+class Pivot:
+    """
+    avg(value) per id for each listed value of the staging column `column`, written
+    to the target column mapped to that value.
+    """
+    column: str
+    value: str
+    targets: Dict[str, str]
+    sql_type: str = 'double precision'
+
+
+@dataclass(frozen=True)
+class MergeSpec:
+    key_columns: Sequence[str]
+    columns: Sequence[TargetColumn]
+    pivot: Optional[Pivot] = None
+
+    @property
+    def target_columns(self) -> List[str]:
+        pivoted = list(self.pivot.targets.values()) if self.pivot else []
+        return ['id', *(c.name for c in self.columns), *pivoted]
+
+    @property
+    def update_columns(self) -> List[str]:
+        pivoted = list(self.pivot.targets.values()) if self.pivot else []
+        return [*(c.name for c in self.columns if c.update), *pivoted]
+
+
+def _q(name: str) -> str:
+    return f'"{name}"'
+
+
+def _float(name: str, target: str, update: bool = True) -> TargetColumn:
+    return TargetColumn(target, 'double precision', _q(name), update=update)
+
+
+MERGE_SPECS: Dict[str, MergeSpec] = {
+    'CD': MergeSpec(
+        key_columns=MERGE_KEY_COLUMNS['CD'],
+        columns=[
+            TargetColumn('production_code', 'varchar(5)', _q('Production Code')),
+            TargetColumn('unit_id', 'varchar(25)', _q('Unit ID')),
+            _float('Column A Stage A', 'column_a_stage_a'),
+            _float('Column B Stage A', 'column_b_stage_a'),
+            _float('Column C Stage A', 'column_c_stage_a'),
+            _float('Column D Stage A', 'column_d_stage_a'),
+        ],
+    ),
+    'AB': MergeSpec(
+        key_columns=MERGE_KEY_COLUMNS['AB'],
+        columns=[
+            TargetColumn('production_code', 'varchar(5)', _q('Production Code')),
+            TargetColumn('parent_id', 'varchar(25)', _q('Parent ID')),
+            TargetColumn('child_position', 'varchar(5)', _q('Child Position')),
+            TargetColumn('unit_id', 'varchar(30)', 'concat("Parent ID", "Child Position")'),
+            TargetColumn('operator', 'varchar(255)', _q('Operator')),
+            _float('Column A Stage A', 'column_a_stage_a'),
+        ],
+    ),
+    'EF': MergeSpec(
+        key_columns=MERGE_KEY_COLUMNS['EF'],
+        columns=[
+            TargetColumn('production_code', 'varchar(5)', _q('Production Code')),
+            TargetColumn('parent_id', 'varchar(25)', _q('Parent ID')),
+            TargetColumn('child_position', 'varchar(5)', _q('Child Position')),
+            TargetColumn('unit_id', 'varchar(30)', 'concat("Parent ID", "Child Position")'),
+        ],
+        pivot=Pivot(
+            column='Comment',
+            value='(cast("Column A Stage A" as double precision) + cast("Column B Stage A" as double precision)'
+                  ' + cast("Column C Stage A" as double precision)) / 3.0',
+            targets={'Comment': 'comment', 'test': 'test', 'This is not Real': 'this_is_not_real'},
+        ),
+    ),
+}
+
+
+def spec_for_table(source_table: str) -> MergeSpec:
+    """
+    The spec of a stg_<code> staging table, by its Production Code prefix.
+    """
+    prefix = source_table[len('stg_'):len('stg_') + 2]
+    if prefix not in MERGE_SPECS:
+        raise ValueError(f"No merge spec for staging table '{source_table}'")
+    return MERGE_SPECS[prefix]
+
+
+def target_ddl(spec: MergeSpec, target_table: str, quote: Callable[[str], str] = _q) -> List[str]:
+    """
+    CREATE TABLE / unique index on id statements for the target, both idempotent.
+    """
+    columns = ['id varchar(32) not null', *(f"{c.name} {c.sql_type}" for c in spec.columns)]
+    if spec.pivot:
+        columns += [f"{name} {spec.pivot.sql_type}" for name in spec.pivot.targets.values()]
+    columns.append('updated_at timestamp')
+    return [
+        f"create table if not exists {quote(target_table)} ({', '.join(columns)})",
+        f"create unique index if not exists {quote(f'ux_{target_table}_id')} on {quote(target_table)} (id)",
+    ]
+
+
+def source_query(spec: MergeSpec, source_table: str, where: str = '', quote: Callable[[str], str] = _q) -> str:
+    """
+    One row per target id from the staging rows matching where. For each id only the
+    newest processing_ts is kept, since one upsert cannot touch the same id twice;
+    pivot specs average over all rows of that newest batch.
+    """
+    key = f"md5(concat({', '.join(_q(c) for c in spec.key_columns)}))"
+    columns = [f"cast({c.expression} as {c.sql_type}) as {c.name}" for c in spec.columns]
+    if spec.pivot:
+        columns += [f"{spec.pivot.value} as _pivot_value", f"{_q(spec.pivot.column)} as _pivot_key"]
+    rank = 'rank' if spec.pivot else 'row_number'
+    ranked = (
+        f"select {key} as id, {', '.join(columns)}, "
+        f"{rank}() over (partition by {key} order by processing_ts desc) as _rank "
+        f"from {quote(source_table)} {where}"
+    )
+    names = ', '.join(['id', *(c.name for c in spec.columns)])
+    if not spec.pivot:
+        return f"select {names} from ({ranked}) ranked where _rank = 1"
+    pivoted = ', '.join(
+        f"cast(avg(_pivot_value) filter (where _pivot_key = '{value}') as {spec.pivot.sql_type}) as {target}"
+        for value, target in spec.pivot.targets.items()
+    )
+    return f"select {names}, {pivoted} from ({ranked}) ranked where _rank = 1 group by {names}"
+
+
+def upsert_query(spec: MergeSpec, target_table: str, select_sql: str, quote: Callable[[str], str] = _q) -> str:
+    """
+    INSERT the rows of select_sql (with the spec's target columns) into the target,
+    updating the spec's update columns of ids that already exist. Pivot columns keep
+    their stored value when the new batch has none for them.
+    """
+    names = ', '.join(spec.target_columns)
+    pivoted = set(spec.pivot.targets.values()) if spec.pivot else set()
+    updates = ', '.join(
+        f"{name} = coalesce(excluded.{name}, {quote(target_table)}.{name})" if name in pivoted
+        else f"{name} = excluded.{name}"
+        for name in spec.update_columns
+    )
+    # 'where true' keeps SQLite from parsing ON CONFLICT as a join constraint
+    return (
+        f"insert into {quote(target_table)} ({names}, updated_at) "
+        f"select {names}, current_timestamp from ({select_sql}) src where true "
+        f"on conflict (id) do update set {updates}"
+    )
+
+
+def merge_query(
+    spec: MergeSpec, source_table: str, target_table: str, where: str = '', quote: Callable[[str], str] = _q
+) -> str:
+    """
+    Single-statement upsert of the staging rows matching where into the target.
+    """
+    return upsert_query(spec, target_table, source_query(spec, source_table, where, quote), quote)
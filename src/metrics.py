@@ -0,0 +1,288 @@
+import cProfile
+import heapq
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+_current_file: ContextVar[Optional[str]] = ContextVar('current_file', default=None)
+_active: Optional['RunMetrics'] = None
+
+
+def _new_stats() -> Dict[str, float]:
+    return {'seconds': 0.0, 'calls': 0, 'rows': 0, 'bytes': 0}
+
+
+def rss_bytes() -> int:
+    """
+    Current resident set size of this process, or 0 where /proc is unavailable.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+
+def max_rss_bytes() -> int:
+    """
+    High-water resident set size of this process since it started.
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes elsewhere
+
+
+class RunMetrics:
+    """
+    Thread-safe timing, row-count and byte-count totals per pipeline stage, broken
+    down per file and per staging table. The process RSS is sampled at the end of
+    every stage of a file and the highest value kept per file; with several workers
+    it is the process peak while that file was in flight.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.stages: Dict[str, Dict[str, float]] = defaultdict(_new_stats)
+        self.files: Dict[str, Dict[str, Dict[str, float]]] = defaultdict(lambda: defaultdict(_new_stats))
+        self.tables: Dict[str, Dict[str, Dict[str, float]]] = defaultdict(lambda: defaultdict(_new_stats))
+        self.results: List[Dict[str, Any]] = []
+        self.peak_rss: Dict[str, int] = {}
+
+    def record(self, stage: str, seconds: float, rows: int = 0, nbytes: int = 0,
+               key: Optional[str] = None, table: Optional[str] = None) -> None:
+        key = key or _current_file.get()
+        rss = rss_bytes() if key else 0
+        with self._lock:
+            if key and rss > self.peak_rss.get(key, 0):
+                self.peak_rss[key] = rss
+            targets = [self.stages[stage]]
+            if key:
+                targets.append(self.files[key][stage])
+            if table:
+                targets.append(self.tables[table][stage])
+            for stats in targets:
+                stats['seconds'] += seconds
+                stats['calls'] += 1
+                stats['rows'] += rows
+                stats['bytes'] += nbytes
+
+    def add_result(self, result: Dict[str, Any]) -> None:
+        with self._lock:
+            self.results.append(result)
+
+    def file_seconds(self, key: str) -> float:
+        return sum(s['seconds'] for s in self.files.get(key, {}).values())
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            statuses: Dict[str, int] = defaultdict(int)
+            for result in self.results:
+                statuses[result['status']] += 1
+            return {
+                'started': self.started,
+                'duration_seconds': time.time() - self.started,
+                'files_by_status': dict(statuses),
+                'stages': {k: dict(v) for k, v in self.stages.items()},
+                'tables': {t: {k: dict(v) for k, v in s.items()} for t, s in self.tables.items()},
+                'files': {f: {k: dict(v) for k, v in s.items()} for f, s in self.files.items()},
+                'memory': {'peak_rss_bytes': max_rss_bytes(), 'files_peak_rss_bytes': dict(self.peak_rss)},
+            }
+
+    def write_json(self, path: str) -> None:
+        """
+        Write the run report as JSON.
+        """
+        _atomic_write(path, json.dumps(self.report(), indent=2, default=str))
+
+    def write_prometheus(self, path: str, prefix: str = 'etl') -> None:
+        """
+        Write stage and per-table totals in the Prometheus textfile collector format.
+        """
+        report = self.report()
+        lines = []
+        for name, unit in [('seconds', 'seconds'), ('rows', 'rows'), ('bytes', 'bytes')]:
+            metric = f"{prefix}_stage_{unit}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for stage, stats in report['stages'].items():
+                lines.append(f'{metric}{{stage="{stage}"}} {stats[name]}')
+            for table, stages in report['tables'].items():
+                for stage, stats in stages.items():
+                    lines.append(f'{metric}{{stage="{stage}",table="{table}"}} {stats[name]}')
+        lines.append(f"# TYPE {prefix}_files_total counter")
+        for status, count in report['files_by_status'].items():
+            lines.append(f'{prefix}_files_total{{status="{status}"}} {count}')
+        lines.append(f"# TYPE {prefix}_run_duration_seconds gauge")
+        lines.append(f"{prefix}_run_duration_seconds {report['duration_seconds']}")
+        lines.append(f"# TYPE {prefix}_peak_rss_bytes gauge")
+        lines.append(f"{prefix}_peak_rss_bytes {report['memory']['peak_rss_bytes']}")
+        _atomic_write(path, '\n'.join(lines) + '\n')
+
+
+def _atomic_write(path: str, content: str) -> None:
+    # Scrapers must never see a half-written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def activate(metrics: Optional[RunMetrics]) -> Iterator[None]:
+    """
+    Make metrics the recorder used by stage() for the duration of a run.
+    """
+    global _active
+    previous, _active = _active, metrics
+    try:
+        yield
+    finally:
+        _active = previous
+
+
+@contextmanager
+def current_file(key: str) -> Iterator[None]:
+    """
+    Attribute stages recorded in this thread to the S3 key being processed.
+    """
+    token = _current_file.set(key)
+    try:
+        yield
+    finally:
+        _current_file.reset(token)
+
+
+@contextmanager
+def stage(name: str, table: Optional[str] = None) -> Iterator[Dict[str, int]]:
+    """
+    Time a stage on the active recorder. Set 'rows'/'bytes' on the yielded dict to
+    count them; without an active recorder this is a cheap no-op.
+    """
+    counts = {'rows': 0, 'bytes': 0}
+    if _active is None:
+        yield counts
+        return
+    start = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        _active.record(name, time.perf_counter() - start, counts['rows'], counts['bytes'], table=table)
+
+
+def record(name: str, seconds: float, rows: int = 0, nbytes: int = 0) -> None:
+    """
+    Record an externally timed stage on the active recorder, if any.
+    """
+    if _active is not None:
+        _active.record(name, seconds, rows, nbytes)
+
+
+class MeteredStream:
+    """
+    Wraps a file-like S3 body and accumulates the time and bytes spent in read(), so
+    download time can be told apart from parse time while the parser streams it.
+    """
+
+    def __init__(self, body: Any):
+        self._body = body
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def read(self, *args: Any) -> Any:
+        return self._metered(self._body.read, *args)
+
+    def readline(self, *args: Any) -> Any:
+        return self._metered(self._body.readline, *args)
+
+    def __iter__(self) -> 'MeteredStream':
+        return self
+
+    def __next__(self) -> Any:
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def _metered(self, read: Any, *args: Any) -> Any:
+        start = time.perf_counter()
+        data = read(*args)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(data)
+        return data
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._body, name)
+
+
+class FileProfiler:
+    """
+    Profiles each file with cProfile and tracemalloc and keeps the top_n slowest for
+    dump(). cProfile allows one active profiler per process, so run single-threaded.
+    """
+
+    def __init__(self, top_n: int = 5):
+        self.top_n = top_n
+        self._slowest: List[Any] = []
+
+    @contextmanager
+    def profile(self, key: str) -> Iterator[None]:
+        profiler = cProfile.Profile()
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            allocations = tracemalloc.take_snapshot().compare_to(before, 'lineno')[:20]
+            if not tracing:
+                tracemalloc.stop()
+            entry = (elapsed, key, profiler, peak, allocations)
+            if len(self._slowest) < self.top_n:
+                heapq.heappush(self._slowest, entry)
+            elif elapsed > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def dump(self, directory: str) -> List[str]:
+        """
+        Write <key>.prof (pstats) and <key>.tracemalloc.txt for the slowest files.
+        """
+        os.makedirs(directory, exist_ok=True)
+        written = []
+        for elapsed, key, profiler, peak, allocations in sorted(self._slowest, reverse=True):
+            base = os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]', '_', key))
+            profiler.dump_stats(f"{base}.prof")
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(30)
+            with open(f"{base}.tracemalloc.txt", 'w') as f:
+                f.write(f"{key}: {elapsed:.3f}s, peak traced memory {peak / 1e6:.1f} MB\n\n")
+                f.write('\n'.join(str(stat) for stat in allocations))
+                f.write('\n\n' + stream.getvalue())
+            written.append(base)
+            logger.info(f"Profile for {key} ({elapsed:.3f}s) written to {base}.prof")
+        return written
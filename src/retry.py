@@ -0,0 +1,174 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional, TypeVar
+from sqlalchemy.exc import DBAPIError
+from .config import RETRY_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# S3 error codes asking the caller to slow down, and those worth retrying as they are
+_S3_THROTTLE_CODES = {
+    'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests',
+    'TooManyRequestsException', 'RequestThrottled', '503',
+}
+_S3_TRANSIENT_CODES = {'InternalError', 'ServiceUnavailable', 'RequestTimeout', 'RequestTimeTooSkewed', '500'}
+# botocore transport errors, matched by name so boto stays an optional import here
+_TRANSIENT_ERROR_NAMES = {
+    'EndpointConnectionError', 'ConnectionClosedError', 'ReadTimeoutError', 'ConnectTimeoutError',
+    'IncompleteReadError', 'ResponseStreamingError',
+}
+# Postgres SQLSTATEs: out of connections/resources (throttling), and aborted work safe to redo
+_PG_THROTTLE_CLASSES = ('53',)
+_PG_TRANSIENT_CODES = {'40001', '40P01', '57P01', '57P02', '57P03'}
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Up to attempts tries with 'full jitter' exponential backoff: before retry n the
+    caller sleeps a uniform random time in [0, min(max_delay, base_delay * 2**n)].
+    """
+    attempts: int = RETRY_ATTEMPTS
+    base_delay: float = RETRY_BASE_DELAY
+    max_delay: float = RETRY_MAX_DELAY
+
+    def delay(self, retry: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+
+def _s3_error_code(exc: BaseException) -> Optional[str]:
+    response = getattr(exc, 'response', None)
+    if not isinstance(response, dict):
+        return None
+    code = response.get('Error', {}).get('Code')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return str(code or status) if code or status else None
+
+
+def _pg_code(exc: BaseException) -> Optional[str]:
+    return getattr(getattr(exc, 'orig', None), 'pgcode', None)
+
+
+def is_throttle(exc: BaseException) -> bool:
+    """
+    True for errors by which S3 or Postgres signal they are overloaded.
+    """
+    code = _s3_error_code(exc)
+    if code is not None:
+        return code in _S3_THROTTLE_CODES
+    pg_code = _pg_code(exc)
+    return pg_code is not None and pg_code.startswith(_PG_THROTTLE_CLASSES)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """
+    True for throttling and for transient failures (dropped connections, timeouts,
+    deadlocks) after which the same request may succeed.
+    """
+    if is_throttle(exc):
+        return True
+    code = _s3_error_code(exc)
+    if code is not None:
+        return code in _S3_TRANSIENT_CODES
+    if isinstance(exc, DBAPIError):
+        pg_code = _pg_code(exc)
+        return exc.connection_invalidated or (pg_code is not None and (
+            pg_code in _PG_TRANSIENT_CODES or pg_code.startswith('08')))
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    return any(cls.__name__ in _TRANSIENT_ERROR_NAMES for cls in type(exc).__mro__)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD cap on concurrent calls to one service. Each success raises the limit by
+    1/limit (about one slot per limit successes) up to max_limit; a throttling error
+    halves it (down to min_limit), at most once per cooldown seconds so one burst of
+    throttled responses counts as one congestion signal. Calls wait in slot() while
+    the limit is reached.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, decrease: float = 0.5, cooldown: float = 1.0):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = float(self.max_limit)
+        self._in_flight = 0
+        self._last_decrease = float('-inf')
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        with self._cond:
+            while self._in_flight >= int(self.limit):
+                self._cond.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify()
+
+    def on_success(self) -> None:
+        with self._cond:
+            if self.limit < self.max_limit:
+                grown = min(self.max_limit, self.limit + 1 / self.limit)
+                if int(grown) > int(self.limit):
+                    self._cond.notify()
+                self.limit = grown
+
+    def on_throttle(self) -> None:
+        with self._cond:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit * self.decrease)
+            logger.warning(f"Throttled: concurrency limit lowered to {int(self.limit)}")
+
+
+def call_with_retry(
+    fn: Callable[[], T],
+    name: str,
+    policy: Optional[RetryPolicy] = None,
+    limiter: Optional[AdaptiveLimiter] = None,
+) -> T:
+    """
+    Call fn, inside a limiter slot if given, retrying retryable errors with backoff.
+    fn must be safe to repeat (a whole read, or a load in its own transaction).
+    Throttling errors also lower the limiter; successes raise it. Time spent backing
+    off is recorded as the '<name>_retry' stage.
+    """
+    policy = policy or RetryPolicy()
+    attempts = max(1, policy.attempts)
+    retry = 0
+    while True:
+        try:
+            if limiter is None:
+                result = fn()
+            else:
+                with limiter.slot():
+                    result = fn()
+        except Exception as e:
+            if retry + 1 >= attempts or not is_retryable(e):
+                raise
+            if limiter is not None and is_throttle(e):
+                limiter.on_throttle()
+            delay = policy.delay(retry)
+            retry += 1
+            logger.warning(f"{name} failed ({e}); retry {retry}/{attempts - 1} in {delay:.2f}s")
+            with metrics.stage(f'{name}_retry'):
+                time.sleep(delay)
+            continue
+        if limiter is not None:
+            limiter.on_success()
+        return result
@@ -0,0 +1,197 @@
+"""
+Declarative per-schema data-quality rules, evaluated as one vectorized pass.
+
+Each Production Code prefix declares its required columns, formatted columns,
+numeric ranges, allowed values and unique key. evaluate() ORs one bit per failed
+check into a uint64 per row, so rejected rows keep every reason they failed and
+the kept rows are selected with a single take; split_rejects() returns them next
+to the rejected rows labelled with their reason codes, ready for a bulk load into
+quarantine_<prefix>.
+"""
+import hashlib
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Dict, FrozenSet, List, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from .config import EXPECTED_SCHEMAS, STAGE_VALUE_RANGE
+from .extract import valid_production_code_mask
+from .merge import MERGE_SPECS
+
+REASONS_COLUMN = 'reject_reasons'
+
+
+@dataclass(frozen=True)
+class RuleSet:
+    """
+    Rules of one schema: a value in every required column, a value accepted by the
+    format check of each formats column, a number within each ranges column's bounds
+    (either may be None; infinities never pass) and, for allowed columns, one of the
+    listed values. Among the rows passing those, a repeat of an earlier row is
+    rejected as 'duplicate' and another row with an earlier row's unique key as
+    'duplicate_key'.
+    """
+    required: Sequence[str]
+    formats: Dict[str, Callable[[pd.Series], np.ndarray]] = field(default_factory=dict)
+    ranges: Dict[str, Tuple[Optional[float], Optional[float]]] = field(default_factory=dict)
+    allowed: Dict[str, FrozenSet[str]] = field(default_factory=dict)
+    unique: Sequence[str] = ()
+
+
+def _stage_columns(columns: Sequence[str]) -> List[str]:
+    return [name for name in columns if re.fullmatch(r'Column [A-Z] Stage A', name)]
+
+
+def _rules(prefix: str) -> RuleSet:
+    columns = EXPECTED_SCHEMAS[prefix]
+    spec = MERGE_SPECS[prefix]
+    # Values the prod pivot has no target column for would be dropped by the merge
+    allowed = {spec.pivot.column: frozenset(spec.pivot.targets)} if spec.pivot else {}
+    return RuleSet(
+        required=columns,
+        formats={'Production Code': valid_production_code_mask},
+        ranges={name: STAGE_VALUE_RANGE for name in _stage_columns(columns)},
+        allowed=allowed,
+        unique=[*spec.key_columns, *allowed],  # The pivot averages per key and value
+    )
+
+
+RULES: Dict[str, RuleSet] = {prefix: _rules(prefix) for prefix in EXPECTED_SCHEMAS}
+
+
+def rules_digest(rules: Dict[str, RuleSet] = RULES) -> str:
+    """
+    Short stable digest of rule sets (format checks by name), so results checked
+    against other rules are told apart.
+    """
+    described = [
+        (prefix, list(ruleset.required),
+         sorted((name, f"{check.__module__}.{check.__qualname__}") for name, check in ruleset.formats.items()),
+         sorted(ruleset.ranges.items()), sorted((name, sorted(values)) for name, values in ruleset.allowed.items()),
+         list(ruleset.unique))
+        for prefix, ruleset in sorted(rules.items())
+    ]
+    return hashlib.sha256(repr(described).encode()).hexdigest()[:16]
+
+
+def schema_prefix(columns: Sequence[str]) -> str:
+    """
+    The prefix whose schema has exactly these columns (as left by schema validation).
+    """
+    for prefix, expected in EXPECTED_SCHEMAS.items():
+        if list(columns) == expected:
+            return prefix
+    raise ValueError(f"No schema matches columns {list(columns)}")
+
+
+def quarantine_table(prefix: str) -> str:
+    return f"quarantine_{prefix}"
+
+
+def _numeric(column: pd.Series) -> np.ndarray:
+    if pd.api.types.is_numeric_dtype(column.dtype):
+        return column.to_numpy(dtype=np.float64, na_value=np.nan)
+    return pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def _isin(column: pd.Series, values: FrozenSet[str]) -> np.ndarray:
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # Once per category; null (code -1) maps to the trailing True and is left to required
+        allowed = np.append(column.cat.categories.isin(list(values)), True)
+        return allowed[column.cat.codes.to_numpy()]
+    return column.isin(list(values)).to_numpy() | column.isna().to_numpy()
+
+
+def _combined_hash(
+    df: pd.DataFrame, columns: Sequence[str], rows: np.ndarray, combined: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    One 64-bit hash per row in rows over columns, folded into combined when given.
+    Columns are hashed uncategorized: factorizing high-cardinality ids first costs
+    more than it saves.
+    """
+    combined = np.zeros(len(rows), dtype=np.uint64) if combined is None else combined.copy()
+    for name in columns:
+        column = pd.util.hash_pandas_object(df[name], index=False, categorize=False).to_numpy()[rows]
+        combined *= np.uint64(0x100000001B3)  # FNV-1a style multiply-xor fold
+        combined ^= column
+    return combined
+
+
+def _scatter(size: int, rows: np.ndarray) -> np.ndarray:
+    mask = np.zeros(size, dtype=bool)
+    mask[rows] = True
+    return mask
+
+
+def evaluate(df: pd.DataFrame, rules: RuleSet) -> Tuple[np.ndarray, List[str]]:
+    """
+    One uint64 of failed-check bits per row of df (0 for rows passing every rule),
+    and the reason code of each bit.
+    """
+    bits = np.zeros(len(df), dtype=np.uint64)
+    reasons: List[str] = []
+
+    def flag(reason: str, failed: np.ndarray) -> None:
+        np.bitwise_or(bits, np.uint64(1) << np.uint64(len(reasons)), out=bits, where=failed)
+        reasons.append(reason)
+
+    missing: Dict[str, np.ndarray] = {}
+
+    def isna(name: str) -> np.ndarray:
+        if name not in missing:
+            missing[name] = df[name].isna().to_numpy()
+        return missing[name]
+
+    for name in rules.required:
+        flag(f'missing:{name}', isna(name))
+    for name, check in rules.formats.items():
+        flag(f'format:{name}', ~check(df[name]) & ~isna(name))
+    for name, (low, high) in rules.ranges.items():
+        values = _numeric(df[name])
+        flag(f'not_numeric:{name}', np.isnan(values) & ~isna(name))
+        out_of_range = np.isinf(values)
+        if low is not None:
+            out_of_range |= values < low
+        if high is not None:
+            out_of_range |= values > high
+        flag(f'range:{name}', out_of_range)
+    for name, values in rules.allowed.items():
+        flag(f'allowed:{name}', ~_isin(df[name], values))
+    passed = np.flatnonzero(bits == 0)
+    if len(passed):
+        # 64-bit hashes stand in for the keys and rows, so the passing rows are never copied
+        unique = [name for name in rules.unique if name in df.columns]
+        key_hash = _combined_hash(df, unique, passed)
+        row_hash = _combined_hash(df, [name for name in df.columns if name not in unique], passed, key_hash)
+        repeat = pd.Series(row_hash).duplicated().to_numpy()
+        flag('duplicate', _scatter(len(df), passed[repeat]))
+        if unique and len(unique) < len(df.columns):
+            repeat_key = pd.Series(key_hash).duplicated().to_numpy() & ~repeat
+            flag('duplicate_key', _scatter(len(df), passed[repeat_key]))
+    return bits, reasons
+
+
+def _labels(bits: np.ndarray, reasons: List[str]) -> pd.Categorical:
+    # Each distinct combination of failed checks is spelled out once
+    combinations, inverse = np.unique(bits, return_inverse=True)
+    labels = [','.join(r for i, r in enumerate(reasons) if int(c) >> i & 1) for c in combinations]
+    return pd.Categorical.from_codes(inverse.reshape(-1), labels)
+
+
+def split_rejects(df: pd.DataFrame, rules: Optional[RuleSet] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Split df into the rows passing rules (default: those of its schema's prefix) and
+    the rejected rows. Kept rows are df itself when nothing is rejected. Rejected
+    values are cast to strings, so values of any parsed dtype fit one quarantine
+    table, and a REASONS_COLUMN lists the comma-separated reason codes of each row.
+    """
+    rules = rules or RULES[schema_prefix(df.columns)]
+    bits, reasons = evaluate(df, rules)
+    rejected = np.flatnonzero(bits)
+    if not len(rejected):
+        return df, pd.DataFrame(columns=[*df.columns, REASONS_COLUMN], dtype='string')
+    kept = df.take(np.flatnonzero(bits == 0))
+    quarantined = df.take(rejected).astype('string')
+    quarantined[REASONS_COLUMN] = _labels(bits[rejected], reasons)
+    return kept, quarantined
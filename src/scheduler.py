@@ -0,0 +1,139 @@
+import logging
+import os
+import re
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from .config import MERGE_WORKERS, PROD_TABLE_TEMPLATE
+from .transform import load_to_prod
+
+logger = logging.getLogger(__name__)
+
+_CODE_IN_NAME = re.compile(r'^([A-Z]{2}\d{3})')
+
+
+def production_code_of_key(key: str) -> Optional[str]:
+    """
+    The Production Code an object's file name starts with (e.g. raw/AB001_7.csv ->
+    AB001), or None when the name does not say.
+    """
+    match = _CODE_IN_NAME.match(os.path.basename(key))
+    return match.group(1) if match else None
+
+
+class MergeScheduler:
+    """
+    Queues the prod merge of each stg_<code> table as soon as no file that may still
+    write to it is outstanding, so merges overlap with the loading of other codes.
+    In a key-ordered listing a code is complete once the listing moves past it; if
+    keys arrive out of order (sharded listings, work queues, one code under several
+    directories), merges wait for the whole listing instead.
+    Files are expected to write the code their name starts with
+    (production_code_of_key); a file whose name gives no code holds back every merge
+    until it is done. Merges run on up to max_workers pooled connections, and merges
+    into the same target are serialized. If a file still writes a table after its
+    merge was queued (a mixed file named for another code), the table is merged again
+    in full once everything has loaded, so no late row is left below the watermark.
+    """
+
+    def __init__(
+        self,
+        engine: Any,
+        max_workers: int = MERGE_WORKERS,
+        target_template: str = PROD_TABLE_TEMPLATE,
+        code_of: Callable[[str], Optional[str]] = production_code_of_key,
+        merge: Callable[..., None] = load_to_prod,
+    ):
+        self.engine = engine
+        self.target_template = target_template
+        self.code_of = code_of
+        self.merge = merge
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='merge')
+        self._lock = threading.Lock()
+        self._target_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+        self._pending: Dict[str, int] = defaultdict(int)  # outstanding files per hinted code (None: unknown)
+        self._listing_done = False
+        self._listed: Set[Optional[str]] = set()  # Codes the key-ordered listing has moved past
+        self._ordered = True
+        self._last_listed: Optional[Tuple[str, Optional[str]]] = None  # (key, code)
+        self._written: Set[str] = set()
+        self._queued: Set[str] = set()
+        self._late: Set[str] = set()
+        self._futures: List[Future] = []
+        self.merges: Dict[str, Dict[str, Any]] = {}
+
+    def track(self, objects: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Pass listing entries through, registering each as outstanding before it is
+        handed on; the listing counts as complete once objects is exhausted.
+        """
+        for obj in objects:
+            code = self.code_of(obj['Key'])
+            with self._lock:
+                self._pending[code] += 1
+                if self._ordered and self._last_listed is not None:
+                    last_key, last_code = self._last_listed
+                    if obj['Key'] < last_key or code in self._listed:
+                        logger.info("Listing is not key-ordered; prod merges wait for all of it")
+                        self._ordered = False
+                        self._listed.clear()
+                    elif code != last_code:
+                        self._listed.add(last_code)
+                        self._queue_ready()
+                self._last_listed = (obj['Key'], code)
+            yield obj
+        with self._lock:
+            self._listing_done = True
+            self._queue_ready()
+
+    def file_done(self, result: Dict[str, Any]) -> None:
+        """
+        Record a file's final result and queue every merge it unblocks.
+        """
+        with self._lock:
+            self._pending[self.code_of(result['key'])] -= 1
+            for table_name in result['tables']:
+                if table_name in self._queued:
+                    logger.warning(f"{result['key']} wrote {table_name} after its merge was queued")
+                    self._late.add(table_name)
+                self._written.add(table_name)
+            self._queue_ready()
+
+    def wait(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Queue the remaining merges once loading is over and block until all have run.
+        Returns the outcome (status, error) per staging table.
+        """
+        with self._lock:
+            self._listing_done = True
+            self._pending.clear()
+            self._queue_ready()
+        for future in list(self._futures):
+            future.result()
+        for table_name in sorted(self._late):
+            self._run_merge(table_name, incremental=False)
+        self._executor.shutdown()
+        return self.merges
+
+    def _queue_ready(self) -> None:
+        if self._pending.get(None, 0) > 0:
+            return
+        for table_name in sorted(self._written - self._queued):
+            code = table_name[len('stg_'):]
+            if (not self._listing_done and code not in self._listed) or self._pending.get(code, 0) > 0:
+                continue
+            self._queued.add(table_name)
+            logger.info(f"Queueing prod merge of {table_name}")
+            self._futures.append(self._executor.submit(self._run_merge, table_name))
+
+    def _run_merge(self, table_name: str, incremental: bool = True) -> None:
+        target_table = self.target_template.format(code=table_name[len('stg_'):])
+        with self._target_locks[target_table]:
+            try:
+                self.merge(table_name, target_table, engine=self.engine, incremental=incremental)
+            except Exception as e:
+                logger.error(f"Prod merge of {table_name} into {target_table} failed: {e}")
+                self.merges[table_name] = {'target': target_table, 'status': 'failed', 'error': str(e)}
+                return
+        self.merges[table_name] = {'target': target_table, 'status': 'merged', 'error': None}
@@ -0,0 +1,381 @@
+"""
+Multi-core staged ingestion, used by process_file unless RunContext.parse_workers is 0.
+
+Parsing, validation and cleaning are CPU-bound and hold the GIL, so with threads
+alone a run keeps about one core busy. Here each file passes three stages that run
+concurrently:
+
+- download threads fetch the whole object into a shared-memory segment;
+- a pool of worker processes parses, validates and cleans it, and hands the
+  cleaned (and quarantined) rows back as Arrow IPC streams in shared memory, so
+  neither the raw bytes nor the DataFrames are pickled through the pool's pipe;
+- loader threads rebuild the frames and stage them as process_single_file does
+  (coalesced, deduplicated, leased or quarantined as the run's context says).
+
+Files are admitted from the listing only while fewer than max_files files and
+max_bytes of raw object data are in flight, so a slow stage backs up into the
+listing rather than into memory.
+"""
+import logging
+import multiprocessing
+import os
+import pickle
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import pandas as pd
+from .config import EXPECTED_SCHEMAS, HEADER_PEEK_BYTES, STAGED_MAX_BYTES
+from .clean_and_load import (
+    RunContext, _cache_variant, _file_result, _finish, _load_clean, _needs_prevalidation, validate_and_clean,
+)
+from .extract import HAS_PYARROW, download_bytes, parse_csv_bytes, prevalidate_csv_schema
+from .retry import call_with_retry
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SharedBuffer:
+    """
+    Name and size of a shared-memory segment passed between processes, holding raw
+    bytes, an Arrow IPC stream or (without pyarrow) a pickle. Segments are not
+    tracked by the resource tracker: whoever consumes one unlinks it.
+    """
+    name: str
+    size: int
+    format: str = 'raw'
+
+    @classmethod
+    def allocate(cls, size: int, format: str) -> Tuple['SharedBuffer', SharedMemory]:
+        shm = SharedMemory(create=True, size=max(1, size), track=False)
+        return cls(shm.name, size, format), shm
+
+    @classmethod
+    def from_bytes(cls, data: bytes, format: str = 'raw') -> 'SharedBuffer':
+        buffer, shm = cls.allocate(len(data), format)
+        try:
+            shm.buf[:len(data)] = data
+        except BaseException:
+            shm.unlink()
+            raise
+        finally:
+            shm.close()
+        return buffer
+
+    @contextmanager
+    def view(self) -> Iterator[memoryview]:
+        """
+        The segment's bytes; release everything derived from them before leaving.
+        """
+        shm = SharedMemory(name=self.name, track=False)
+        data = shm.buf[:self.size]
+        try:
+            yield data
+        finally:
+            data.release()
+            shm.close()
+
+    def unlink(self) -> None:
+        try:
+            shm = SharedMemory(name=self.name, track=False)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+
+def _write_stream(sink: Any, table: Any) -> None:
+    import pyarrow as pa
+
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def share_frame(df: pd.DataFrame) -> SharedBuffer:
+    """
+    Write df into a new shared-memory segment as an Arrow IPC stream (a pickle
+    without pyarrow). The stream is sized with a mock write first, then written
+    straight into the segment.
+    """
+    if not HAS_PYARROW:
+        return SharedBuffer.from_bytes(pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL), 'pickle')
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.MockOutputStream()
+    _write_stream(sink, table)
+    buffer, shm = SharedBuffer.allocate(sink.size(), 'arrow')
+    try:
+        target = pa.py_buffer(shm.buf)
+        _write_stream(pa.FixedSizeBufferWriter(target), table)
+        del target
+    except BaseException:
+        shm.unlink()
+        raise
+    finally:
+        shm.close()
+    return buffer
+
+
+def read_frame(buffer: SharedBuffer) -> pd.DataFrame:
+    """
+    Copy the frame share_frame wrote out of its segment, then unlink the segment.
+    """
+    try:
+        with buffer.view() as data:
+            if buffer.format == 'pickle':
+                return pickle.loads(data)
+            import pyarrow as pa
+
+            # to_pandas() shares some column buffers with the stream, so read a private copy
+            return pa.ipc.open_stream(pa.py_buffer(bytes(data))).read_all().to_pandas()
+    finally:
+        buffer.unlink()
+
+
+def parse_and_clean(item: str, body: SharedBuffer, low_memory: bool, quarantine: bool) -> Dict[str, Any]:
+    """
+    Worker-process stage: parse, validate and clean the object in body. Returns
+    {'final': result} when the file ends here, or {'frames': [clean, rejected]} as
+    shared frames (rejected is None without quarantine), with the 'stages' timed
+    meanwhile for the parent's run metrics.
+    """
+    recorder = metrics.RunMetrics()
+    outcome: Dict[str, Any] = {}
+    with metrics.activate(recorder):
+        try:
+            with body.view() as data:
+                df = parse_csv_bytes(data, item)
+            final, df_clean, rejected = validate_and_clean(df, item, low_memory, quarantine)
+            del df
+            if final is not None:
+                outcome['final'] = final
+            else:
+                outcome['frames'] = [share_frame(df_clean), None if rejected is None else share_frame(rejected)]
+        except Exception as e:
+            logger.error(f"Failed to process file {item}: {e}")
+            outcome['final'] = _file_result(item, 'failed', error=str(e))
+    outcome['stages'] = {name: dict(stats) for name, stats in recorder.stages.items()}
+    return outcome
+
+
+_pools: Dict[int, ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def parse_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    The pool of this many parse processes, started on first use and kept for later
+    runs (e.g. watch micro-batches) so workers import pandas once. Workers are
+    spawned rather than forked, as the parent runs download and loader threads.
+    """
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        return _pools[workers]
+
+
+def _discard_pool(workers: int, pool: ProcessPoolExecutor) -> None:
+    # A broken pool has already terminated its workers (and shutting it down from one
+    # of its own callbacks would deadlock): just start a fresh one next time
+    with _pools_lock:
+        if _pools.get(workers) is pool:
+            del _pools[workers]
+
+
+def shutdown_parse_pools() -> None:
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+
+class _Admission:
+    """
+    Files and raw bytes in flight. admit() blocks while either limit is reached; a
+    file larger than max_bytes is still admitted once nothing else is in flight.
+    """
+
+    def __init__(self, max_files: int, max_bytes: int):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.files = 0
+        self.bytes = 0
+        self._cond = threading.Condition()
+
+    def admit(self, nbytes: int) -> None:
+        with self._cond:
+            while self.files and (self.files >= self.max_files or self.bytes + nbytes > self.max_bytes):
+                self._cond.wait()
+            self.files += 1
+            self.bytes += nbytes
+
+    def release(self, nbytes: int) -> None:
+        with self._cond:
+            self.files -= 1
+            self.bytes -= nbytes
+            self._cond.notify_all()
+
+    def drain(self) -> None:
+        with self._cond:
+            while self.files:
+                self._cond.wait()
+
+
+class _StagedRun:
+    def __init__(
+        self, s3_client: Any, bucket_name: str, ctx: RunContext, download_workers: int, parse_workers: int,
+        max_bytes: int,
+    ):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.ctx = ctx
+        self.download_workers = download_workers
+        self.parse_workers = parse_workers
+        self.admission = _Admission(download_workers + 2 * parse_workers, max_bytes)
+        self.results: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def run(self, objects: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        self.parsers = parse_pool(self.parse_workers)
+        # Loaders close last: files still downloading or parsing when the listing fails hand over to them
+        with ThreadPoolExecutor(self.download_workers, thread_name_prefix='load') as self.loaders, \
+                ThreadPoolExecutor(self.download_workers, thread_name_prefix='download') as self.downloads:
+            try:
+                for obj in objects:
+                    self.admission.admit(obj.get('Size') or 0)
+                    self.downloads.submit(self._download, obj)
+            finally:
+                self.admission.drain()
+        return self.results
+
+    def _download(self, obj: Dict[str, Any]) -> None:
+        key = obj['Key']
+        try:
+            with metrics.current_file(key):
+                outcome = self._fetch(obj)
+            if 'body' in outcome:
+                body, parsers = outcome['body'], self.parsers
+                try:
+                    future = parsers.submit(parse_and_clean, key, body, self.ctx.low_memory, self.ctx.quarantine)
+                except Exception as e:
+                    body.unlink()
+                    if isinstance(e, BrokenProcessPool):
+                        self._replace_parsers(parsers)
+                    raise
+                future.add_done_callback(lambda f: self._parsed(obj, body, parsers, f))
+                return
+        except Exception as e:
+            logger.error(f"Failed to process file {key}: {e}")
+            outcome = {'final': _file_result(key, 'failed', error=str(e))}
+        self._submit_load(obj, outcome)
+
+    def _replace_parsers(self, broken: ProcessPoolExecutor) -> None:
+        # A worker died: later files of this run go to a fresh pool
+        _discard_pool(self.parse_workers, broken)
+        with self._lock:
+            if self.parsers is broken:
+                self.parsers = parse_pool(self.parse_workers)
+
+    def _submit_load(self, obj: Dict[str, Any], outcome: Dict[str, Any]) -> None:
+        try:
+            self.loaders.submit(self._load, obj, outcome)
+        except RuntimeError as e:  # The loaders have shut down
+            for frame in outcome.get('frames', []):
+                if isinstance(frame, SharedBuffer):
+                    frame.unlink()
+            logger.error(f"Failed to process file {obj['Key']}: {e}")
+            with self._lock:
+                self.results.append(_file_result(obj['Key'], 'failed', error=str(e)))
+            self.admission.release(obj.get('Size') or 0)
+
+    def _fetch(self, obj: Dict[str, Any]) -> Dict[str, Any]:
+        key, ctx = obj['Key'], self.ctx
+        if ctx.batch_cache is not None and obj.get('ETag') is not None:
+            cached = ctx.batch_cache.get(key, obj['ETag'], _cache_variant(ctx))
+            if cached is not None:
+                cached['processing_ts'] = datetime.now()
+                return {'frames': [cached, None], 'cached': True}
+        if _needs_prevalidation(obj.get('Size'), ctx):
+            valid, res = call_with_retry(
+                lambda: prevalidate_csv_schema(self.s3_client, self.bucket_name, key, EXPECTED_SCHEMAS, HEADER_PEEK_BYTES),
+                's3', ctx.retry_policy, ctx.s3_limiter)
+            if not valid:
+                logger.warning(f"Schema validation failed for {key}: {res}")
+                return {'final': _file_result(key, 'schema_invalid', error=str(res))}
+        data = call_with_retry(lambda: download_bytes(self.s3_client, self.bucket_name, key),
+                               's3', ctx.retry_policy, ctx.s3_limiter)
+        return {'body': SharedBuffer.from_bytes(data)}
+
+    def _parsed(
+        self, obj: Dict[str, Any], body: SharedBuffer, parsers: ProcessPoolExecutor, future: Future
+    ) -> None:
+        # Runs on the pool's result thread: hand over to a loader and return
+        body.unlink()
+        try:
+            outcome = future.result()
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                self._replace_parsers(parsers)
+            logger.error(f"Failed to process file {obj['Key']}: {e}")
+            outcome = {'final': _file_result(obj['Key'], 'failed', error=str(e))}
+        self._submit_load(obj, outcome)
+
+    def _load(self, obj: Dict[str, Any], outcome: Dict[str, Any]) -> None:
+        key, ctx = obj['Key'], self.ctx
+        frames = outcome.get('frames', [])
+        try:
+            with metrics.current_file(key):
+                for name, stats in outcome.get('stages', {}).items():
+                    metrics.record(name, stats['seconds'], int(stats['rows']), int(stats['bytes']))
+                if 'final' in outcome:
+                    result = outcome['final']
+                else:
+                    df_clean, rejected = (f if f is None or isinstance(f, pd.DataFrame) else read_frame(f)
+                                          for f in frames)
+                    result = _load_clean(key, df_clean, ctx, rejected)
+                    if ctx.batch_cache is not None and obj.get('ETag') is not None and not outcome.get('cached') \
+                            and result['status'] != 'failed' and not df_clean.empty:
+                        ctx.batch_cache.put(key, obj['ETag'], df_clean, _cache_variant(ctx))
+        except Exception as e:
+            logger.error(f"Failed to process file {key}: {e}")
+            result = _file_result(key, 'failed', error=str(e))
+        finally:
+            for frame in frames:
+                if isinstance(frame, SharedBuffer):
+                    frame.unlink()  # No-op once read
+        try:
+            if result['status'] != 'buffered':
+                _finish(result, ctx)
+        finally:
+            with self._lock:
+                self.results.append(result)
+            self.admission.release(obj.get('Size') or 0)
+
+
+def run_staged(
+    s3_client: Any,
+    bucket_name: str,
+    objects: Iterable[Dict[str, Any]],
+    ctx: RunContext,
+    download_workers: int,
+    parse_workers: Optional[int] = None,
+    max_bytes: int = STAGED_MAX_BYTES,
+) -> List[Dict[str, Any]]:
+    """
+    Process objects through the staged pipeline: download_workers download and as
+    many loader threads around parse_workers processes (default: one per core).
+    At most download_workers + 2 * parse_workers files and about max_bytes of raw
+    object data are in flight. Chunked reads and per-file profiling are not
+    supported here (process_file falls back to its thread pool for them).
+    Returns one result per object, in completion order.
+    """
+    parse_workers = parse_workers or os.cpu_count() or 1
+    return _StagedRun(s3_client, bucket_name, ctx, download_workers, parse_workers, max_bytes).run(objects)
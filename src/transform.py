@@ -1,114 +1,168 @@
-from sqlalchemy import create_engine, text
-from .config import DB_URI
-
-
-engine = create_engine(DB_URI)
-
-def file1_merge_query(source_table, target_table):
-    return f'''
-    with cte as(
-        select 
-            MD5(CONCAT("Production Code","Unit ID")) as id,
-            cast("Production Code" as varchar(5))as production_code,
-            cast("Unit ID" as varchar(25))as unit_id,
-            cast("Column A Stage A" as float) as column_a_stage_a,
-            cast("Column B Stage A" as float) as column_b_stage_a,
-            cast("Column C Stage A" as float) as column_c_stage_a,
-            cast("Column D Stage A" as float) as column_d_stage_a,
-            processing_ts
-        from {source_table})
-    MERGE into {target_table} target 
-    using cte src
-    on target.id = src.id
-    when matched then
-        update set 
-        target.column_a_stage_a = src.column_a_stage_a,
-        target.column_b_stage_a = src.column_b_stage_a,
-        target.column_c_stage_a = src.column_c_stage_a,
-        target.column_d_stage_a = src.column_d_stage_a
-    when not matched then
-        insert (id, production_code,unit_id,column_a_stage_a,column_b_stage_a, column_c_stage_a, column_d_stage_a,updated_at)	
-        values(src.id, src.production_code,src.unit_id,src.column_a_stage_a,src.column_b_stage_a, src.column_c_stage_a, src.column_d_stage_a,current_timestamp())
-    '''
-def file3_merge_query(source_table, target_table):
-    return f'''
-    with cte as(
-        select 
-            MD5(CONCAT("Production Code","Parent ID","Child Position")) as id,
-            cast("Production Code" as varchar(5))as production_code,
-            cast("Parent ID" as varchar(25))as parent_id,
-            cast("Child Position" as varchar(5)) as child_position,
-            concat("Parent ID","Child Position") as unit_id,
-            cast("Comment" as varchar(255)) as comment,
-            cast("Column A Stage A" as float) as column_a_stage_a,
-            cast("Column B Stage A" as float) as column_b_stage_a,
-            cast("Column C Stage A" as float) as column_c_stage_a,
-            processing_ts
-        from {source_table}
-    ),
-    pivot as(
-        select 
-            id,
-            production_code,
-            parent_id,
-            child_position,
-            unit_id,
-            AVG((column_a_stage_a + column_b_stage_a + column_c_stage_a) / 3.0) FILTER (WHERE comment = 'Comment') AS "comment",
-            AVG((column_a_stage_a + column_b_stage_a + column_c_stage_a) / 3.0) FILTER (WHERE comment = 'test') AS "test",
-            AVG((column_a_stage_a + column_b_stage_a + column_c_stage_a) / 3.0) FILTER (WHERE comment = 'This is not Real') AS "this_is_not_real"
-            ,processing_ts
-        FROM cte
-        GROUP BY
-            id,
-            production_code,
-            parent_id,
-            child_position,
-            unit_id,
-            processing_ts)
-    MERGE into {target_table} target 
-    using pivot src
-    on target.id = src.id
-    when matched then
-        update set 
-        target.comment = src.comment,
-        target.test = src.test,
-        target.this_is_not_real = src.this_is_not_real
-    when not matched then
-        insert (id, production_code,parent_id,child_position,unit_id,comment, test, this_is_not_real,updated_at)	
-        values(src.id, src.production_code,src.parent_id,src.child_position,src.unit_id,src.comment,src.test, src.this_is_not_real,current_timestamp())
-    '''
-
-def file2_merge_query(source_table, target_table):
-    return f'''
-    with cte as(
-        select 
-            MD5(CONCAT("Production Code","Parent ID","Child Position","Operator")) as id,
-            cast("Production Code" as varchar(5))as production_code,
-            cast("Parent ID" as varchar(25))as parent_id,
-            cast("Child Position" as varchar(5)) as child_position,
-            concat("Parent ID","Child Position") as unit_id,
-            cast("Operator" as varchar(255)) as operator,
-            cast("Column A Stage A" as float) as column_a_stage_a,
-            processing_ts
-        from {source_table})
-    MERGE into {target_table} target 
-    using cte src
-    on target.id = src.id
-    when matched then
-        update set 
-        target.column_a_stage_a = src.column_a_stage_a,
-    when not matched then
-        insert (id, production_code,parent_id,child_position,unit_id,operator,column_a_stage_a,,updated_at)	
-        values(src.id, src.production_code,src.parent_id,src.child_position,src.unit_id,src.operator,src.column_a_stage_a,current_timestamp())
-    '''
-
-
-# with engine.connect() as conn:
-#     conn.execute(text(file1_query))
-
-
-
-def load_to_prod(source_table:str, target_table:str, query_func:function) -> None:
-    query = query_func(source_table,target_table)
+import logging
+from datetime import datetime
+from typing import Any, Callable, Optional
+from sqlalchemy import Column, DateTime, MetaData, String, Table, bindparam, create_engine, inspect, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateTable
+from .config import DB_URI, MERGE_BATCH_SIZE
+from .db import upsert
+from .merge import MERGE_SPECS, MergeSpec, merge_query, source_query, spec_for_table, target_ddl, upsert_query
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+# High-water mark on staging processing_ts per prod table, for incremental merges
+merge_watermarks = Table(
+    'merge_watermarks',
+    metadata,
+    Column('target_table', String(255), primary_key=True),
+    Column('high_water_mark', DateTime),
+    Column('updated_at', DateTime),
+)
+
+
+def file1_merge_query(source_table, target_table, where=''):
+    return merge_query(MERGE_SPECS['CD'], source_table, target_table, where)
+
+def file2_merge_query(source_table, target_table, where=''):
+    return merge_query(MERGE_SPECS['AB'], source_table, target_table, where)
+
+def file3_merge_query(source_table, target_table, where=''):
+    return merge_query(MERGE_SPECS['EF'], source_table, target_table, where)
+
+
+def _ts_text(sql: str, params: dict) -> Any:
+    """
+    text() with timestamp parameters bound as DateTime, so SQLite compares them in
+    the same format pandas stored processing_ts in.
+    """
+    return text(sql).bindparams(*(bindparam(k, v, type_=DateTime()) for k, v in params.items()))
+
+
+def get_watermark(conn: Connection, target_table: str) -> Optional[datetime]:
+    return conn.execute(
+        select(merge_watermarks.c.high_water_mark).where(merge_watermarks.c.target_table == target_table)
+    ).scalar()
+
+
+def _create_watermarks(engine: Any) -> None:
+    # Concurrent merges (see MergeScheduler) must not race create_all's check-then-create
+    try:
+        with engine.begin() as conn:
+            conn.execute(CreateTable(merge_watermarks, if_not_exists=True))
+    except DBAPIError:
+        if not inspect(engine).has_table(merge_watermarks.name):
+            raise
+
+
+def _merge_in_batches(
+    engine: Any, spec: MergeSpec, source_table: str, target_table: str, where: str, params: dict, batch_size: int
+) -> int:
+    """
+    Materialize the spec's source rows once in a temporary table numbered by id, then
+    upsert them batch_size ids at a time, committing each batch so row locks on the
+    target are held for one bounded batch rather than the whole merge.
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    batch_table = quote(f"_merge_{target_table}")
+    with engine.begin() as conn:
+        for statement in target_ddl(spec, target_table, quote):
+            conn.execute(text(statement))
     with engine.connect() as conn:
-        conn.execute(text(query))
+        conn.execute(text(f"drop table if exists {batch_table}"))
+        conn.execute(_ts_text(
+            f"create temporary table {batch_table} as "
+            f"select src.*, row_number() over (order by id) as _batch "
+            f"from ({source_query(spec, source_table, where, quote)}) src",
+            params,
+        ))
+        total = conn.execute(text(f"select count(*) from {batch_table}")).scalar()
+        conn.commit()
+        batch = upsert_query(spec, target_table, f"select * from {batch_table} where _batch > :lo and _batch <= :hi",
+                             quote)
+        for lo in range(0, total, batch_size):
+            conn.execute(text(batch), {'lo': lo, 'hi': lo + batch_size})
+            conn.commit()
+        conn.execute(text(f"drop table {batch_table}"))
+        conn.commit()
+    return total
+
+
+def load_to_prod(
+    source_table:str,
+    target_table:str,
+    query_func:Optional[Callable[..., str]] = None,
+    engine:Any = None,
+    incremental:bool = True,
+    retention:Optional[str] = None,
+    spec:Optional[MergeSpec] = None,
+    batch_size:int = MERGE_BATCH_SIZE,
+) -> None:
+    """
+    Merge source_table into target_table, reusing the run's pooled engine when given.
+    By default the merge is generated from spec (or the MERGE_SPECS entry for the
+    stg_<code> prefix of source_table): the target and its unique index on id are
+    created if missing, and staging rows are upserted batch_size ids per transaction.
+    A query_func (source, target, where) -> SQL is instead run as one statement.
+    Staging is append-only, so by default only rows with a processing_ts above the
+    target's high-water mark (kept in merge_watermarks) are hashed, pivoted and
+    merged, and the mark then advances to the newest merged row once every batch has
+    committed; an interrupted merge is redone in full by the next call. Run it after
+    the staging loads it should include have committed: a row committed later with an
+    older processing_ts would fall below the mark. retention='delete' removes the
+    merged rows from staging; retention='archive' first copies them to
+    <source_table>_archive.
+    """
+    if retention not in (None, 'delete', 'archive'):
+        raise ValueError(f"Unknown staging retention '{retention}'")
+    if engine is None:
+        engine = create_engine(DB_URI)
+    if query_func is None:
+        spec = spec or spec_for_table(source_table)
+    if not incremental:
+        with metrics.stage('load_to_prod', table=target_table) as merged:
+            if query_func is None:
+                merged['rows'] = _merge_in_batches(engine, spec, source_table, target_table, '', {}, batch_size)
+                return
+            with engine.begin() as conn:
+                merged['rows'] = max(conn.execute(text(query_func(source_table,target_table))).rowcount, 0)
+        return
+    _create_watermarks(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    source = quote(source_table)
+    with engine.begin() as conn:
+        conn.execute(text(
+            f"create index if not exists {quote(f'ix_{source_table}_processing_ts')} on {source} (processing_ts)"
+        ))
+        low = get_watermark(conn, target_table)
+        high = conn.execute(text(f"select max(processing_ts) from {source}")).scalar()
+    if isinstance(high, str):  # SQLite returns timestamps as text
+        high = datetime.fromisoformat(high)
+    if high is None or (low is not None and high <= low):
+        logger.info(f"No new rows in {source_table} since {low}")
+        return
+    params = {'high': high}
+    where = "where processing_ts <= :high"
+    if low is not None:
+        params['low'] = low
+        where += " and processing_ts > :low"
+    if query_func is None:
+        with metrics.stage('load_to_prod', table=target_table) as merged:
+            merged['rows'] = _merge_in_batches(engine, spec, source_table, target_table, where, params, batch_size)
+    with engine.begin() as conn:
+        if query_func is not None:
+            with metrics.stage('load_to_prod', table=target_table) as merged:
+                merged['rows'] = max(conn.execute(_ts_text(query_func(source_table,target_table,where), params)).rowcount, 0)
+        upsert(conn, merge_watermarks, {
+            'target_table': target_table, 'high_water_mark': high, 'updated_at': datetime.now(),
+        }, ['target_table'])
+        if retention == 'archive':
+            archive = quote(f"{source_table}_archive")
+            conn.execute(text(f"create table if not exists {archive} as select * from {source} where 1 = 0"))
+            conn.execute(_ts_text(f"insert into {archive} select * from {source} where processing_ts <= :high", {'high': high}))
+        if retention in ('archive', 'delete'):
+            conn.execute(_ts_text(f"delete from {source} where processing_ts <= :high", {'high': high}))
+    logger.info(f"Merged {source_table} into {target_table} up to {high}")
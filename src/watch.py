@@ -0,0 +1,237 @@
+"""
+Continuous ingestion: discover new objects by incremental S3 listing or event
+notifications and feed them to the pipeline in micro-batches. Kept free of pandas
+like src.listing; the batch callable brings the pipeline.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import unquote_plus
+from .config import (WATCH_INTERVAL, WATCH_BATCH_FILES, WATCH_BATCH_BYTES, WATCH_BATCH_WINDOW, WATCH_RESCAN_EVERY,
+                     WATCH_RESCAN_OVERLAP)
+from .listing import CSV_SUFFIXES, list_s3_objects
+
+logger = logging.getLogger(__name__)
+
+
+def objects_from_event(event: Dict[str, Any], bucket_name: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Listing entries (Key, ETag, Size, LastModified) for the ObjectCreated records of
+    an S3 event notification (as delivered through SNS/SQS/EventBridge), optionally
+    restricted to bucket_name.
+    """
+    entries = []
+    for record in event.get('Records', []):
+        if not record.get('eventName', '').startswith('ObjectCreated'):
+            continue
+        s3 = record.get('s3', {})
+        if bucket_name and s3.get('bucket', {}).get('name') != bucket_name:
+            continue
+        obj = s3.get('object', {})
+        etag = obj.get('eTag')
+        entry: Dict[str, Any] = {
+            'Key': unquote_plus(obj['key']),  # Keys arrive URL-encoded
+            'ETag': '"' + etag.strip('"') + '"' if etag else None,  # Quoted as in listings
+            'Size': obj.get('size'),
+        }
+        if record.get('eventTime'):
+            entry['LastModified'] = datetime.fromisoformat(record['eventTime'].replace('Z', '+00:00'))
+        entries.append(entry)
+    return entries
+
+
+class LocalEventQueue:
+    """
+    In-process stand-in for an SQS queue of S3 event notifications.
+    """
+
+    def __init__(self) -> None:
+        self._queue: queue.Queue = queue.Queue()
+
+    def send(self, message: Any) -> None:
+        """
+        Enqueue one notification, as a dict or its JSON body.
+        """
+        self._queue.put(json.loads(message) if isinstance(message, (str, bytes)) else message)
+
+    def receive(self, timeout: float) -> List[Dict[str, Any]]:
+        """
+        Wait up to timeout seconds for a notification, then drain every waiting one.
+        """
+        try:
+            messages = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                return messages
+
+
+class Watcher:
+    """
+    Long-running loop handing new objects to process_batch (listing entries in,
+    file results out) in micro-batches. A batch is sent once it holds batch_files
+    objects or batch_bytes bytes, or batch_window seconds after its first object
+    arrived.
+    Without events, each prefix is polled every interval seconds with StartAfter set
+    to the last key seen, so a poll costs one request unless new keys arrived. Keys
+    that sort before the last one seen (e.g. a new code prefix) are only found by
+    the full listing run every rescan_every polls. With events (a LocalEventQueue or
+    anything with the same receive()), notifications are used instead and listings
+    only run for those rescans.
+    An object is handed on once per ETag; failed files are retried by the next rescan.
+    Rescans skip objects last modified more than rescan_overlap seconds before the
+    previous one started, which that listing already saw, so only recent keys are
+    remembered.
+    """
+
+    def __init__(
+        self,
+        s3_client: Any,
+        bucket_name: str,
+        prefixes: Iterable[str],
+        process_batch: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]],
+        interval: float = WATCH_INTERVAL,
+        batch_files: int = WATCH_BATCH_FILES,
+        batch_bytes: int = WATCH_BATCH_BYTES,
+        batch_window: float = WATCH_BATCH_WINDOW,
+        rescan_every: int = WATCH_RESCAN_EVERY,
+        rescan_overlap: float = WATCH_RESCAN_OVERLAP,
+        events: Any = None,
+    ):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefixes = list(prefixes)
+        self.process_batch = process_batch
+        self.interval = interval
+        self.batch_files = batch_files
+        self.batch_bytes = batch_bytes
+        self.batch_window = batch_window
+        self.rescan_every = rescan_every
+        self.rescan_overlap = rescan_overlap
+        self.events = events
+        self._last_key: Dict[str, Optional[str]] = {prefix: None for prefix in self.prefixes}
+        self._seen: Dict[str, Tuple[Optional[str], datetime]] = {}  # key -> (ETag, LastModified) handed on
+        self._retry: Set[str] = set()
+        self._seen_before: Optional[datetime] = None  # Objects modified earlier were handed on already
+        self._next_seen_before: Optional[datetime] = None
+        self._pending: List[Dict[str, Any]] = []
+        self._pending_bytes = 0
+        self._window_start: Optional[float] = None
+        self._polls = 0
+        self._stop = threading.Event()
+        self.batches = 0
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def run(self, max_batches: Optional[int] = None) -> None:
+        """
+        Watch until stop() is called (or max_batches batches were processed); pending
+        objects are processed before returning.
+        """
+        while not self._stop.is_set() and (max_batches is None or self.batches < max_batches):
+            self._add(self._discover())
+            if self._batch_ready():
+                self.flush()
+            elif self.events is None:
+                self._stop.wait(self._wait_time())
+        if self._pending:
+            self.flush()
+
+    def _discover(self) -> List[Dict[str, Any]]:
+        self._polls += 1
+        rescan = self._polls == 1 or (self.rescan_every and self._polls % self.rescan_every == 0)
+        if self.events is not None and not rescan:
+            found = []
+            for message in self.events.receive(timeout=self._wait_time()):
+                found.extend(objects_from_event(message, self.bucket_name))
+            return [obj for obj in found if obj['Key'].startswith(tuple(self.prefixes))
+                    and obj['Key'].endswith(CSV_SUFFIXES)]
+        return self.poll(full=rescan)
+
+    def poll(self, full: bool = False) -> List[Dict[str, Any]]:
+        """
+        List each prefix after its last seen key (everything when full, less the objects
+        the previous full listing already saw).
+        """
+        if full:
+            self._seen_before = self._next_seen_before
+            if self._seen_before is not None:
+                self._seen = {key: seen for key, seen in self._seen.items() if seen[1] >= self._seen_before}
+            started = datetime.now(timezone.utc)
+        found = []
+        for prefix in self.prefixes:
+            start_after = None if full else self._last_key[prefix]
+            for obj in list_s3_objects(self.s3_client, self.bucket_name, prefix, start_after=start_after):
+                if self._last_key[prefix] is None or obj['Key'] > self._last_key[prefix]:
+                    self._last_key[prefix] = obj['Key']
+                if self._is_new(obj):
+                    found.append(obj)
+        if full:
+            self._next_seen_before = started - timedelta(seconds=self.rescan_overlap)
+        return found
+
+    def _is_new(self, obj: Dict[str, Any]) -> bool:
+        if obj['Key'] in self._retry:
+            return True
+        modified = obj.get('LastModified')
+        if modified is not None and self._seen_before is not None and modified < self._seen_before:
+            return False
+        seen = self._seen.get(obj['Key'])
+        return seen is None or seen[0] != obj.get('ETag')
+
+    def _wait_time(self) -> float:
+        if self._window_start is None:
+            return self.interval
+        return max(0.0, min(self.interval, self._window_start + self.batch_window - time.monotonic()))
+
+    def _add(self, objects: List[Dict[str, Any]]) -> None:
+        for obj in objects:
+            if not self._is_new(obj):
+                continue
+            self._retry.discard(obj['Key'])
+            self._seen[obj['Key']] = (obj.get('ETag'), obj.get('LastModified') or datetime.now(timezone.utc))
+            self._pending.append(obj)
+            self._pending_bytes += obj.get('Size') or 0
+            if self._window_start is None:
+                self._window_start = time.monotonic()
+
+    def _batch_ready(self) -> bool:
+        if not self._pending:
+            return False
+        return (
+            len(self._pending) >= self.batch_files
+            or self._pending_bytes >= self.batch_bytes
+            or time.monotonic() - self._window_start >= self.batch_window
+        )
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """
+        Process the pending objects now; returns their file results.
+        """
+        batch, self._pending, self._pending_bytes, self._window_start = self._pending, [], 0, None
+        start = time.perf_counter()
+        try:
+            results = self.process_batch(batch)
+        except Exception as e:
+            logger.error(f"Micro-batch of {len(batch)} files failed: {e}")
+            results = [{'key': obj['Key'], 'status': 'failed'} for obj in batch]
+        self.batches += 1
+        for result in results:
+            if result['status'] == 'failed':
+                self._seen.pop(result['key'], None)
+                self._retry.add(result['key'])
+        now = datetime.now(timezone.utc)
+        latencies = [(now - obj['LastModified']).total_seconds() for obj in batch if obj.get('LastModified')]
+        logger.info(
+            f"Micro-batch of {len(batch)} files processed in {time.perf_counter() - start:.2f}s"
+            + (f", land-to-staging latency up to {max(latencies):.1f}s" if latencies else '')
+        )
+        return results
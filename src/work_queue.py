@@ -0,0 +1,252 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Integer, MetaData, String, Table, Text, and_, case, create_engine, func, or_,
+    select, update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from .config import WORK_LEASE_SECONDS, WORK_CLAIM_BATCH, WORK_MAX_ATTEMPTS
+from .manifest import DONE_STATUSES
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+ingestion_work_queue = Table(
+    'ingestion_work_queue',
+    metadata,
+    Column('key', String(1024), primary_key=True),
+    Column('etag', String(128)),
+    Column('size', BigInteger),
+    Column('status', String(16), nullable=False, index=True),  # pending, leased, done or failed
+    Column('owner', String(128)),
+    Column('lease_expires', DateTime),
+    Column('attempts', Integer, nullable=False, default=0),
+    Column('outcome', String(32)),  # Status of the last file result
+    Column('rows', BigInteger),
+    Column('error', Text),
+    Column('updated_at', DateTime),
+)
+
+class LeaseLost(Exception):
+    """
+    The worker's lease on a key expired and was claimed by another worker.
+    """
+
+
+def _utcnow() -> datetime:
+    # Lease times are naive UTC from the workers' clocks, which are assumed NTP-synced
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class WorkQueue:
+    """
+    Shared queue of S3 keys in the 'ingestion_work_queue' table, so several nodes
+    can run main.py against the same bucket and ingest each object once.
+    Every node may enqueue its listing (already queued keys with the same ETag and
+    size are left alone; changed objects are queued again). Workers claim batches
+    of keys as leases with UPDATE ... WHERE key IN (SELECT ... FOR UPDATE SKIP
+    LOCKED), so concurrent claims never block on or return the same rows. A lease
+    expires after lease_seconds unless renewed by the owner's heartbeat thread;
+    keys of a crashed worker are then claimed again, up to max_attempts claims;
+    claim() marks keys whose last lease expired failed.
+    complete() only updates keys whose lease the worker still holds; given the
+    staging load's connection it commits in the same transaction, and raises
+    LeaseLost (rolling the load back) when another worker has taken the key over.
+    """
+
+    def __init__(
+        self,
+        engine: Any,
+        owner: Optional[str] = None,
+        lease_seconds: int = WORK_LEASE_SECONDS,
+        batch_size: int = WORK_CLAIM_BATCH,
+        max_attempts: int = WORK_MAX_ATTEMPTS,
+    ):
+        self.engine = engine
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+        metadata.create_all(engine, tables=[ingestion_work_queue])
+
+    @classmethod
+    def from_uri(cls, uri: str, **kwargs: Any) -> 'WorkQueue':
+        return cls(create_engine(uri), **kwargs)
+
+    def shares_database(self, engine: Any) -> bool:
+        """
+        True when engine points at the queue's database, so loads and completions can
+        commit together.
+        """
+        return str(getattr(engine, 'engine', engine).url) == str(self.engine.url)
+
+    def enqueue(self, objects: Iterable[Dict[str, Any]], page_size: int = 1000) -> int:
+        """
+        Queue listed objects in pages of page_size; returns the number listed.
+        """
+        dialect = postgresql if self.engine.dialect.name == 'postgresql' else sqlite
+        listed = 0
+        page: List[Dict[str, Any]] = []
+        for obj in objects:
+            page.append({
+                'key': obj['Key'], 'etag': obj.get('ETag'), 'size': obj.get('Size'),
+                'status': 'pending', 'attempts': 0, 'updated_at': _utcnow(),
+            })
+            if len(page) >= page_size:
+                listed += self._enqueue_page(dialect, page)
+                page = []
+        if page:
+            listed += self._enqueue_page(dialect, page)
+        return listed
+
+    def _enqueue_page(self, dialect: Any, page: List[Dict[str, Any]]) -> int:
+        q = ingestion_work_queue
+        stmt = dialect.insert(q)
+        changed = or_(q.c.etag.is_distinct_from(stmt.excluded.etag), q.c.size.is_distinct_from(stmt.excluded.size))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['key'],
+            set_={name: stmt.excluded[name] for name in ('etag', 'size', 'status', 'attempts', 'updated_at')}
+                 | {'owner': None, 'lease_expires': None},
+            where=changed,
+        )
+        with self.engine.begin() as conn:
+            conn.execute(stmt, page)
+        return len(page)
+
+    def claim(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Lease up to limit (default batch_size) pending or expired keys to this worker.
+        Returns them as listing entries (Key, ETag, Size).
+        """
+        q = ingestion_work_queue
+        now = _utcnow()
+        exhausted = (
+            update(q)
+            .where(and_(q.c.status == 'leased', q.c.lease_expires < now, q.c.attempts >= self.max_attempts))
+            .values(status='failed', owner=None, lease_expires=None, updated_at=now,
+                    error=f"Lease expired after {self.max_attempts} attempts")
+        )
+        claimable = (
+            select(q.c.key)
+            .where(and_(
+                or_(q.c.status == 'pending', and_(q.c.status == 'leased', q.c.lease_expires < now)),
+                q.c.attempts < self.max_attempts,
+            ))
+            .order_by(q.c.key)
+            .limit(limit or self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        stmt = (
+            update(q)
+            .where(q.c.key.in_(claimable.scalar_subquery()))
+            .values(status='leased', owner=self.owner, lease_expires=now + timedelta(seconds=self.lease_seconds),
+                    attempts=q.c.attempts + 1, updated_at=now)
+            .returning(q.c.key, q.c.etag, q.c.size)
+        )
+        with self.engine.begin() as conn:
+            swept = conn.execute(exhausted).rowcount
+            rows = conn.execute(stmt).all()
+        if swept:
+            logger.warning(f"Marked {swept} keys failed after {self.max_attempts} expired leases")
+        if rows:
+            self._start_heartbeat()
+        return [{'Key': key, 'ETag': etag, 'Size': size} for key, etag, size in sorted(rows)]
+
+    def drain(self) -> Iterator[Dict[str, Any]]:
+        """
+        Yield claimed keys batch after batch until nothing is left to claim. The next
+        batch is claimed only once the previous one has been consumed, so a worker
+        holds few more leases than it has files in flight.
+        """
+        while not self._stop.is_set():
+            batch = self.claim()
+            if not batch:
+                return
+            yield from batch
+
+    def renew(self) -> int:
+        """
+        Extend every lease this worker still holds; returns the number renewed.
+        """
+        q = ingestion_work_queue
+        now = _utcnow()
+        with self.engine.begin() as conn:
+            return conn.execute(
+                update(q)
+                .where(and_(q.c.owner == self.owner, q.c.status == 'leased'))
+                .values(lease_expires=now + timedelta(seconds=self.lease_seconds))
+            ).rowcount
+
+    def complete(self, result: Dict[str, Any], conn: Any = None) -> bool:
+        """
+        Record a file result for a key this worker holds: final outcomes mark it done,
+        others put it back in the queue (or mark it failed after max_attempts claims).
+        With conn the update joins the caller's transaction and LeaseLost is raised if
+        the lease is gone; otherwise returns False in that case.
+        """
+        q = ingestion_work_queue
+        values: Dict[str, Any] = {
+            'outcome': result['status'], 'rows': result['rows'], 'error': result['error'], 'updated_at': _utcnow(),
+        }
+        if result['status'] in DONE_STATUSES:  # Any other outcome puts the key back in the queue
+            values['status'] = 'done'
+        else:
+            values.update(
+                status=case((q.c.attempts < self.max_attempts, 'pending'), else_='failed'),
+                owner=None, lease_expires=None,
+            )
+        stmt = (
+            update(q)
+            .where(and_(q.c.key == result['key'], q.c.owner == self.owner, q.c.status == 'leased'))
+            .values(**values)
+        )
+        if conn is not None:
+            if conn.execute(stmt).rowcount == 0:
+                raise LeaseLost(f"Lease on {result['key']} was lost to another worker")
+            return True
+        try:
+            with self.engine.begin() as own:
+                held = own.execute(stmt).rowcount > 0
+        except Exception as e:
+            logger.error(f"Error recording {result['key']} in work queue: {e}")
+            return False
+        if not held:
+            logger.warning(f"Lease on {result['key']} was lost before its result was recorded")
+        return held
+
+    def counts(self) -> Dict[str, int]:
+        """
+        Number of keys per status.
+        """
+        q = ingestion_work_queue
+        with self.engine.connect() as conn:
+            return dict(conn.execute(select(q.c.status, func.count()).group_by(q.c.status)).all())
+
+    def _start_heartbeat(self) -> None:
+        if self._heartbeat is not None:
+            return
+        self._heartbeat = threading.Thread(target=self._renew_leases, name='work-queue-heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    def _renew_leases(self) -> None:
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                self.renew()
+            except Exception as e:
+                logger.warning(f"Could not renew work queue leases: {e}")
+
+    def close(self) -> None:
+        """
+        Stop renewing leases; keys still leased expire and are claimed again.
+        """
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
@@ -0,0 +1,100 @@
+import os
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from benchmarks.stand_ins import FakeS3Client, make_csv, make_frame
+from src.clean_and_load import RunContext, process_file, rebuild_staging_from_cache
+from src.extract import HAS_PYARROW
+
+pytestmark = pytest.mark.skipif(not HAS_PYARROW, reason='pyarrow not installed')
+
+class CountingS3Client(FakeS3Client):
+    def __init__(self):
+        super().__init__()
+        self.gets = []
+    def get_object(self, Bucket, Key, Range=None):
+        self.gets.append(Key)
+        return super().get_object(Bucket, Key, Range)
+
+def test_rerun_reads_cache_instead_of_s3(tmp_path):
+    from src.cache import BatchCache
+    s3 = CountingS3Client()
+    s3.put_object(Bucket='b', Key='raw/AB001_0.csv', Body=make_csv('AB001', 50, dirty_ratio=0.1, seed=1))
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    cache = BatchCache(str(tmp_path / 'cache'))
+    first = process_file(s3, 'b', 'raw/', RunContext(engine=engine, batch_cache=cache))
+    second = process_file(s3, 'b', 'raw/', RunContext(engine=engine, batch_cache=BatchCache(str(tmp_path / 'cache'))))
+    assert s3.gets == ['raw/AB001_0.csv']
+    assert second[0]['status'] == 'loaded' and second[0]['rows'] == first[0]['rows']
+    staged = pd.read_sql_table('stg_AB001', engine)
+    batches = staged.groupby('processing_ts').size()
+    assert list(batches) == [first[0]['rows']] * 2
+    # A new version of the object misses the cache
+    s3.put_object(Bucket='b', Key='raw/AB001_0.csv', Body=make_csv('AB001', 50, seed=2))
+    process_file(s3, 'b', 'raw/', RunContext(engine=engine, batch_cache=cache))
+    assert len(s3.gets) == 2
+
+def test_lru_eviction_and_rebuild(tmp_path):
+    from src.cache import BatchCache
+    cache = BatchCache(str(tmp_path / 'cache'))
+    frames = {f'raw/CD00{i}.csv': make_frame(f'CD00{i}', 200, seed=i) for i in range(1, 4)}
+    for key, df in frames.items():
+        cache.put(key, 'e', df)
+    one_entry = max(cache._sizes.values())
+    cache.max_bytes = 2 * one_entry + one_entry // 2
+    assert cache.get('raw/CD001.csv', 'e') is not None  # CD001 is now most recently used
+    cache.put('raw/CD004.csv', 'e', make_frame('CD004', 200, seed=4))
+    assert cache.get('raw/CD002.csv', 'e') is None
+    assert len(os.listdir(tmp_path / 'cache')) == 2
+    # Survives a restart with the same recency order
+    reopened = BatchCache(str(tmp_path / 'cache'), max_bytes=cache.max_bytes)
+    cached = reopened.get('raw/CD001.csv', 'e')
+    pd.testing.assert_frame_equal(cached, frames['raw/CD001.csv'], check_dtype=False)
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    assert rebuild_staging_from_cache(reopened, engine=engine) == {'stg_CD001': 200, 'stg_CD004': 200}
+    assert rebuild_staging_from_cache(reopened, engine=engine, replace=True) == {'stg_CD001': 200, 'stg_CD004': 200}
+    assert len(pd.read_sql_table('stg_CD001', engine)) == 200
+
+def test_cache_is_kept_per_cleaning_variant(tmp_path):
+    from src.cache import BatchCache
+    s3 = CountingS3Client()
+    s3.put_object(Bucket='b', Key='raw/CD001_0.csv', Body=make_csv('CD001', 100, dirty_ratio=0.2, seed=2))
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    cache = BatchCache(str(tmp_path / 'cache'))
+    [plain] = process_file(s3, 'b', 'raw/', RunContext(engine=engine, batch_cache=cache))
+    [checked] = process_file(s3, 'b', 'raw/', RunContext(engine=engine, batch_cache=cache, quarantine=True))
+    assert len(s3.gets) == 2  # The plain run's frame was not checked against the rules
+    assert checked['quarantined'] == len(pd.read_sql_table('quarantine_CD', engine)) > 0
+    [again] = process_file(s3, 'b', 'raw/', RunContext(engine=engine, batch_cache=cache, quarantine=True))
+    assert len(s3.gets) == 2 and again['rows'] == checked['rows'] != plain['rows']
+    # A rebuild reloads one frame per object
+    assert rebuild_staging_from_cache(cache, engine=engine) == {'stg_CD001': checked['rows']}
+
+@pytest.mark.parametrize('parse_workers', [0, 2])
+def test_failed_load_is_not_cached(tmp_path, monkeypatch, parse_workers):
+    from src import clean_and_load
+    from src.cache import BatchCache
+    from src.retry import RetryPolicy
+    from src.staged import shutdown_parse_pools
+    s3 = FakeS3Client()
+    s3.put_object(Bucket='b', Key='raw/CD001_0.csv', Body=make_csv('CD001', 100, dirty_ratio=0.2, seed=2))
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    ctx = RunContext(engine=engine, batch_cache=BatchCache(str(tmp_path / 'cache')), quarantine=True,
+                     parse_workers=parse_workers, retry_policy=RetryPolicy(attempts=1))
+    load = clean_and_load.load_to_postgres
+
+    def staging_down(df, table_name, engine=None):
+        if table_name.startswith('stg_'):
+            raise RuntimeError('db down')
+        load(df, table_name, engine=engine)
+
+    try:
+        monkeypatch.setattr(clean_and_load, 'load_to_postgres', staging_down)
+        [failed] = process_file(s3, 'b', 'raw/', ctx)
+        monkeypatch.undo()
+        [rerun] = process_file(s3, 'b', 'raw/', ctx)
+    finally:
+        shutdown_parse_pools()
+    assert failed['status'] == 'failed' and rerun['status'] == 'loaded'
+    assert rerun['quarantined'] == failed['quarantined'] > 0  # The rerun checked the rules again
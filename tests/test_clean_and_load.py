@@ -32,7 +32,7 @@ def test_process_file_success(monkeypatch):
     # Mock S3 and extract functions
     s3_client = MagicMock()
     s3_client.list_objects_v2.return_value = {'Contents': [{'Key': 'file.csv'}]}
-    monkeypatch.setattr(clean_and_load, 'list_s3_files', lambda *a, **kw: ['file.csv'])
+    monkeypatch.setattr(clean_and_load, 'list_s3_objects', lambda *a, **kw: [{'Key': 'file.csv'}])
     monkeypatch.setattr(clean_and_load, 'read_csv_file', lambda *a, **kw: pd.DataFrame({'Production Code': ['AB001'], 'a': [1]}))
     monkeypatch.setattr(clean_and_load, 'validate_csv_schema_by_production_code', lambda df, schemas: (True, 'ok'))
     monkeypatch.setattr(clean_and_load, 'drop_invalid_production_codes', lambda df: df)
@@ -42,15 +42,249 @@ def test_process_file_success(monkeypatch):
 
 def test_process_file_schema_fail(monkeypatch):
     s3_client = MagicMock()
-    monkeypatch.setattr(clean_and_load, 'list_s3_files', lambda *a, **kw: ['file.csv'])
+    monkeypatch.setattr(clean_and_load, 'list_s3_objects', lambda *a, **kw: [{'Key': 'file.csv'}])
     monkeypatch.setattr(clean_and_load, 'read_csv_file', lambda *a, **kw: pd.DataFrame({'Production Code': ['AB001'], 'a': [1]}))
     monkeypatch.setattr(clean_and_load, 'validate_csv_schema_by_production_code', lambda df, schemas: (False, 'bad schema'))
     clean_and_load.process_file(s3_client, 'bucket', 'prefix')
 
 def test_process_file_drop_invalid(monkeypatch):
     s3_client = MagicMock()
-    monkeypatch.setattr(clean_and_load, 'list_s3_files', lambda *a, **kw: ['file.csv'])
+    monkeypatch.setattr(clean_and_load, 'list_s3_objects', lambda *a, **kw: [{'Key': 'file.csv'}])
     monkeypatch.setattr(clean_and_load, 'read_csv_file', lambda *a, **kw: pd.DataFrame({'Production Code': ['AB001'], 'a': [1]}))
     monkeypatch.setattr(clean_and_load, 'validate_csv_schema_by_production_code', lambda df, schemas: (True, 'ok'))
     monkeypatch.setattr(clean_and_load, 'drop_invalid_production_codes', lambda df: pd.DataFrame())
-    clean_and_load.process_file(s3_client, 'bucket', 'prefix') 
\ No newline at end of file
+    clean_and_load.process_file(s3_client, 'bucket', 'prefix') 
+
+def test_process_file_returns_result_summary(monkeypatch):
+    s3_client = MagicMock()
+    monkeypatch.setattr(clean_and_load, 'list_s3_objects', lambda *a, **kw: iter([{'Key': 'good.csv'}, {'Key': 'bad.csv'}]))
+    codes = {'good.csv': 'AB001', 'bad.csv': 'CD001'}
+    monkeypatch.setattr(clean_and_load, 'read_csv_file', lambda s3, bucket, key: pd.DataFrame({'Production Code': [codes[key]] * 2, 'a': [1, 2]}))
+    monkeypatch.setattr(clean_and_load, 'validate_csv_schema_by_production_code', lambda df, schemas: (True, 'ok'))
+    monkeypatch.setattr(clean_and_load, 'cleaning_data', lambda df: df)
+    def fake_load(df, table, **kw):
+        if table == 'stg_CD001':
+            raise Exception('db down')
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', fake_load)
+    results = clean_and_load.process_file(s3_client, 'bucket', 'prefix')
+    assert [r['status'] for r in results] == ['loaded', 'failed']
+    assert results[0]['tables'] == {'stg_AB001': 2}
+    assert results[0]['rows'] == 2
+    assert results[1]['error'] == 'db down'
+
+def test_process_file_concurrent(monkeypatch):
+    s3_client = MagicMock()
+    keys = [f'raw/AB{i:03d}.csv' for i in range(20)]
+    monkeypatch.setattr(clean_and_load, 'list_s3_objects', lambda *a, **kw: iter({'Key': k} for k in keys))
+    def fake_read(s3, bucket, key):
+        if key == 'raw/AB007.csv':
+            raise Exception('read error')
+        return pd.DataFrame({'Production Code': [key[4:9]], 'a': [1]})
+    monkeypatch.setattr(clean_and_load, 'read_csv_file', fake_read)
+    monkeypatch.setattr(clean_and_load, 'validate_csv_schema_by_production_code', lambda df, schemas: (True, 'ok'))
+    monkeypatch.setattr(clean_and_load, 'cleaning_data', lambda df: df)
+    loaded = []
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', lambda df, table, **kw: loaded.append(table))
+    results = clean_and_load.process_file(s3_client, 'bucket', 'prefix', clean_and_load.RunContext(max_workers=4))
+    by_key = {r['key']: r for r in results}
+    assert set(by_key) == set(keys)
+    assert by_key['raw/AB007.csv']['status'] == 'failed'
+    assert sum(r['status'] == 'loaded' for r in results) == 19
+    assert len(loaded) == 19
+
+def _csv_client(body):
+    from io import StringIO
+    client = MagicMock()
+    client.get_object.side_effect = lambda Bucket, Key: {'Body': StringIO(body)}
+    return client
+
+CD_CSV = (
+    'Production Code,Unit ID,Column A Stage A,Column B Stage A,Column C Stage A,Column D Stage A\n'
+    'CD001,U1,1,2,3,4\n'
+    'CD001,U2,1,2,3,4\n'
+    'BAD,U3,1,2,3,4\n'
+    'CD001,U1,1,2,3,4\n'
+    'CD001,U4,,2,3,4\n'
+)
+
+def test_process_file_chunked(monkeypatch):
+    loaded = []
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', lambda df, table, **kw: loaded.append((table, df)))
+    result = clean_and_load.process_file_chunked(_csv_client(CD_CSV), 'bucket', 'raw/CD001.csv', chunksize=2)
+    assert result['status'] == 'loaded'
+    assert result['tables'] == {'stg_CD001': 3}
+    assert [len(df) for _, df in loaded] == [2, 1]
+    assert result['rows'] == 3
+    assert len({ts for _, df in loaded for ts in df['processing_ts']}) == 1
+
+def test_process_file_chunked_survives_non_numeric_value(monkeypatch):
+    loaded = []
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', lambda df, table, **kw: loaded.append(df))
+    body = CD_CSV + 'CD001,U5,x,2,3,4\nCD001,U6,1,2,3,4\n'
+    result = clean_and_load.process_file_chunked(_csv_client(body), 'bucket', 'raw/CD001.csv', chunksize=2)
+    assert result['status'] == 'loaded' and result['rows'] == 4
+    assert 'U5' not in set(pd.concat(loaded)['Unit ID'])
+
+@pytest.mark.parametrize('chunksize', [None, 2])
+def test_aliased_header_is_coerced_to_numeric(monkeypatch, chunksize):
+    loaded = []
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', lambda df, table, **kw: loaded.append(df))
+    body = 'Production Code,unit,a,b,c,d\n' + CD_CSV.split('\n', 1)[1] + 'CD001,U5,x,2,3,4\n'
+    if chunksize:
+        result = clean_and_load.process_file_chunked(_csv_client(body), 'bucket', 'raw/CD001.csv', chunksize=chunksize)
+    else:
+        result = clean_and_load.process_single_file(_csv_client(body), 'bucket', 'raw/CD001.csv')
+    assert result['status'] == 'loaded'
+    df = pd.concat(loaded)
+    assert df['Column A Stage A'].dtype == 'float64'
+    assert 'U5' not in set(df['Unit ID'])
+
+def test_process_file_chunked_dedupe_across_chunks(monkeypatch):
+    loaded = []
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', lambda df, table, **kw: loaded.append(df))
+    result = clean_and_load.process_file_chunked(
+        _csv_client(CD_CSV), 'bucket', 'raw/CD001.csv', chunksize=2, dedupe_across_chunks=True)
+    assert result['rows'] == 2
+    assert list(pd.concat(loaded)['Unit ID']) == ['U1', 'U2']
+
+def test_process_file_chunked_schema_fail(monkeypatch):
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', MagicMock())
+    result = clean_and_load.process_file_chunked(
+        _csv_client('Production Code,A\nCD001,1\n'), 'bucket', 'raw/CD001.csv', chunksize=2)
+    assert result['status'] == 'schema_invalid'
+    clean_and_load.load_to_postgres.assert_not_called()
+
+def test_copy_insert_streams_csv_buffer():
+    cursor = MagicMock()
+    cursor.rowcount = 2
+    conn = MagicMock()
+    conn.connection.cursor.return_value.__enter__.return_value = cursor
+    table = MagicMock(schema=None)
+    table.name = 'stg_CD001'
+    rows = clean_and_load.copy_insert(table, conn, ['Production Code', 'a'], iter([('CD001', 1), ('CD001', None)]))
+    sql, buffer = cursor.copy_expert.call_args.args
+    assert sql == 'COPY "stg_CD001" ("Production Code", "a") FROM STDIN WITH CSV'
+    assert buffer.read() == 'CD001,1\r\nCD001,\r\n'
+    assert rows == 2
+
+def test_load_to_postgres_batched_insert_fallback(monkeypatch, tmp_path):
+    from sqlalchemy import create_engine
+    db_uri = f"sqlite:///{tmp_path / 'stg.db'}"
+    monkeypatch.setattr(clean_and_load, 'DB_URI', db_uri)
+    monkeypatch.setattr(clean_and_load, 'INSERT_BATCH_SIZE', 2)
+    df = pd.DataFrame({'Production Code': ['CD001'] * 5, 'a': range(5)})
+    clean_and_load.load_to_postgres(df, 'stg_CD001')
+    assert len(pd.read_sql_table('stg_CD001', create_engine(db_uri))) == 5
+
+def test_staging_buffer_coalesces_per_table(tmp_path):
+    from sqlalchemy import create_engine
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    buffer = clean_and_load.StagingBuffer(engine, max_rows=3)
+    results = [clean_and_load._file_result(f'f{i}.csv', 'loaded', {'stg_CD001': 1}, 1) for i in range(4)]
+    for result in results:
+        buffer.add([('stg_CD001', pd.DataFrame({'Production Code': ['CD001'], 'a': [1]}))], result)
+    assert [r['status'] for r in results] == ['loaded'] * 3 + ['buffered']
+    buffer.flush()
+    assert results[3]['status'] == 'loaded'
+    assert len(pd.read_sql_table('stg_CD001', engine)) == 4
+
+def test_process_file_shares_one_engine(monkeypatch):
+    s3_client = MagicMock()
+    engine = MagicMock()
+    monkeypatch.setattr(clean_and_load, 'list_s3_objects', lambda *a, **kw: iter([{'Key': 'a.csv'}, {'Key': 'b.csv'}]))
+    monkeypatch.setattr(clean_and_load, 'read_csv_file', lambda *a, **kw: pd.DataFrame({'Production Code': ['AB001'], 'a': [1]}))
+    monkeypatch.setattr(clean_and_load, 'validate_csv_schema_by_production_code', lambda df, schemas: (True, 'ok'))
+    engines = []
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', lambda df, table, engine=None: engines.append(engine))
+    clean_and_load.process_file(s3_client, 'bucket', 'prefix', clean_and_load.RunContext(engine=engine))
+    assert engines == [engine, engine]
+    engine.dispose.assert_not_called()
+
+def test_process_single_file_prevalidates_large_objects(monkeypatch):
+    client = MagicMock()
+    monkeypatch.setattr(clean_and_load, 'prevalidate_csv_schema', lambda *a: (False, 'Header mismatch'))
+    ctx = clean_and_load.RunContext(prevalidate_min_bytes=100)
+    result = clean_and_load.process_single_file(client, 'bucket', 'raw/CD001.csv', ctx, size=1000)
+    assert result['status'] == 'schema_invalid'
+    assert result['error'] == 'Header mismatch'
+    client.get_object.assert_not_called()
+
+def test_route_by_production_code():
+    df = pd.DataFrame({'Production Code': ['AB001', 'AB002', 'AB001'], 'a': [1, 2, 3]})
+    routed = dict(clean_and_load.route_by_production_code(df))
+    assert list(routed) == ['stg_AB001', 'stg_AB002']
+    assert list(routed['stg_AB001']['a']) == [1, 3]
+    single = df[df['Production Code'] == 'AB001']
+    assert next(clean_and_load.route_by_production_code(single))[1] is single
+
+def test_process_single_file_routes_mixed_codes(monkeypatch):
+    loaded = {}
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', lambda df, table, **kw: loaded.update({table: len(df)}))
+    body = CD_CSV + 'CD002,U9,1,2,3,4\n'
+    result = clean_and_load.process_single_file(_csv_client(body), 'bucket', 'raw/CD001.csv')
+    assert loaded == {'stg_CD001': 2, 'stg_CD002': 1}
+    assert result['tables'] == loaded
+    assert result['rows'] == 3
+
+def test_staging_buffer_waits_for_every_routed_table(tmp_path):
+    from sqlalchemy import create_engine
+    recorded = []
+    buffer = clean_and_load.StagingBuffer(create_engine(f"sqlite:///{tmp_path / 'stg.db'}"), max_rows=1, on_loaded=recorded.append)
+    result = clean_and_load._file_result('f.csv', 'loaded')
+    buffer.add([('stg_CD001', pd.DataFrame({'a': [1]})), ('stg_CD002', pd.DataFrame({'a': [2]}))], result)
+    assert recorded == [result]
+    assert result['status'] == 'loaded'
+
+def test_clean_low_memory_matches_default_cleaning():
+    from datetime import datetime
+    from benchmarks.stand_ins import make_frame
+    ts = datetime(2025, 1, 1)
+    df = make_frame('AB001', 500, dirty_ratio=0.1, duplicate_ratio=0.2, seed=3)
+    expected = clean_and_load.cleaning_data(clean_and_load.drop_invalid_production_codes(df.copy()), processing_ts=ts)
+    result = clean_and_load.clean_low_memory(df.copy(), processing_ts=ts)
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True),
+                                  check_dtype=False, check_categorical=False)
+
+def test_downcast_frame_is_lossless():
+    df = pd.DataFrame({'x': [0.5, 1.25, None], 'y': [0.1, 0.2, 0.3], 'code': pd.array(['a', 'a', 'b'], dtype='string')})
+    clean_and_load.downcast_frame(df, category_max_ratio=0.7)
+    assert df['x'].dtype == 'float32' and df['y'].dtype == 'float64'
+    assert isinstance(df['code'].dtype, pd.CategoricalDtype)
+
+def test_staging_loads_widen_downcast_floats(monkeypatch):
+    appended = []
+    monkeypatch.setattr(clean_and_load, '_append', lambda df, table, engine: appended.append(df))
+    df = clean_and_load.downcast_frame(pd.DataFrame({'x': [0.5, 1.25]}))
+    clean_and_load.load_to_postgres(df, 'stg_CD001', engine=MagicMock())
+    assert df['x'].dtype == 'float32' and appended[0]['x'].dtype == 'float64'
+
+def test_staging_tables_take_schema_types(tmp_path):
+    from sqlalchemy import create_engine, inspect
+    from sqlalchemy.dialects import postgresql
+    from sqlalchemy.schema import CreateTable
+    df = pd.DataFrame({'Production Code': ['CD001'], 'Unit ID': [7], 'Column A Stage A': [1]})
+    ddl = str(CreateTable(clean_and_load.staging_table(df, 'stg_CD001'), if_not_exists=True)
+              .compile(dialect=postgresql.dialect()))
+    assert 'CREATE TABLE IF NOT EXISTS "stg_CD001"' in ddl
+    assert '"Unit ID" TEXT' in ddl and '"Column A Stage A" FLOAT(53)' in ddl
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    # A rolled-back first load leaves nothing behind that later loads rely on
+    with pytest.raises(ZeroDivisionError), engine.begin() as conn:
+        clean_and_load.load_to_postgres(df, 'stg_CD001', engine=conn)
+        1 / 0
+    clean_and_load.load_to_postgres(df, 'stg_CD001', engine=engine)
+    clean_and_load.load_to_postgres(df.assign(**{'Unit ID': ['U8']}), 'stg_CD001', engine=engine)
+    assert pd.read_sql_table('stg_CD001', engine)['Unit ID'].tolist() == ['7', 'U8']
+    assert [str(c['type']) for c in inspect(engine).get_columns('stg_CD001')][:3] == ['TEXT', 'TEXT', 'FLOAT']
+
+def test_process_file_low_memory(monkeypatch):
+    loaded = []
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', lambda df, table, **kw: loaded.append(df))
+    ctx = clean_and_load.RunContext(low_memory=True)
+    result = clean_and_load.process_single_file(_csv_client(CD_CSV), 'bucket', 'raw/CD001.csv', ctx)
+    assert result['tables'] == {'stg_CD001': 2}
+    loaded.clear()
+    chunked = clean_and_load.process_file_chunked(
+        _csv_client(CD_CSV), 'bucket', 'raw/CD001.csv', chunksize=2, ctx=ctx, dedupe_across_chunks=True)
+    assert chunked['rows'] == 2
+    assert list(pd.concat(loaded)['Unit ID']) == ['U1', 'U2']
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from benchmarks.stand_ins import FakeS3Client, make_csv, make_frame
+from src.clean_and_load import RunContext, process_file
+from src.dedupe import DedupeIndex
+
+def test_drop_seen_only_after_add():
+    index = DedupeIndex()
+    df = make_frame('CD001', 20)
+    kept, fingerprints = index.drop_seen(df, 'stg_CD001')
+    assert len(kept) == 20
+    # In flight in another file until released (e.g. the load failed)
+    assert index.drop_seen(df, 'stg_CD001')[0].empty
+    index.release(fingerprints)
+    kept, fingerprints = index.drop_seen(df, 'stg_CD001')
+    assert len(kept) == 20
+    index.add(fingerprints)
+    assert index.drop_seen(df, 'stg_CD001')[0].empty
+
+def test_changed_values_pass_unless_keys_only():
+    df = make_frame('AB001', 10)
+    changed = df.copy()
+    changed['Column A Stage A'] += 1
+    for keys_only, expected in [(False, 10), (True, 0)]:
+        index = DedupeIndex(keys_only=keys_only)
+        index.add(index.fingerprints(df, 'stg_AB001'))
+        assert len(index.drop_seen(changed, 'stg_AB001')[0]) == expected
+
+def test_fingerprints_ignore_dtype_representation():
+    df = make_frame('EF001', 10)
+    index = DedupeIndex()
+    as_categories = df.astype({'Production Code': 'category', 'Comment': 'category'})
+    assert (index.fingerprints(df, 'stg_EF001') == index.fingerprints(as_categories, 'stg_EF001')).all()
+    # Values low-memory cleaning narrows to float32 hash as they would as float64
+    df['Column A Stage A'] = df['Column A Stage A'].round()
+    narrowed = df.astype({'Column A Stage A': 'float32'})
+    assert (index.fingerprints(df, 'stg_EF001') == index.fingerprints(narrowed, 'stg_EF001')).all()
+
+def test_index_persists_exact_and_bloom(tmp_path):
+    fingerprints = np.arange(1, 5001, dtype=np.uint64) * np.uint64(2654435761)
+    others = fingerprints + np.uint64(1)
+    for name, capacity in [('exact.npz', None), ('bloom.npz', 10000)]:
+        path = str(tmp_path / name)
+        index = DedupeIndex(path, bloom_capacity=capacity, error_rate=0.01)
+        for part in np.array_split(fingerprints, 7):
+            index.add(part)
+        index.save()
+        reopened = DedupeIndex(path, bloom_capacity=capacity)
+        assert reopened._store.contains(fingerprints).all()
+        assert reopened._store.contains(others).mean() < 0.02
+
+def test_replayed_export_is_not_reloaded(tmp_path):
+    s3 = FakeS3Client()
+    body = make_csv('CD001', 100, seed=1)
+    s3.put_object(Bucket='bench', Key='raw/CD001_00000.csv', Body=body)
+    s3.put_object(Bucket='bench', Key='raw/CD001_00001.csv', Body=body)
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    path = str(tmp_path / 'dedupe.npz')
+    results = process_file(s3, 'bench', 'raw/', RunContext(engine=engine, dedupe_index=DedupeIndex(path)))
+    assert [r['rows'] for r in results] == [100, 0]
+    # A later run with the same export loads nothing
+    s3.put_object(Bucket='bench', Key='raw/CD001_00002.csv', Body=body)
+    process_file(s3, 'bench', 'raw/CD001_00002', RunContext(engine=engine, chunksize=30, dedupe_index=DedupeIndex(path)))
+    assert len(pd.read_sql_table('stg_CD001', engine)) == 100
+
+@pytest.mark.parametrize('options', [{'coalesce': True}, {'max_workers': 2}])
+def test_duplicate_files_in_one_run_load_once(tmp_path, options):
+    s3 = FakeS3Client()
+    body = make_csv('CD001', 50, seed=4)
+    s3.put_object(Bucket='bench', Key='raw/CD001_00000.csv', Body=body)
+    s3.put_object(Bucket='bench', Key='raw/CD001_00001.csv', Body=body)
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    results = process_file(s3, 'bench', 'raw/', RunContext(engine=engine, dedupe_index=DedupeIndex(), **options))
+    assert sorted(r['rows'] for r in results) == [0, 50]
+    assert len(pd.read_sql_table('stg_CD001', engine)) == 50
+
+def test_failed_load_releases_in_flight_rows(tmp_path, monkeypatch):
+    from src import clean_and_load
+    s3 = FakeS3Client()
+    s3.put_object(Bucket='bench', Key='raw/CD001.csv', Body=make_csv('CD001', 50, seed=4))
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    index = DedupeIndex()
+    real_load = clean_and_load.load_to_postgres
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', lambda *a, **kw: 1 / 0)
+    assert process_file(s3, 'bench', 'raw/', RunContext(engine=engine, dedupe_index=index))[0]['status'] == 'failed'
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', real_load)
+    assert process_file(s3, 'bench', 'raw/', RunContext(engine=engine, dedupe_index=index))[0]['rows'] == 50
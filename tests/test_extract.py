@@ -1,5 +1,6 @@
 import pytest
 import pandas as pd
+from io import BytesIO, StringIO
 from unittest.mock import MagicMock
 from src import extract
 
@@ -14,10 +15,50 @@ class DummyS3Client:
             return {'Body': StringIO('Production Code,Unit ID\nAB001,123')}
         raise Exception('File not found')
 
+class PagedS3Client:
+    def __init__(self, files, page_size=2):
+        self.files = files
+        self.page_size = page_size
+        self.calls = []
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        self.calls.append((Prefix, ContinuationToken))
+        matching = [f for f in self.files if f.startswith(Prefix)]
+        start = int(ContinuationToken or 0)
+        end = start + self.page_size
+        response = {'Contents': [{'Key': f} for f in matching[start:end]], 'IsTruncated': end < len(matching)}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(end)
+        return response
+
 def test_list_s3_files():
     client = DummyS3Client(files=['a.csv', 'b.txt', 'c.csv'])
     result = extract.list_s3_files(client, 'bucket', 'prefix')
-    assert result == ['a.csv', 'c.csv']
+    assert list(result) == ['a.csv', 'c.csv']
+
+def test_list_s3_files_follows_continuation_tokens():
+    files = [f'raw/AB{i:03d}.csv' for i in range(5)] + ['raw/notes.txt']
+    client = PagedS3Client(files, page_size=2)
+    result = list(extract.list_s3_files(client, 'bucket', 'raw/'))
+    assert result == files[:5]
+    assert [token for _, token in client.calls] == [None, '2', '4']
+
+def test_list_s3_files_is_lazy():
+    client = PagedS3Client([f'raw/AB{i:03d}.csv' for i in range(6)], page_size=2)
+    keys = extract.list_s3_files(client, 'bucket', 'raw/')
+    assert next(keys) == 'raw/AB000.csv'
+    assert len(client.calls) == 1
+
+def test_list_s3_files_by_prefixes():
+    files = ['raw/AB001.csv', 'raw/AB002.csv', 'raw/CD001.csv', 'raw/EF001.csv', 'raw/ZZ001.csv']
+    client = PagedS3Client(files, page_size=1)
+    result = list(extract.list_s3_files_by_prefixes(client, 'bucket', 'raw/', ['AB', 'CD', 'EF']))
+    assert sorted(result) == files[:4]
+
+def test_list_s3_files_by_prefixes_propagates_errors():
+    client = MagicMock()
+    client.list_objects_v2.side_effect = Exception('denied')
+    with pytest.raises(Exception, match='denied'):
+        list(extract.list_s3_files_by_prefixes(client, 'bucket', 'raw/', ['AB']))
 
 def test_is_valid_csv_filename():
     assert extract.is_valid_csv_filename('dir/AB001.csv', 'dir', 'AB')
@@ -76,7 +117,143 @@ def test_drop_invalid_production_codes():
     filtered = extract.drop_invalid_production_codes(df)
     assert all(filtered['Production Code'].str.match(r'^[A-Z]{2}\d{3}$'))
 
+def test_drop_invalid_production_codes_fixed_width():
+    codes = ['AB001', 'ab001', 'AB0012', 'AB00', None, 'AB 01', 'ÄB001', 123]
+    df = pd.DataFrame({'Production Code': codes, 'i': range(len(codes))})
+    assert list(extract.drop_invalid_production_codes(df)['i']) == [0]
+    categorical = df.astype({'Production Code': 'category'})
+    assert list(extract.drop_invalid_production_codes(categorical)['i']) == [0]
+
+def test_drop_invalid_production_codes_all_valid_returns_frame():
+    df = pd.DataFrame({'Production Code': ['AB001', 'CD002']})
+    assert extract.drop_invalid_production_codes(df) is df
+
 def test_drop_invalid_production_codes_missing_column():
     df = pd.DataFrame({'A': [1]})
     with pytest.raises(ValueError):
-        extract.drop_invalid_production_codes(df) 
\ No newline at end of file
+        extract.drop_invalid_production_codes(df) 
+
+def test_read_csv_chunks():
+    client = MagicMock()
+    from io import StringIO
+    client.get_object.return_value = {'Body': StringIO('Production Code,Unit ID\nAB001,1\nAB001,2\nAB001,3\n')}
+    chunks = list(extract.read_csv_chunks(client, 'bucket', 'key.csv', chunksize=2))
+    assert [len(c) for c in chunks] == [2, 1]
+
+class RangedS3Client:
+    def __init__(self, body):
+        self.body = body.encode()
+        self.ranges = []
+    def get_object(self, Bucket, Key, Range=None):
+        from io import BytesIO
+        self.ranges.append(Range)
+        if Range:
+            start, end = map(int, Range[len('bytes='):].split('-'))
+            return {'Body': BytesIO(self.body[start:end + 1])}
+        return {'Body': BytesIO(self.body)}
+
+def test_read_csv_header_drops_partial_row():
+    client = RangedS3Client('Production Code,Unit ID\nCD001,U1\nCD001,U2\n')
+    head = extract.read_csv_header(client, 'bucket', 'key.csv', max_bytes=36)
+    assert client.ranges == ['bytes=0-35']
+    assert list(head.columns) == ['Production Code', 'Unit ID']
+    assert list(head['Unit ID']) == ['U1']
+
+def test_prevalidate_csv_schema_rejects_with_same_message():
+    body = 'Production Code,Unit ID\nCD001,U1\n' + 'CD001,U2\n' * 1000
+    schemas = {'CD': ['Production Code', 'Unit ID', 'Column A Stage A']}
+    valid, msg = extract.prevalidate_csv_schema(RangedS3Client(body), 'bucket', 'key.csv', schemas, max_bytes=64)
+    full_valid, full_msg = extract.validate_csv_schema_by_production_code(pd.read_csv(StringIO(body)), schemas)
+    assert not valid and not full_valid
+    assert msg == full_msg
+
+def test_prevalidate_csv_schema_inconclusive_passes():
+    body = 'Production Code,Unit ID\n,U1\nCD001,U2\n'
+    valid, _ = extract.prevalidate_csv_schema(RangedS3Client(body), 'bucket', 'key.csv', {'CD': []}, max_bytes=30)
+    assert valid
+
+TYPED_CSV = 'Production Code,Unit ID,Column A Stage A\nCD001,123,1.5\nCD001,124,2\n'
+
+def test_csv_dtypes():
+    schemas = {'CD': [('Production Code', 'string', True), ('Unit ID', 'string', False), ('Column A Stage A', 'float64', False)]}
+    assert extract.csv_dtypes(schemas) == {'Production Code': 'category', 'Unit ID': 'string', 'Column A Stage A': 'float64'}
+    assert extract.csv_dtypes(schemas, 'pyarrow')['Column A Stage A'] == 'double[pyarrow]'
+
+def test_read_csv_file_applies_schema_dtypes():
+    client = MagicMock()
+    client.get_object.side_effect = lambda Bucket, Key: {'Body': StringIO(TYPED_CSV)}
+    df = extract.read_csv_file(client, 'bucket', 'raw/CD001.csv')
+    assert isinstance(df['Production Code'].dtype, pd.CategoricalDtype)
+    assert df['Unit ID'].tolist() == ['123', '124']
+    assert df['Column A Stage A'].dtype == 'float64'
+
+def test_read_csv_file_coerces_untyped_values():
+    client = MagicMock()
+    client.get_object.side_effect = lambda Bucket, Key: {'Body': StringIO(TYPED_CSV + 'CD001,125,n/a?\n')}
+    df = extract.read_csv_file(client, 'bucket', 'raw/CD001.csv')
+    assert df['Column A Stage A'].dtype == 'float64' and df['Column A Stage A'].isna().tolist() == [False, False, True]
+    assert client.get_object.call_count == 1
+
+def test_read_csv_chunks_coerce_untyped_values():
+    client = MagicMock()
+    client.get_object.side_effect = lambda Bucket, Key: {'Body': StringIO(TYPED_CSV + 'CD001,125,n/a?\n')}
+    chunks = list(extract.read_csv_chunks(client, 'bucket', 'raw/CD001.csv', chunksize=2))
+    assert [c['Column A Stage A'].dtype for c in chunks] == ['float64', 'float64']
+    assert chunks[1]['Column A Stage A'].isna().all()
+
+def test_read_csv_file_pyarrow_engine(monkeypatch):
+    pytest.importorskip('pyarrow')
+    monkeypatch.setattr(extract, 'CSV_ENGINE', 'pyarrow')
+    monkeypatch.setattr(extract, 'CSV_DTYPE_BACKEND', 'pyarrow')
+    client = MagicMock()
+    client.get_object.side_effect = lambda Bucket, Key: {'Body': BytesIO(TYPED_CSV.encode())}
+    df = extract.read_csv_file(client, 'bucket', 'raw/CD001.csv')
+    assert str(df['Column A Stage A'].dtype) == 'double[pyarrow]'
+    assert isinstance(df['Production Code'].dtype, pd.CategoricalDtype)
+    client.get_object.side_effect = lambda Bucket, Key: {'Body': BytesIO(TYPED_CSV.encode() + b'CD001,125,n/a?\n')}
+    df = extract.read_csv_file(client, 'bucket', 'raw/CD001.csv')
+    assert str(df['Column A Stage A'].dtype) == 'double[pyarrow]' and df['Column A Stage A'].isna().sum() == 1
+
+def _compress(data, suffix):
+    import bz2, gzip
+    if suffix == '.csv.zst':
+        return pytest.importorskip('zstandard').ZstdCompressor().compress(data)
+    return gzip.compress(data) if suffix == '.csv.gz' else bz2.compress(data)
+
+def test_list_s3_files_includes_compressed():
+    client = DummyS3Client(files=['a.csv', 'b.csv.gz', 'c.csv.zst', 'd.csv.bz2', 'e.gz', 'f.csv.xz'])
+    assert list(extract.list_s3_files(client, 'bucket', '')) == ['a.csv', 'b.csv.gz', 'c.csv.zst', 'd.csv.bz2']
+
+def test_is_valid_csv_filename_compressed():
+    assert extract.is_valid_csv_filename('dir/AB001.csv.gz', 'dir', 'AB')
+    assert extract.is_valid_csv_filename('dir/AB001.csv.zst', 'dir', 'AB')
+    assert extract.is_valid_csv_filename('dir/AB001.csv.bz2', 'dir', 'AB')
+    assert not extract.is_valid_csv_filename('dir/AB001.gz', 'dir', 'AB')
+
+@pytest.mark.parametrize('suffix', ['.csv.gz', '.csv.bz2', '.csv.zst'])
+def test_read_compressed_csv(suffix):
+    body = _compress(TYPED_CSV.encode(), suffix)
+    client = RangedS3Client('')
+    client.body = body
+    df = extract.read_csv_file(client, 'bucket', f'raw/CD001{suffix}')
+    pd.testing.assert_frame_equal(df, extract.read_csv_file(RangedS3Client(TYPED_CSV), 'bucket', 'raw/CD001.csv'))
+    chunks = list(extract.read_csv_chunks(client, 'bucket', f'raw/CD001{suffix}', chunksize=1))
+    assert sum(len(c) for c in chunks) == len(df)
+
+def test_read_csv_header_inflates_compressed_prefix():
+    import gzip, random
+    rng = random.Random(0)
+    rows = ''.join(f'CD001,U{rng.random()},{rng.random()}\n' for _ in range(2000))
+    client = RangedS3Client('')
+    client.body = gzip.compress((TYPED_CSV.splitlines(True)[0] + rows).encode())
+    head = extract.read_csv_header(client, 'bucket', 'raw/CD001.csv.gz', max_bytes=4096)
+    assert list(head.columns) == TYPED_CSV.splitlines()[0].split(',')
+    assert 0 < len(head) < 2000
+    assert head.notna().all().all()
+
+def test_prevalidate_csv_schema_passes_without_complete_header():
+    import bz2
+    client = RangedS3Client('')
+    client.body = bz2.compress(TYPED_CSV.encode() * 100)
+    valid, _ = extract.prevalidate_csv_schema(client, 'bucket', 'raw/CD001.csv.bz2', {}, max_bytes=64)
+    assert valid
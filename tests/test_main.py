@@ -0,0 +1,76 @@
+import subprocess
+import sys
+import pytest
+import main
+from benchmarks.stand_ins import FakeS3Client, make_csv
+
+def test_import_and_noop_run_skip_heavy_modules():
+    code = (
+        "import sys, main\n"
+        "class Empty:\n"
+        "    def list_objects_v2(self, **kw): return {'Contents': []}\n"
+        "main.s3_client = Empty\n"
+        "assert main.main(['--bucket', 'b']) == 0\n"
+        "print(sorted(m for m in ('pandas', 'numpy', 'sqlalchemy', 'boto3') if m in sys.modules))\n"
+    )
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == '[]'
+
+def test_plan_lists_and_prevalidates(monkeypatch, capsys):
+    s3 = FakeS3Client()
+    s3.put_object(Bucket='b', Key='raw/CD001_0.csv', Body=make_csv('CD001', 20))
+    s3.put_object(Bucket='b', Key='raw/AB001_1.csv', Body=make_csv('CD001', 20).replace(b'Unit ID', b'Unit ID,Extra', 1))
+    s3.put_object(Bucket='b', Key='raw/notes.txt', Body=b'not a csv')
+    monkeypatch.setattr(main, 's3_client', lambda: s3)
+    assert main.main(['plan', '--bucket', 'b', '--workers', '2']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith('reject') and "Header mismatch for prefix 'CD'" in lines[0]
+    assert lines[1].startswith('ingest') and lines[1].endswith('raw/CD001_0.csv')
+    assert len(lines) == 2
+
+def test_run_passes_listed_objects(monkeypatch):
+    import src.clean_and_load
+    s3 = FakeS3Client()
+    for i in range(3):
+        s3.put_object(Bucket='b', Key=f'raw/CD001_{i}.csv', Body=b'')
+    calls = []
+    monkeypatch.setattr(main, 's3_client', lambda: s3)
+    monkeypatch.setattr(src.clean_and_load, 'process_file', lambda **kw: calls.append(kw) or [])
+    assert main.main(['run', '--bucket', 'b', '--workers', '3', '--coalesce']) == 0
+    assert [obj['Key'] for obj in calls[0]['objects']] == [f'raw/CD001_{i}.csv' for i in range(3)]
+    assert calls[0]['ctx'].max_workers == 3 and calls[0]['ctx'].coalesce
+
+def test_watch_shares_loading_options():
+    args = main.build_parser().parse_args(['watch', '--batch-window', '1.5', '--merge', '--low-memory'])
+    assert args.func is main.watch and args.batch_window == 1.5 and args.merge and args.low_memory
+
+def test_run_rejects_merge_with_work_queue(capsys):
+    with pytest.raises(SystemExit):
+        main.main(['run', '--work-queue-uri', 'sqlite://', '--merge'])
+    assert '--merge cannot be combined with --work-queue-uri' in capsys.readouterr().err
+    with pytest.raises(SystemExit):
+        main.main(['run', '--work-queue-uri', 'sqlite://', '--coalesce'])
+    assert '--coalesce cannot be combined with --work-queue-uri' in capsys.readouterr().err
+
+def test_run_options_match_config_settings():
+    args = main.build_parser().parse_args([
+        'run', '--manifest-uri', 'sqlite:///m.db', '--parse-workers', 'auto',
+        '--metrics-json', 'm.json', '--metrics-prom', 'm.prom', '--profile-dir', 'prof', '--profile-top', '3',
+    ])
+    assert args.manifest_uri == 'sqlite:///m.db' and args.parse_workers is None
+    assert (args.metrics_json, args.metrics_prom, args.profile_dir, args.profile_top) == ('m.json', 'm.prom', 'prof', 3)
+    assert main.build_parser().parse_args(['watch', '--parse-workers', '0']).parse_workers == 0
+
+def test_run_opens_the_given_manifest(monkeypatch):
+    s3 = FakeS3Client()
+    s3.put_object(Bucket='b', Key='raw/CD001_0.csv', Body=make_csv('CD001', 20))
+    opened = []
+    monkeypatch.setattr(main, 's3_client', lambda: s3)
+    monkeypatch.setattr(main, 'open_manifest', lambda uri: opened.append(uri))
+    monkeypatch.setattr(main, 'ingest', lambda *a, **kw: 0)
+    assert main.main(['run', '--bucket', 'b', '--manifest-uri', 'sqlite:///m.db']) == 0
+    assert opened == ['sqlite:///m.db']
+
+def test_plan_reads_the_run_manifest_by_default(monkeypatch):
+    monkeypatch.setattr(main, 'MANIFEST_URI', 'sqlite:///manifest.db')
+    assert main.build_parser().parse_args(['plan']).manifest_uri == 'sqlite:///manifest.db'
@@ -0,0 +1,53 @@
+import pandas as pd
+from io import StringIO
+from src import clean_and_load
+from src.manifest import IngestionManifest
+
+CD_CSV = (
+    'Production Code,Unit ID,Column A Stage A,Column B Stage A,Column C Stage A,Column D Stage A\n'
+    'CD001,U1,1,2,3,4\n'
+)
+
+class ManifestS3Client:
+    def __init__(self, objects):
+        self.objects = objects
+        self.gets = []
+    def list_objects_v2(self, Bucket, Prefix):
+        return {'Contents': list(self.objects.values())}
+    def get_object(self, Bucket, Key):
+        self.gets.append(Key)
+        if Key == 'raw/broken.csv':
+            raise Exception('boom')
+        return {'Body': StringIO(CD_CSV)}
+
+def _obj(key, etag):
+    return {'Key': key, 'ETag': etag, 'Size': len(CD_CSV)}
+
+def test_manifest_skips_unchanged_and_retries_failed(monkeypatch, tmp_path):
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', lambda df, table, **kw: None)
+    uri = f"sqlite:///{tmp_path / 'manifest.db'}"
+    client = ManifestS3Client({
+        'raw/CD001.csv': _obj('raw/CD001.csv', '"a"'),
+        'raw/broken.csv': _obj('raw/broken.csv', '"b"'),
+    })
+    results = clean_and_load.process_file(client, 'bucket', 'raw/', clean_and_load.RunContext(engine=object(), manifest=IngestionManifest.from_uri(uri)))
+    assert {r['key']: r['status'] for r in results} == {'raw/CD001.csv': 'loaded', 'raw/broken.csv': 'failed'}
+
+    client.gets.clear()
+    client.objects['raw/CD002.csv'] = _obj('raw/CD002.csv', '"c"')
+    clean_and_load.process_file(client, 'bucket', 'raw/', clean_and_load.RunContext(engine=object(), manifest=IngestionManifest.from_uri(uri)))
+    assert sorted(client.gets) == ['raw/CD002.csv', 'raw/broken.csv']
+
+    client.gets.clear()
+    client.objects['raw/CD001.csv'] = _obj('raw/CD001.csv', '"changed"')
+    clean_and_load.process_file(client, 'bucket', 'raw/', clean_and_load.RunContext(engine=object(), manifest=IngestionManifest.from_uri(uri)))
+    assert sorted(client.gets) == ['raw/CD001.csv', 'raw/broken.csv']
+
+def test_manifest_records_row_counts(monkeypatch, tmp_path):
+    monkeypatch.setattr(clean_and_load, 'load_to_postgres', lambda df, table, **kw: None)
+    manifest = IngestionManifest.from_uri(f"sqlite:///{tmp_path / 'manifest.db'}")
+    client = ManifestS3Client({'raw/CD001.csv': _obj('raw/CD001.csv', '"a"')})
+    clean_and_load.process_file(client, 'bucket', 'raw/', clean_and_load.RunContext(engine=object(), manifest=manifest))
+    row = pd.read_sql_table('ingestion_manifest', manifest.engine).iloc[0]
+    assert (row['key'], row['etag'], row['size'], row['rows'], row['status']) == (
+        'raw/CD001.csv', '"a"', len(CD_CSV), 1, 'loaded')
@@ -0,0 +1,64 @@
+import io
+import json
+from sqlalchemy import create_engine
+from benchmarks.stand_ins import FakeS3Client, populate_bucket
+from src import metrics
+from src.clean_and_load import RunContext, process_file
+from src.metrics import FileProfiler, MeteredStream, RunMetrics
+
+def test_stage_is_noop_without_active_recorder():
+    with metrics.stage('parse') as counts:
+        counts['rows'] = 3
+    run_metrics = RunMetrics()
+    assert run_metrics.report()['stages'] == {}
+
+def test_stage_records_per_file_and_table():
+    run_metrics = RunMetrics()
+    with metrics.activate(run_metrics), metrics.current_file('raw/a.csv'):
+        with metrics.stage('load', table='stg_AB001') as counts:
+            counts['rows'] = 10
+        metrics.record('download', 0.5, nbytes=100)
+    report = run_metrics.report()
+    assert report['stages']['load']['rows'] == 10
+    assert report['tables']['stg_AB001']['load']['calls'] == 1
+    assert report['files']['raw/a.csv']['download']['bytes'] == 100
+    assert run_metrics.file_seconds('raw/a.csv') >= 0.5
+
+def test_metered_stream_counts_bytes():
+    stream = MeteredStream(io.BytesIO(b'a,b\n1,2\n'))
+    assert list(stream) == [b'a,b\n', b'1,2\n']
+    assert stream.bytes == 8
+
+def test_process_file_reports_stages(tmp_path):
+    s3 = FakeS3Client()
+    populate_bucket(s3, 'bench', 'raw/', files=3, rows=50, dirty_ratio=0.1)
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    run_metrics = RunMetrics()
+    profiler = FileProfiler(top_n=2)
+    results = process_file(s3, 'bench', 'raw/', RunContext(engine=engine, run_metrics=run_metrics, profiler=profiler))
+    report = run_metrics.report()
+    assert report['files_by_status'] == {'loaded': 3}
+    for stage in ['download', 'parse', 'validate', 'drop_invalid', 'clean', 'load']:
+        assert report['stages'][stage]['calls'] == 3
+    assert report['stages']['parse']['rows'] == 150
+    assert sum(t['load']['rows'] for t in report['tables'].values()) == sum(r['rows'] for r in results)
+    assert set(report['files']) == {r['key'] for r in results}
+
+    run_metrics.write_json(str(tmp_path / 'metrics.json'))
+    assert json.loads((tmp_path / 'metrics.json').read_text())['files_by_status'] == {'loaded': 3}
+    run_metrics.write_prometheus(str(tmp_path / 'metrics.prom'))
+    prom = (tmp_path / 'metrics.prom').read_text()
+    assert 'etl_files_total{status="loaded"} 3' in prom
+    assert 'etl_stage_rows_total{stage="load",table="stg_AB001"}' in prom
+    written = profiler.dump(str(tmp_path / 'profiles'))
+    assert len(written) == 2
+    assert (tmp_path / 'profiles').joinpath(written[0].split('/')[-1] + '.prof').exists()
+
+def test_peak_rss_sampled_per_file():
+    run_metrics = RunMetrics()
+    with metrics.activate(run_metrics), metrics.current_file('raw/a.csv'):
+        with metrics.stage('clean'):
+            pass
+    memory = run_metrics.report()['memory']
+    assert memory['peak_rss_bytes'] > 0
+    assert memory['files_peak_rss_bytes']['raw/a.csv'] == run_metrics.peak_rss['raw/a.csv'] > 0
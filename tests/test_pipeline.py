@@ -0,0 +1,25 @@
+import pandas as pd
+from sqlalchemy import create_engine
+from benchmarks.stand_ins import FakeS3Client, make_frame, populate_bucket
+from src.clean_and_load import RunContext, process_file
+from src.config import EXPECTED_SCHEMAS
+
+def test_make_frame_matches_schema():
+    for code in ['AB001', 'CD001', 'EF001']:
+        df = make_frame(code, 50, dirty_ratio=0.2, duplicate_ratio=0.2)
+        assert list(df.columns) == EXPECTED_SCHEMAS[code[:2]]
+        assert (df['Production Code'] == 'BAD').any()
+        assert df.duplicated().any()
+
+def test_pipeline_end_to_end_on_stand_ins(tmp_path):
+    s3 = FakeS3Client(page_size=2)
+    populate_bucket(s3, 'bench', 'raw/', files=6, rows=100, dirty_ratio=0.1)
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    results = process_file(s3, 'bench', 'raw/', RunContext(engine=engine, max_workers=3))
+    assert len(results) == 6
+    assert all(r['status'] == 'loaded' for r in results)
+    for table in ['stg_AB001', 'stg_CD001', 'stg_EF001']:
+        loaded = pd.read_sql_table(table, engine)
+        assert loaded.notna().all().all()
+        assert (loaded['Production Code'] == table[4:]).all()
+    assert sum(r['rows'] for r in results) == sum(len(pd.read_sql_table(t, engine)) for t in ['stg_AB001', 'stg_CD001', 'stg_EF001'])
@@ -0,0 +1,76 @@
+import pytest
+from botocore.exceptions import ClientError
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from benchmarks.stand_ins import FakeS3Client, populate_bucket
+from src.clean_and_load import RunContext, process_file
+from src.retry import AdaptiveLimiter, RetryPolicy, call_with_retry, is_retryable, is_throttle
+
+NO_WAIT = RetryPolicy(attempts=4, base_delay=0)
+
+def _client_error(code, status=503):
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'GetObject')
+
+class PgError(Exception):
+    def __init__(self, pgcode):
+        self.pgcode = pgcode
+
+def test_error_classification():
+    assert is_throttle(_client_error('SlowDown'))
+    assert is_retryable(_client_error('InternalError', 500)) and not is_throttle(_client_error('InternalError', 500))
+    assert not is_retryable(_client_error('NoSuchKey', 404))
+    assert is_retryable(ConnectionResetError()) and not is_retryable(ValueError('bad csv'))
+    assert is_throttle(OperationalError('insert', {}, PgError('53300')))
+    assert is_retryable(OperationalError('insert', {}, PgError('40P01')))
+    assert not is_retryable(OperationalError('insert', {}, PgError('42P01')))
+
+def test_backoff_is_jittered_and_capped():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+    delays = [policy.delay(10) for _ in range(200)]
+    assert 0 <= min(delays) and max(delays) <= 5.0 and len(set(delays)) > 1
+
+def test_call_with_retry_retries_transient_errors_only():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _client_error('SlowDown')
+        return 'ok'
+
+    limiter = AdaptiveLimiter(8, cooldown=0)
+    assert call_with_retry(flaky, 's3', NO_WAIT, limiter) == 'ok'
+    assert len(calls) == 3 and limiter.limit < 8
+    with pytest.raises(ValueError):
+        call_with_retry(lambda: calls.append(1) or int('x'), 's3', NO_WAIT)
+    with pytest.raises(ClientError):
+        call_with_retry(lambda: (_ for _ in ()).throw(_client_error('SlowDown')), 's3', NO_WAIT)
+
+def test_limiter_halves_on_throttle_and_grows_back():
+    limiter = AdaptiveLimiter(8, cooldown=60)
+    limiter.on_throttle()
+    limiter.on_throttle()  # Same congestion burst
+    assert limiter.limit == 4
+    for _ in range(40):
+        limiter.on_success()
+    assert limiter.limit == 8
+
+class ThrottlingS3Client(FakeS3Client):
+    def __init__(self):
+        super().__init__()
+        self.throttled = set()
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Key not in self.throttled:
+            self.throttled.add(Key)
+            raise _client_error('SlowDown')
+        return super().get_object(Bucket, Key, Range=Range)
+
+@pytest.mark.parametrize('options', [{}, {'chunksize': 20}, {'coalesce': True}])
+def test_process_file_survives_throttling(tmp_path, options):
+    s3 = ThrottlingS3Client()
+    populate_bucket(s3, 'bench', 'raw/', files=6, rows=50)
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    results = process_file(s3, 'bench', 'raw/', RunContext(engine=engine, max_workers=3, retry_policy=NO_WAIT, **options))
+    assert {r['status'] for r in results} == {'loaded'}
+    assert len(s3.throttled) == 6
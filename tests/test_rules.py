@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from benchmarks.stand_ins import FakeS3Client, make_csv, make_frame
+from src import clean_and_load
+from src.rules import REASONS_COLUMN, RULES, RuleSet, evaluate, schema_prefix, split_rejects
+
+def _cd(**overrides):
+    data = {
+        'Production Code': ['CD001', 'CD001', 'BAD', None, 'CD001', 'CD001', 'CD001'],
+        'Unit ID': ['U1', 'U1', 'U2', 'U3', 'U1', 'U4', 'U5'],
+        'Column A Stage A': [1.0, 1.0, 2.0, 3.0, 1.0, np.inf, 5.0],
+        'Column B Stage A': [1.0, 1.0, 2.0, 3.0, 9.0, 1.0, 5.0],
+        'Column C Stage A': [1.0, 1.0, 2.0, 3.0, 1.0, 1.0, 5.0],
+        'Column D Stage A': [1.0, 1.0, 2.0, 3.0, 1.0, 1.0, None],
+    }
+    data.update(overrides)
+    return pd.DataFrame(data)
+
+def test_rules_follow_schemas_and_pivot():
+    assert RULES['EF'].allowed == {'Comment': frozenset({'Comment', 'test', 'This is not Real'})}
+    assert list(RULES['EF'].unique) == ['Production Code', 'Parent ID', 'Child Position', 'Comment']
+    assert set(RULES['CD'].ranges) == {'Column A Stage A', 'Column B Stage A', 'Column C Stage A', 'Column D Stage A'}
+    assert schema_prefix(_cd().columns) == 'CD'
+
+def test_split_rejects_labels_every_reason():
+    kept, rejected = split_rejects(_cd())
+    assert list(kept['Unit ID']) == ['U1']
+    assert list(rejected[REASONS_COLUMN]) == [
+        'duplicate', 'format:Production Code', 'missing:Production Code', 'duplicate_key',
+        'range:Column A Stage A', 'missing:Column D Stage A',
+    ]
+    assert (rejected.drop(columns=REASONS_COLUMN).dtypes == 'string').all()
+
+def test_failed_checks_are_all_kept():
+    rules = RuleSet(required=['Unit ID'], ranges={'Column B Stage A': (0.0, 2.0)})
+    df = _cd(**{'Unit ID': [None] * 7, 'Column B Stage A': ['1', 'x', '2', '3', '9', '1', '5']})
+    bits, reasons = evaluate(df, rules)
+    labels = [{r for i, r in enumerate(reasons) if int(b) >> i & 1} for b in bits]
+    assert labels[1] == {'missing:Unit ID', 'not_numeric:Column B Stage A'}
+    assert labels[4] == {'missing:Unit ID', 'range:Column B Stage A'}
+
+def test_allowed_values_checked_per_category():
+    df = make_frame('EF001', 300, seed=1)
+    df['Comment'] = df['Comment'].astype('category').cat.add_categories(['Unknown'])
+    df.loc[[3, 7], 'Comment'] = 'Unknown'
+    _, rejected = split_rejects(df)
+    assert rejected.loc[rejected[REASONS_COLUMN] == 'allowed:Comment'].index.tolist() == [3, 7]
+
+def test_rules_without_keys_match_default_cleaning():
+    df = make_frame('CD001', 2000, dirty_ratio=0.1, duplicate_ratio=0.2, seed=5)
+    expected = clean_and_load.cleaning_data(clean_and_load.drop_invalid_production_codes(df.copy()))
+    kept, rejected = split_rejects(df, RuleSet(required=list(df.columns), formats=RULES['CD'].formats))
+    assert kept.index.equals(expected.index)
+    assert len(kept) + len(rejected) == len(df)
+
+@pytest.mark.parametrize('options', [{}, {'chunksize': 30}, {'coalesce': True}, {'low_memory': True}])
+def test_process_file_quarantines_rejects(tmp_path, options):
+    s3 = FakeS3Client()
+    s3.put_object(Bucket='b', Key='raw/CD001.csv', Body=make_csv('CD001', 100, dirty_ratio=0.2, seed=2))
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    [result] = clean_and_load.process_file(s3, 'b', 'raw/', clean_and_load.RunContext(engine=engine, quarantine=True, **options))
+    staged = pd.read_sql_table('stg_CD001', engine)
+    quarantined = pd.read_sql_table('quarantine_CD', engine)
+    assert result['status'] == 'loaded' and result['rows'] == len(staged)
+    assert result['quarantined'] == len(quarantined) > 0
+    assert len(staged) + len(quarantined) == 100
+    assert set(quarantined['source_key']) == {'raw/CD001.csv'}
+    assert quarantined[REASONS_COLUMN].str.match(r'(format:|missing:|duplicate_key)').all()
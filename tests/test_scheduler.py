@@ -0,0 +1,100 @@
+import threading
+import pandas as pd
+from sqlalchemy import create_engine
+from benchmarks.stand_ins import FakeS3Client, populate_bucket, register_sqlite_functions
+from src.clean_and_load import RunContext, process_file
+from src.scheduler import MergeScheduler, production_code_of_key
+
+class RecordingMerge:
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, source, target, engine=None, incremental=True):
+        with self.lock:
+            self.calls.append((source, target, incremental))
+
+def _result(key, *tables):
+    return {'key': key, 'status': 'loaded', 'tables': {t: 1 for t in tables}}
+
+def test_production_code_of_key():
+    assert production_code_of_key('raw/AB001_00007.csv.gz') == 'AB001'
+    assert production_code_of_key('raw/export.csv') is None
+
+def test_merge_waits_for_every_file_of_its_code():
+    merge = RecordingMerge()
+    scheduler = MergeScheduler(None, max_workers=1, merge=merge)
+    list(scheduler.track([{'Key': 'raw/AB001_0.csv'}, {'Key': 'raw/AB001_1.csv'}, {'Key': 'raw/CD001_0.csv'}]))
+    scheduler.file_done(_result('raw/AB001_0.csv', 'stg_AB001'))
+    scheduler.file_done(_result('raw/CD001_0.csv', 'stg_CD001'))
+    assert scheduler._queued == {'stg_CD001'}
+    scheduler.file_done(_result('raw/AB001_1.csv', 'stg_AB001'))
+    merges = scheduler.wait()
+    assert sorted(merge.calls) == [('stg_AB001', 'prod_AB001', True), ('stg_CD001', 'prod_CD001', True)]
+    assert {m['status'] for m in merges.values()} == {'merged'}
+
+def test_merge_starts_once_the_listing_moves_past_its_code():
+    merge = RecordingMerge()
+    scheduler = MergeScheduler(None, max_workers=1, merge=merge)
+    listing = scheduler.track(iter([{'Key': 'raw/AB001_0.csv'}, {'Key': 'raw/AB001_1.csv'},
+                                    {'Key': 'raw/CD001_0.csv'}, {'Key': 'raw/EF001_0.csv'}]))
+    next(listing), next(listing)
+    scheduler.file_done(_result('raw/AB001_0.csv', 'stg_AB001'))
+    scheduler.file_done(_result('raw/AB001_1.csv', 'stg_AB001'))
+    assert not scheduler._queued  # More AB001 keys may follow
+    next(listing)
+    assert scheduler._queued == {'stg_AB001'}  # While CD001 and EF001 are still loading
+    scheduler.file_done(_result('raw/CD001_0.csv', 'stg_CD001'))
+    assert scheduler._queued == {'stg_AB001'}
+    list(listing)
+    scheduler.file_done(_result('raw/EF001_0.csv', 'stg_EF001'))
+    scheduler.wait()
+    assert len(merge.calls) == 3
+
+def test_unordered_listing_merges_after_all_of_it():
+    scheduler = MergeScheduler(None, max_workers=1, merge=RecordingMerge())
+    listing = scheduler.track(iter([{'Key': 'raw/b/CD001_0.csv'}, {'Key': 'raw/a/AB001_0.csv'},
+                                    {'Key': 'raw/b/EF001_0.csv'}, {'Key': 'raw/c/CD001_1.csv'}]))
+    next(listing), next(listing), next(listing)
+    scheduler.file_done(_result('raw/b/CD001_0.csv', 'stg_CD001'))
+    scheduler.file_done(_result('raw/a/AB001_0.csv', 'stg_AB001'))
+    assert not scheduler._queued
+    list(listing)
+    assert scheduler._queued == {'stg_AB001'}
+    scheduler.wait()
+
+def test_unnamed_file_holds_back_merges_and_late_writes_remerge():
+    merge = RecordingMerge()
+    scheduler = MergeScheduler(None, max_workers=1, merge=merge)
+    list(scheduler.track([{'Key': 'raw/export.csv'}, {'Key': 'raw/CD001_0.csv'}, {'Key': 'raw/EF001_0.csv'}]))
+    scheduler.file_done(_result('raw/CD001_0.csv', 'stg_CD001'))
+    assert not scheduler._queued
+    scheduler.file_done(_result('raw/export.csv', 'stg_CD001'))
+    assert scheduler._queued == {'stg_CD001'}
+    # A mixed EF file also writes CD rows after the CD merge was queued
+    scheduler.file_done(_result('raw/EF001_0.csv', 'stg_EF001', 'stg_CD001'))
+    scheduler.wait()
+    assert merge.calls.count(('stg_CD001', 'prod_CD001', False)) == 1
+    assert ('stg_EF001', 'prod_EF001', True) in merge.calls
+
+def test_failed_merge_is_reported():
+    def failing(source, target, engine=None, incremental=True):
+        raise RuntimeError('boom')
+    scheduler = MergeScheduler(None, max_workers=1, merge=failing)
+    list(scheduler.track([{'Key': 'raw/AB001_0.csv'}]))
+    scheduler.file_done(_result('raw/AB001_0.csv', 'stg_AB001'))
+    assert scheduler.wait() == {'stg_AB001': {'target': 'prod_AB001', 'status': 'failed', 'error': 'boom'}}
+
+def test_process_file_merges_into_prod(tmp_path):
+    s3 = FakeS3Client()
+    populate_bucket(s3, 'bench', 'raw/', files=6, rows=50)
+    engine = create_engine(f"sqlite:///{tmp_path / 'etl.db'}")
+    register_sqlite_functions(engine)
+    scheduler = MergeScheduler(engine, max_workers=2)
+    results = process_file(s3, 'bench', 'raw/', RunContext(engine=engine, max_workers=2, scheduler=scheduler))
+    merges = scheduler.wait()
+    assert {r['status'] for r in results} == {'loaded'}
+    assert sorted(merges) == ['stg_AB001', 'stg_CD001', 'stg_EF001']
+    assert {m['status'] for m in merges.values()} == {'merged'}
+    for merge in merges.values():
+        assert len(pd.read_sql_table(merge['target'], engine)) > 0
@@ -0,0 +1,106 @@
+import os
+import signal
+import threading
+import time
+import pandas as pd
+import pytest
+from multiprocessing.shared_memory import SharedMemory
+from sqlalchemy import create_engine
+from benchmarks.stand_ins import FakeS3Client, make_csv, make_frame, populate_bucket
+from src.clean_and_load import RunContext, process_file
+from src.metrics import RunMetrics
+from src.staged import _Admission, parse_pool, read_frame, share_frame, shutdown_parse_pools
+
+@pytest.fixture(scope='module', autouse=True)
+def parse_pools():
+    yield
+    shutdown_parse_pools()
+
+def test_shared_frame_round_trip_unlinks_segment():
+    df = make_frame('EF001', 500, dirty_ratio=0.1, seed=3)
+    buffer = share_frame(df)
+    pd.testing.assert_frame_equal(read_frame(buffer), df)
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=buffer.name, track=False)
+
+def _bucket():
+    s3 = FakeS3Client()
+    populate_bucket(s3, 'b', 'raw/', files=6, rows=200, dirty_ratio=0.1, duplicate_ratio=0.1)
+    s3.put_object(Bucket='b', Key='raw/AB009.csv', Body=b'Wrong,Header\n1,2\n')
+    return s3
+
+@pytest.mark.parametrize('options', [{}, {'quarantine': True}, {'coalesce': True}])
+def test_parse_workers_match_thread_pool(tmp_path, options):
+    results, tables = {}, {}
+    for parse_workers in (0, 2):
+        engine = create_engine(f"sqlite:///{tmp_path / f'stg{parse_workers}.db'}")
+        run_metrics = RunMetrics()
+        ctx = RunContext(engine=engine, max_workers=2, parse_workers=parse_workers, run_metrics=run_metrics, **options)
+        found = process_file(_bucket(), 'b', 'raw/', ctx)
+        results[parse_workers] = sorted((r['key'], r['status'], r['rows'], r['quarantined']) for r in found)
+        tables[parse_workers] = {table: len(pd.read_sql_table(table, engine))
+                                 for table in ['stg_AB001', 'stg_CD001', 'stg_EF001']}
+        assert run_metrics.stages['parse']['rows'] > 0
+        engine.dispose()
+    assert results[2] == results[0]
+    assert ('raw/AB009.csv', 'schema_invalid', 0, 0) in results[2]
+    assert tables[2] == tables[0]
+
+def test_admission_bounds_files_and_bytes():
+    admission = _Admission(max_files=2, max_bytes=100)
+    admission.admit(60)
+    admitted = threading.Event()
+    waiter = threading.Thread(target=lambda: (admission.admit(60), admitted.set()))
+    waiter.start()
+    assert not admitted.wait(0.1)  # 120 bytes would exceed max_bytes
+    admission.release(60)
+    assert admitted.wait(1)
+    waiter.join()
+    # A file larger than max_bytes still goes through alone
+    admission.release(60)
+    admission.admit(500)
+    assert (admission.files, admission.bytes) == (1, 500)
+
+def _segments():
+    return {name for name in os.listdir('/dev/shm') if name.startswith('psm_')} if os.path.isdir('/dev/shm') else set()
+
+class KillingS3Client(FakeS3Client):
+    """Kills every parse worker while the given key downloads."""
+    def __init__(self, kill_key):
+        super().__init__()
+        self.kill_key = kill_key
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Key == self.kill_key:
+            pool = parse_pool(2)
+            for process in list(pool._processes.values()):
+                os.kill(process.pid, signal.SIGKILL)
+            deadline = time.monotonic() + 10
+            while not pool._broken and time.monotonic() < deadline:
+                time.sleep(0.01)
+        return super().get_object(Bucket, Key, Range)
+
+def test_dead_parse_worker_fails_only_files_in_flight(tmp_path):
+    keys = [f'raw/CD001_{i}.csv' for i in range(8)]
+    s3 = KillingS3Client(kill_key=keys[2])
+    for key in keys:
+        s3.put_object(Bucket='b', Key=key, Body=make_csv('CD001', 20, seed=len(key)))
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    results = process_file(s3, 'b', 'raw/', RunContext(engine=engine, max_workers=1, parse_workers=2))
+    status = {r['key']: r['status'] for r in results}
+    assert set(status) == set(keys)
+    assert {status[key] for key in keys[3:]} == {'loaded'}  # Parsed by a fresh pool
+
+def test_failing_listing_lets_files_in_flight_finish(tmp_path):
+    s3 = _bucket()
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    before = _segments()
+
+    def listing():
+        yield from s3.list_objects_v2(Bucket='b', Prefix='raw/')['Contents'][:3]
+        raise RuntimeError('listing failed')
+
+    with pytest.raises(RuntimeError, match='listing failed'):
+        process_file(s3, 'b', 'raw/', RunContext(engine=engine, max_workers=2, parse_workers=2), objects=listing())
+    assert len(pd.read_sql_table('stg_AB001', engine)) > 0
+    assert _segments() <= before
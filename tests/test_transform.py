@@ -0,0 +1,113 @@
+import re
+import pandas as pd
+from datetime import datetime
+from sqlalchemy import create_engine, event, text
+from src import transform
+
+def _copy_query(source_table, target_table, where=''):
+    return f"insert into {target_table} select a from {source_table} {where}"
+
+def _stage(engine, values, ts):
+    pd.DataFrame({'a': values, 'processing_ts': ts}).to_sql('stg', engine, if_exists='append', index=False)
+
+def test_load_to_prod_uses_given_engine_and_commits(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'prod.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("create table stg (a int)"))
+        conn.execute(text("insert into stg values (1), (2)"))
+        conn.execute(text("create table prod (a int)"))
+    transform.load_to_prod('stg', 'prod', lambda src, tgt: f"insert into {tgt} select a from {src}", engine=engine, incremental=False)
+    assert len(pd.read_sql_table('prod', engine)) == 2
+
+def test_load_to_prod_merges_only_rows_above_watermark(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'prod.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("create table prod (a int)"))
+    _stage(engine, [1, 2], datetime(2025, 1, 1))
+    transform.load_to_prod('stg', 'prod', _copy_query, engine=engine)
+    transform.load_to_prod('stg', 'prod', _copy_query, engine=engine)
+    _stage(engine, [3], datetime(2025, 1, 2))
+    transform.load_to_prod('stg', 'prod', _copy_query, engine=engine)
+    assert sorted(pd.read_sql_table('prod', engine)['a']) == [1, 2, 3]
+    with engine.connect() as conn:
+        assert transform.get_watermark(conn, 'prod') == datetime(2025, 1, 2)
+
+def test_load_to_prod_archives_merged_rows(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'prod.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("create table prod (a int)"))
+    _stage(engine, [1, 2], datetime(2025, 1, 1))
+    transform.load_to_prod('stg', 'prod', _copy_query, engine=engine, retention='archive')
+    assert len(pd.read_sql_table('stg', engine)) == 0
+    assert len(pd.read_sql_table('stg_archive', engine)) == 2
+
+def test_merge_queries_apply_filter():
+    query = transform.file3_merge_query('stg_EF001', 'ef', 'where processing_ts > :low')
+    assert 'from "stg_EF001" where processing_ts > :low' in query
+
+def test_merge_sql_quotes_mixed_case_tables_for_postgres():
+    from sqlalchemy.dialects import postgresql
+    from src.merge import MERGE_SPECS, merge_query, target_ddl
+    quote = postgresql.dialect().identifier_preparer.quote
+    query = merge_query(MERGE_SPECS['AB'], 'stg_AB001', 'prod_AB001', quote=quote)
+    assert 'from "stg_AB001" ' in query and 'insert into "prod_AB001" ' in query
+    assert target_ddl(MERGE_SPECS['AB'], 'prod_ab', quote)[1].endswith('ux_prod_ab_id on prod_ab (id)')
+    assert '"ux_prod_AB001_id" on "prod_AB001"' in target_ddl(MERGE_SPECS['AB'], 'prod_AB001', quote)[1]
+
+def _staged_engine(tmp_path):
+    from benchmarks.stand_ins import make_frame, register_sqlite_functions
+    from src.clean_and_load import cleaning_data
+    engine = create_engine(f"sqlite:///{tmp_path / 'prod.db'}")
+    register_sqlite_functions(engine)
+    for code in ['AB001', 'CD001', 'EF001']:
+        df = cleaning_data(make_frame(code, 200, duplicate_ratio=0.2), processing_ts=datetime(2025, 1, 1))
+        df.to_sql(f'stg_{code}', engine, index=False)
+    return engine
+
+def test_generated_merge_queries_run(tmp_path):
+    from src.merge import MERGE_SPECS, target_ddl
+    engine = _staged_engine(tmp_path)
+    for prefix, query_func in [('AB', transform.file2_merge_query), ('CD', transform.file1_merge_query),
+                               ('EF', transform.file3_merge_query)]:
+        with engine.begin() as conn:
+            for statement in target_ddl(MERGE_SPECS[prefix], f'prod_{prefix}'):
+                conn.execute(text(statement))
+        transform.load_to_prod(f'stg_{prefix}001', f'prod_{prefix}', query_func, engine=engine)
+        assert len(pd.read_sql_table(f'prod_{prefix}', engine)) > 0
+
+def test_load_to_prod_upserts_spec_merge_in_batches(tmp_path):
+    engine = _staged_engine(tmp_path)
+    keys = {'stg_AB001': ['Parent ID', 'Child Position', 'Operator'], 'stg_CD001': ['Unit ID'],
+            'stg_EF001': ['Parent ID', 'Child Position']}
+    for source, key in keys.items():
+        transform.load_to_prod(source, f'prod_{source[4:6]}', engine=engine, batch_size=17)
+        staged = pd.read_sql_table(source, engine)
+        prod = pd.read_sql_table(f'prod_{source[4:6]}', engine)
+        assert len(prod) == len(staged.drop_duplicates(key)) and prod['id'].is_unique
+
+    # A newer batch updates the EF pivot values it holds and keeps the others
+    ef = pd.read_sql_table('stg_EF001', engine).head(1).assign(
+        **{'Comment': 'test', 'Column A Stage A': 3.0, 'Column B Stage A': 6.0, 'Column C Stage A': 9.0},
+        processing_ts=datetime(2025, 1, 2))
+
+    def ef_row():
+        prod = pd.read_sql_table('prod_EF', engine)
+        return prod[(prod['parent_id'] == ef['Parent ID'][0]) & (prod['child_position'] == ef['Child Position'][0])]
+
+    before = ef_row()
+    ef.to_sql('stg_EF001', engine, if_exists='append', index=False)
+    transform.load_to_prod('stg_EF001', 'prod_EF', engine=engine, batch_size=17)
+    after = ef_row()
+    assert after['test'].tolist() == [6.0]
+    pd.testing.assert_frame_equal(after[['comment', 'this_is_not_real']], before[['comment', 'this_is_not_real']])
+    with engine.connect() as conn:
+        assert conn.execute(text("select count(*) from sqlite_master where name = 'ux_prod_EF_id'")).scalar() == 1
+
+def test_load_to_prod_quotes_every_table_name(tmp_path):
+    engine = _staged_engine(tmp_path)
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+    transform.load_to_prod('stg_CD001', 'prod_CD001', engine=engine, retention='archive')
+    assert len(pd.read_sql_table('prod_CD001', engine)) > 0
+    # Postgres folds unquoted names to lower case, missing the quoted mixed-case tables
+    assert not [s for s in statements if 'CD001' in re.sub(r'"[^"]*"', '', s)]
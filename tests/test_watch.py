@@ -0,0 +1,96 @@
+import pandas as pd
+from sqlalchemy import create_engine
+from benchmarks.stand_ins import FakeS3Client, make_csv
+from src.clean_and_load import RunContext, process_file
+from src.watch import LocalEventQueue, Watcher, objects_from_event
+
+class RecordingS3Client(FakeS3Client):
+    def __init__(self):
+        super().__init__()
+        self.start_after = []
+
+    def list_objects_v2(self, **kwargs):
+        self.start_after.append(kwargs.get('StartAfter'))
+        return super().list_objects_v2(**kwargs)
+
+def _put(s3, key, rows=10):
+    s3.put_object(Bucket='b', Key=key, Body=make_csv(key.split('/')[-1][:5], rows))
+
+def _watcher(s3, batches, statuses=None, **kwargs):
+    def process_batch(objects):
+        batches.append(sorted(obj['Key'] for obj in objects))
+        return [{'key': obj['Key'], 'status': (statuses or {}).get(obj['Key'], 'loaded')} for obj in objects]
+    options = dict(interval=0, batch_window=0, rescan_every=3)
+    options.update(kwargs)
+    return Watcher(s3, 'b', ['raw/'], process_batch, **options)
+
+def test_objects_from_event():
+    event = {'Records': [
+        {'eventName': 'ObjectCreated:Put', 'eventTime': '2025-01-01T00:00:00.000Z',
+         's3': {'bucket': {'name': 'b'}, 'object': {'key': 'raw/CD001+1.csv', 'size': 5, 'eTag': 'abc'}}},
+        {'eventName': 'ObjectRemoved:Delete', 's3': {'bucket': {'name': 'b'}, 'object': {'key': 'raw/x.csv'}}},
+        {'eventName': 'ObjectCreated:Put', 's3': {'bucket': {'name': 'other'}, 'object': {'key': 'raw/y.csv'}}},
+    ]}
+    [entry] = objects_from_event(event, 'b')
+    assert entry['Key'] == 'raw/CD001 1.csv' and entry['ETag'] == '"abc"' and entry['Size'] == 5
+    assert entry['LastModified'].year == 2025
+
+def test_polls_incrementally_and_rescans_for_earlier_keys():
+    s3 = RecordingS3Client()
+    _put(s3, 'raw/CD001_0.csv')
+    batches = []
+    watcher = _watcher(s3, batches)
+    watcher.run(max_batches=1)
+    _put(s3, 'raw/CD001_1.csv')
+    _put(s3, 'raw/AB001_0.csv')  # Sorts before the last key seen
+    watcher.run(max_batches=3)
+    assert batches == [['raw/CD001_0.csv'], ['raw/CD001_1.csv'], ['raw/AB001_0.csv']]
+    assert s3.start_after[:2] == [None, 'raw/CD001_0.csv'] and None in s3.start_after[2:]
+
+def test_batches_by_size_and_retries_failures():
+    s3 = FakeS3Client()
+    for i in range(5):
+        _put(s3, f'raw/CD001_{i}.csv')
+    batches = []
+    watcher = _watcher(s3, batches, statuses={'raw/CD001_4.csv': 'failed'}, batch_files=2, batch_window=60)
+    watcher.run(max_batches=1)
+    assert [len(batch) for batch in batches] == [5]  # The first listing brings the whole backlog
+    watcher.batch_window = 0
+    watcher.run(max_batches=2)  # The rescan after 3 polls finds the failed file again
+    assert batches[-1] == ['raw/CD001_4.csv'] and watcher._polls == 3
+
+def test_rescans_forget_objects_the_previous_listing_saw():
+    s3 = FakeS3Client()
+    for i in range(3):
+        _put(s3, f'raw/CD001_{i}.csv')
+    batches = []
+    watcher = _watcher(s3, batches, statuses={'raw/CD001_2.csv': 'failed'}, rescan_every=2, rescan_overlap=0)
+    watcher.run(max_batches=1)
+    _put(s3, 'raw/AB001_0.csv')
+    watcher.run(max_batches=2)
+    assert batches[-1] == ['raw/AB001_0.csv', 'raw/CD001_2.csv']
+    assert set(watcher._seen) == {'raw/AB001_0.csv'} and watcher._retry == {'raw/CD001_2.csv'}
+
+def test_event_notifications_feed_batches():
+    s3 = FakeS3Client()
+    events = LocalEventQueue()
+    batches = []
+    watcher = _watcher(s3, batches, events=events, rescan_every=0)
+    watcher.run(max_batches=0)  # Initial listing of an empty bucket
+    _put(s3, 'raw/EF001_0.csv')
+    events.send('{"Records": [{"eventName": "ObjectCreated:Put", "s3": {"bucket": {"name": "b"}, '
+                '"object": {"key": "raw/EF001_0.csv", "size": 10, "eTag": "e"}}}]}')
+    watcher.run(max_batches=1)
+    assert batches == [['raw/EF001_0.csv']]
+
+def test_watch_loads_micro_batches(tmp_path):
+    s3 = FakeS3Client()
+    engine = create_engine(f"sqlite:///{tmp_path / 'stg.db'}")
+    ctx = RunContext(engine=engine)
+    watcher = Watcher(s3, 'b', ['raw/'], lambda objects: process_file(s3, 'b', 'raw/', ctx, objects=objects),
+                      interval=0, batch_window=0)
+    _put(s3, 'raw/CD001_0.csv', rows=30)
+    watcher.run(max_batches=1)
+    _put(s3, 'raw/CD001_1.csv', rows=20)
+    watcher.run(max_batches=2)
+    assert len(pd.read_sql_table('stg_CD001', engine)) == 50
@@ -0,0 +1,78 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from benchmarks.stand_ins import FakeS3Client, populate_bucket
+from src import clean_and_load
+from src.clean_and_load import RunContext, process_file
+from src.work_queue import LeaseLost, WorkQueue
+
+def _objects(n, etag='"a"'):
+    return [{'Key': f'raw/CD001_{i}.csv', 'ETag': etag, 'Size': 10} for i in range(n)]
+
+def _result(key, status='loaded'):
+    return {'key': key, 'status': status, 'tables': {}, 'rows': 1, 'error': None}
+
+def test_claims_never_overlap(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'queue.db'}")
+    first, second = WorkQueue(engine, owner='a', batch_size=3), WorkQueue(engine, owner='b', batch_size=3)
+    assert first.enqueue(_objects(5)) == 5
+    second.enqueue(_objects(5))  # Re-listing the same objects queues nothing new
+    claimed_a, claimed_b = first.claim(), second.claim()
+    assert len(claimed_a) == 3 and len(claimed_b) == 2
+    assert not {o['Key'] for o in claimed_a} & {o['Key'] for o in claimed_b}
+    assert first.claim() == [] and first.counts() == {'leased': 5}
+    assert first.complete(_result(claimed_a[0]['Key'])) and not second.complete(_result(claimed_a[1]['Key']))
+
+def test_changed_object_is_queued_again(tmp_path):
+    queue = WorkQueue(create_engine(f"sqlite:///{tmp_path / 'queue.db'}"))
+    queue.enqueue(_objects(1))
+    queue.complete(_result(queue.claim()[0]['Key']))
+    queue.enqueue(_objects(1))
+    assert queue.claim() == []
+    queue.enqueue(_objects(1, etag='"b"'))
+    assert [o['ETag'] for o in queue.claim()] == ['"b"']
+
+def test_failures_are_retried_up_to_max_attempts(tmp_path):
+    queue = WorkQueue(create_engine(f"sqlite:///{tmp_path / 'queue.db'}"), max_attempts=2)
+    queue.enqueue(_objects(1))
+    for _ in range(2):
+        key = queue.claim()[0]['Key']
+        queue.complete(_result(key, 'failed'))
+    assert queue.claim() == [] and queue.counts() == {'failed': 1}
+
+def test_lease_expiring_at_max_attempts_is_marked_failed(tmp_path):
+    queue = WorkQueue(create_engine(f"sqlite:///{tmp_path / 'queue.db'}"), lease_seconds=-1, max_attempts=2)
+    queue.enqueue(_objects(1))
+    assert len(queue.claim()) == 1 and len(queue.claim()) == 1  # Both leases expire at once
+    assert queue.claim() == [] and queue.counts() == {'failed': 1}
+
+def test_expired_lease_is_reclaimed_and_fenced(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'queue.db'}")
+    crashed, survivor = WorkQueue(engine, owner='crashed', lease_seconds=-1), WorkQueue(engine, owner='survivor')
+    crashed.enqueue(_objects(2))
+    assert len(crashed.claim()) == 2
+    assert len(survivor.claim()) == 2
+    assert crashed.renew() == 0
+    with engine.begin() as conn, pytest.raises(LeaseLost):
+        crashed.complete(_result('raw/CD001_0.csv'), conn=conn)
+
+def test_nodes_load_each_file_once(tmp_path, caplog):
+    s3 = FakeS3Client()
+    populate_bucket(s3, 'bench', 'raw/', files=6, rows=40)
+    engine = create_engine(f"sqlite:///{tmp_path / 'etl.db'}")
+    zombie = WorkQueue(engine, owner='zombie', lease_seconds=-1, batch_size=2)
+    zombie.enqueue(s3.list_objects_v2(Bucket='bench', Prefix='raw/')['Contents'])
+    stalled = zombie.claim()
+
+    worker = WorkQueue(engine, owner='worker', batch_size=2)
+    results = process_file(s3, 'bench', 'raw/', RunContext(engine=engine, work_queue=worker, coalesce=True))
+    worker.close()
+    assert len(results) == 6 and worker.counts() == {'done': 6}
+    assert 'lost' not in caplog.text  # Completed with the load, not again afterwards
+
+    # The stalled node wakes up after its leases were taken over: its load is rolled back
+    ctx = RunContext(engine=engine, work_queue=zombie)
+    late = clean_and_load.process_single_file(s3, 'bench', stalled[0]['Key'], ctx)
+    assert late['status'] == 'failed' and 'Lease' in late['error']
+    staged = sum(len(pd.read_sql_table(t, engine)) for t in ['stg_AB001', 'stg_CD001', 'stg_EF001'])
+    assert staged == sum(r['rows'] for r in results)